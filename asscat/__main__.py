@@ -7,17 +7,27 @@ import uvloop
 this = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(this))
 
-from asscat.utils import build_arg_parser
-from asscat.tui.ac_app import AssCatApp
+from asscat.utils import admission_policy, build_arg_parser, liveness_policy
 
 
-async def main():
-    args = build_arg_parser()
+async def main(args):
+    # Imported here, headless runs never load textual
+    from asscat.manager import AssCatManager
+    from asscat.tui.ac_app import AssCatApp
 
-    app = AssCatApp()
+    acm = AssCatManager(buffered=args.buffered, admission=admission_policy(args),
+                        liveness=liveness_policy(args))
+    if args.control:
+        await acm.start_control_server(args.control)
+    app = AssCatApp(acm)
     await app.run_async()
 
 
 if __name__ == '__main__':
-    uvloop.run(main=main(), debug=True)
+    args = build_arg_parser()
+    if args.tui and not args.raw:
+        uvloop.run(main=main(args), debug=True)
+    else:
+        from asscat.headless import run_headless
+        uvloop.run(run_headless(args))
     sys.exit(0)
@@ -0,0 +1,398 @@
+from __future__ import annotations
+
+import socket
+from asyncio import AbstractEventLoop, Future, Server, TimerHandle
+from ssl import SSLContext
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from asscat.logger import setup_logger
+
+# Connections the kernel queues for a listener before they're accepted
+BACKLOG = 1024
+
+# What happens to a connection that can't be admitted and finds the
+# listener's queue full: it's closed right away, or it's queued anyway
+# and the listener stops accepting, leaving new connections waiting in
+# the kernel backlog until the queue has room again
+REJECT = 'reject'
+PAUSE = 'pause'
+
+
+class AdmissionPolicy(NamedTuple):
+    """
+    Limits on accepting sessions. ``rate`` is the sustained number of
+    sessions admitted per second, ``burst`` how many may be admitted at
+    once after a quiet period, ``rate`` by default. Connections over a
+    limit wait, with reading paused, in a queue of ``queue`` entries.
+    """
+    backlog: int = BACKLOG
+    max_sessions: Optional[int] = None
+    rate: Optional[float] = None
+    burst: Optional[int] = None
+    queue: int = 0
+    overflow: str = REJECT
+
+
+def check_policy(policy: AdmissionPolicy) -> AdmissionPolicy:
+    if policy.overflow not in (REJECT, PAUSE):
+        raise ValueError(f'Unknown overflow policy {policy.overflow!r}')
+    if policy.backlog < 1 or policy.queue < 0:
+        raise ValueError('The backlog must be positive and the queue not negative')
+    if policy.max_sessions is not None and policy.max_sessions < 1:
+        raise ValueError('At least one session must be allowed')
+    if policy.rate is not None and policy.rate <= 0:
+        raise ValueError('The accept rate must be positive')
+    if policy.burst is not None and policy.burst < 1:
+        raise ValueError('The accept burst must be at least one')
+    return policy
+
+
+class AdmissionStats:
+    """Counters of one listener's admission"""
+    __slots__ = ('admitted', 'rate_limited', 'session_limited', 'queued', 'rejected', 'pauses')
+
+    def __init__(self):
+        self.admitted: int = 0
+        # Connections that found no token or no free session slot
+        self.rate_limited: int = 0
+        self.session_limited: int = 0
+        self.queued: int = 0
+        self.rejected: int = 0
+        # Times the listener stopped accepting
+        self.pauses: int = 0
+
+
+class TokenBucket:
+    """``rate`` tokens per second, at most ``burst`` saved up"""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate: float = rate
+        self.burst: int = burst
+        self.tokens: float = burst
+        self.stamp: float = now
+
+    def ready(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= 1
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def wait(self) -> float:
+        """Seconds until the next token, as of the last ready()"""
+        return max(0., (1 - self.tokens) / self.rate)
+
+
+class _Limits:
+    __slots__ = ('policy', 'stats', 'sessions', 'bucket', 'waiting', 'pause', 'resume', 'paused')
+
+    def __init__(self, policy: AdmissionPolicy, now: float,
+                 pause: Callable | None = None, resume: Callable | None = None):
+        self.policy: AdmissionPolicy = policy
+        self.stats: AdmissionStats = AdmissionStats()
+        self.sessions: int = 0
+        self.bucket: Optional[TokenBucket] = None
+        if policy.rate is not None:
+            burst = policy.burst or max(1, int(policy.rate))
+            self.bucket = TokenBucket(policy.rate, burst, now)
+        # Sessions waiting for admission, by session id in order of arrival
+        self.waiting: Dict[int, Tuple] = {}
+        self.pause: Optional[Callable] = pause
+        self.resume: Optional[Callable] = resume
+        self.paused: bool = False
+
+    def blocked(self, now: float) -> Optional[str]:
+        """Why a session can't be admitted now, None if it can"""
+        max_sessions = self.policy.max_sessions
+        if max_sessions is not None and self.sessions >= max_sessions:
+            return 'sessions'
+        if self.bucket is not None and not self.bucket.ready(now):
+            return 'rate'
+        return None
+
+
+class AdmissionControl:
+    """
+    Admits the sessions of listeners within their own limits and the
+    global ones. Sessions of listeners it doesn't know, UDP and sharded
+    ones, are admitted right away and only counted.
+
+    A session that can't be admitted has reading paused and waits in
+    its listener's queue until a session closes or the rate allows
+    another one, then ``admitted`` is called for it like for sessions
+    admitted right away, with the output that came in meanwhile. Once
+    the queue is full the overflow policy decides. Queues are served
+    one session per listener in turn.
+    """
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            admitted: Callable,
+            policy: AdmissionPolicy = AdmissionPolicy(),
+    ):
+        self._loop: AbstractEventLoop = loop
+        self._admitted: Callable = admitted
+        self._global: _Limits = _Limits(check_policy(policy), loop.time())
+        self._listeners: Dict[int, _Limits] = {}
+        self._handle: Optional[TimerHandle] = None
+        self._logger = setup_logger(__name__)
+
+    @property
+    def policy(self) -> AdmissionPolicy:
+        return self._global.policy
+
+    @property
+    def sessions(self) -> int:
+        return self._global.sessions
+
+    def add_listener(
+            self,
+            listener_id: int,
+            policy: AdmissionPolicy,
+            pause: Callable | None = None,
+            resume: Callable | None = None,
+    ) -> None:
+        """Limit a listener, ``pause`` and ``resume`` stop and restart accepting"""
+        check_policy(policy)
+        if policy.overflow == PAUSE and pause is None:
+            raise ValueError('This listener can not stop accepting, use the reject policy')
+        self._listeners[listener_id] = _Limits(policy, self._loop.time(), pause, resume)
+
+    def remove_listener(self, listener_id: int) -> None:
+        """Forget a listener, its waiting sessions are closed"""
+        limits = self._listeners.pop(listener_id, None)
+        if limits is not None:
+            for session, *_ in limits.waiting.values():
+                _abort(session)
+            limits.waiting.clear()
+
+    def stats(self, listener_id: int) -> Optional[AdmissionStats]:
+        limits = self._listeners.get(listener_id)
+        return None if limits is None else limits.stats
+
+    def waiting(self, listener_id: int) -> int:
+        limits = self._listeners.get(listener_id)
+        return 0 if limits is None else len(limits.waiting)
+
+    def offer(self, session, peername) -> None:
+        """A session connected, admit, queue or reject it"""
+        limits = self._listeners.get(session.server_id)
+        if limits is None:
+            self._global.sessions += 1
+            self._admitted(session, peername, b'')
+            return
+        if limits.waiting:
+            self._drain()
+        stats = limits.stats
+        blocked = self._blocked(limits)
+        if blocked is None and not limits.waiting:
+            self._admit(limits, session, peername)
+            return
+        if blocked == 'rate':
+            stats.rate_limited += 1
+        else:
+            stats.session_limited += 1
+        if len(limits.waiting) >= limits.policy.queue:
+            if limits.policy.overflow == REJECT:
+                stats.rejected += 1
+                _abort(session)
+                return
+            if not limits.paused:
+                limits.paused = True
+                stats.pauses += 1
+                self._logger.info(f'Listener #{session.server_id} stopped accepting, '
+                                  f'{len(limits.waiting) + 1} sessions waiting')
+                limits.pause()
+        stats.queued += 1
+        _pause_reading(session)
+        # uvloop starts reading once connection_made() returned, pause
+        # the session again after that. What it reads until then is
+        # kept for the session's scrollback.
+        self._loop.call_soon(self._hold, limits, session)
+        held = bytearray()
+        tap = held.extend
+        session.add_tap(tap)
+        limits.waiting[session.session_id] = (session, peername, tap, held)
+        self._schedule()
+
+    def closed(self, session_id: int, listener_id: int) -> None:
+        """An admitted session closed, its slot goes to the next waiting one"""
+        self._global.sessions -= 1
+        limits = self._listeners.get(listener_id)
+        if limits is not None:
+            limits.sessions -= 1
+        self._drain()
+
+    def discard(self, session_id: int) -> None:
+        """A session closed before it was admitted"""
+        for limits in self._listeners.values():
+            if limits.waiting.pop(session_id, None) is not None:
+                self._drain()
+                return
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for listener_id in list(self._listeners):
+            self.remove_listener(listener_id)
+
+    @staticmethod
+    def _hold(limits: _Limits, session) -> None:
+        if session.session_id in limits.waiting:
+            _pause_reading(session)
+
+    def _blocked(self, limits: _Limits) -> Optional[str]:
+        now = self._loop.time()
+        return limits.blocked(now) or self._global.blocked(now)
+
+    def _admit(self, limits: _Limits, session, peername, held: bytes = b'') -> None:
+        for bucket in (limits.bucket, self._global.bucket):
+            if bucket is not None:
+                bucket.take()
+        limits.sessions += 1
+        self._global.sessions += 1
+        limits.stats.admitted += 1
+        self._admitted(session, peername, held)
+
+    def _schedule(self) -> None:
+        """Look at the queues again once an empty token bucket has a token"""
+        if self._handle is not None:
+            return
+        waits = [limits.bucket.wait() for limits in (self._global, *self._listeners.values())
+                 if limits.bucket is not None and limits.bucket.tokens < 1]
+        if waits:
+            self._handle = self._loop.call_later(max(min(waits), 0.001), self._run)
+
+    def _run(self) -> None:
+        self._handle = None
+        self._drain()
+
+    def _drain(self) -> None:
+        pending = True
+        while pending:
+            pending = False
+            for limits in list(self._listeners.values()):
+                if not limits.waiting:
+                    continue
+                if self._blocked(limits) is not None:
+                    continue
+                session_id = next(iter(limits.waiting))
+                session, peername, tap, held = limits.waiting.pop(session_id)
+                session.remove_tap(tap)
+                transport = session.transport
+                if transport is not None:
+                    transport.resume_reading()
+                self._admit(limits, session, peername, bytes(held))
+                pending = True
+        for listener_id, limits in self._listeners.items():
+            if limits.paused and len(limits.waiting) < max(1, limits.policy.queue):
+                limits.paused = False
+                self._logger.info(f'Listener #{listener_id} accepts again')
+                limits.resume()
+        if any(limits.waiting for limits in self._listeners.values()):
+            self._schedule()
+
+
+def _pause_reading(session) -> None:
+    transport = session.transport
+    if transport is not None and not transport.is_closing():
+        transport.pause_reading()
+
+
+def _abort(session) -> None:
+    transport = session.transport
+    if transport is not None:
+        transport.abort()
+
+
+class PausableServer:
+    """
+    TCP listener that can stop accepting without giving up its address.
+    It stands in for asyncio.Server in the manager.
+
+    The listening socket is bound here and the loop serves a duplicate
+    of it. Pausing closes the loop's server and with it the duplicate,
+    connections then wait in the kernel backlog of the socket kept here,
+    until resuming serves a new duplicate.
+    """
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            protocol_factory: Callable,
+            host: str,
+            port: int,
+            ssl: SSLContext | None = None,
+            backlog: int = BACKLOG,
+    ):
+        self._loop: AbstractEventLoop = loop
+        self._protocol_factory: Callable = protocol_factory
+        self._ssl: SSLContext | None = ssl
+        self._backlog: int = backlog
+        family = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][0]
+        self._sock: socket.socket = socket.create_server(
+            (host, port), family=family, backlog=backlog, reuse_port=True)
+        self._server: Optional[Server] = None
+        self._serving: bool = False
+        self._paused: bool = False
+        self._closed: Future = loop.create_future()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        await self.wait_closed()
+
+    @property
+    def sockets(self) -> Tuple:
+        return () if self._closed.done() else (self._sock,)
+
+    def is_serving(self) -> bool:
+        return self._serving and not self._paused
+
+    async def start_serving(self) -> None:
+        self._serving = True
+        await self._serve()
+
+    async def serve_forever(self) -> None:
+        await self.start_serving()
+        await self._closed
+
+    def pause(self) -> None:
+        self._paused = True
+        server, self._server = self._server, None
+        if server is not None:
+            server.close()
+
+    def resume(self) -> None:
+        self._paused = False
+        if self._serving and self._server is None:
+            self._loop.create_task(self._serve())
+
+    async def _serve(self) -> None:
+        if self._server is not None or self._paused or self._closed.done():
+            return
+        server = await self._loop.create_server(
+            self._protocol_factory, sock=self._sock.dup(), ssl=self._ssl,
+            backlog=self._backlog, start_serving=False)
+        if self._server is not None or self._paused or self._closed.done():
+            # Paused or closed while the server was created
+            server.close()
+            return
+        self._server = server
+        await server.start_serving()
+
+    def close(self) -> None:
+        if self._closed.done():
+            return
+        self.pause()
+        self._sock.close()
+        self._closed.set_result(None)
+
+    async def wait_closed(self) -> None:
+        await self._closed
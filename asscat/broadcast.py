@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import secrets
+from asyncio import (
+    IncompleteReadError,
+    LimitOverrunError,
+    Semaphore,
+    TimeoutError,
+    as_completed,
+    wait_for,
+)
+from time import perf_counter
+from typing import AsyncIterator, Iterable, NamedTuple, Optional
+
+# Broadcasts running at once by default
+CONCURRENCY = 64
+# Seconds a single session may take to answer
+TIMEOUT = 10.
+
+
+class BroadcastResult(NamedTuple):
+    session_id: int
+    output: bytes
+    exit_status: Optional[int]
+    elapsed: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.exit_status == 0
+
+
+def _markers(token: str):
+    # The quotes keep the markers out of the echoed command line, only
+    # the shell's own output contains them verbatim.
+    begin = f'ASSCAT_BEGIN_{token}'
+    end = f'ASSCAT_END_{token}_'
+    wrapped = f'echo ASSCAT_"BEGIN"_{token}; {{ %s\n}} 2>&1; echo ASSCAT_"END"_{token}_$?\n'
+    return begin.encode(), end.encode(), wrapped
+
+
+async def read_past(reader, marker: bytes) -> bytes:
+    """read_until() that does not stop at the reader limit"""
+    parts = []
+    while True:
+        try:
+            parts.append(await reader.read_until(marker))
+        except LimitOverrunError as exc:
+            parts.append(await reader.read(max(exc.consumed, 1)))
+        else:
+            return b''.join(parts)
+
+
+async def run_on_session(session, command: str, timeout: float = TIMEOUT) -> BroadcastResult:
+    """
+    Run ``command`` in the shell of ``session`` and collect its output
+    between two unique markers, together with the exit status. Output
+    left unread afterwards is released, whichever way the run ended.
+    """
+    sid = session.session_id
+    start = perf_counter()
+    reader = getattr(session, 'reader', None)
+    transport = getattr(session, 'transport', None)
+    if reader is None or transport is None:
+        return BroadcastResult(sid, b'', None, 0., 'session has no local reader')
+
+    begin, end, wrapped = _markers(secrets.token_hex(6))
+
+    async def _collect():
+        transport.write((wrapped % command).encode())
+        await read_past(reader, begin)
+        # Rest of the marker line, '\n' or '\r\n' on a pty
+        await reader.readline()
+        output = await read_past(reader, end)
+        status = await reader.readline()
+        return output[:-len(end)], int(status.strip() or -1)
+
+    try:
+        output, status = await wait_for(_collect(), timeout)
+    except TimeoutError:
+        return BroadcastResult(sid, b'', None, perf_counter() - start, 'timeout')
+    except (IncompleteReadError, LimitOverrunError, RuntimeError, ValueError) as exc:
+        return BroadcastResult(sid, b'', None, perf_counter() - start, repr(exc))
+    finally:
+        # Don't leave the transport paused for output nobody reads now
+        reader.release()
+    return BroadcastResult(sid, output, status, perf_counter() - start)
+
+
+async def broadcast(
+        sessions: Iterable,
+        command: str,
+        concurrency: int = CONCURRENCY,
+        timeout: float = TIMEOUT,
+) -> AsyncIterator[BroadcastResult]:
+    """
+    Run ``command`` on all ``sessions`` with at most ``concurrency``
+    in flight and yield the results in the order they finish.
+    """
+    semaphore = Semaphore(concurrency)
+
+    async def _bounded(session):
+        async with semaphore:
+            return await run_on_session(session, command, timeout)
+
+    for fut in as_completed([_bounded(session) for session in sessions]):
+        yield await fut
@@ -0,0 +1,297 @@
+import re
+import sys
+from collections import deque
+from functools import lru_cache
+from typing import Deque, List, Set, Union
+
+# Chunks smaller than this are merged into a trailing bytearray so
+# keystroke-sized traffic does not grow the deque one entry per byte.
+COALESCE_SIZE = 1024
+
+# Receive blocks handed out by BufferPool
+BLOCK_SIZE = 256 * 1024
+
+Chunk = Union[bytes, bytearray, memoryview]
+
+
+@lru_cache(maxsize=64)
+def _literal(sub: bytes) -> re.Pattern:
+    return re.compile(re.escape(sub))
+
+
+def _chunk_find(chunk: Chunk, sub: bytes, start: int) -> int:
+    # memoryview has no find(), but the re module searches buffers in place
+    if type(chunk) is memoryview:
+        m = _literal(sub).search(chunk, start)
+        return -1 if m is None else m.start()
+    return chunk.find(sub, start)
+
+
+class ChunkBuffer:
+    """
+    FIFO byte buffer made of a deque of chunks and a read cursor.
+
+    Consuming data from the front only advances the cursor or drops
+    whole chunks, so there is no memmove of the remaining data like
+    with ``del bytearray[:n]``. Returned data is copied exactly once.
+
+    Large memoryview chunks are kept as views, the owner of the
+    underlying memory must not reuse it before the buffer is drained.
+    """
+
+    __slots__ = ('_chunks', '_pos', '_size')
+
+    def __init__(self):
+        self._chunks: Deque[Chunk] = deque()
+        self._pos: int = 0
+        self._size: int = 0
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def __repr__(self):
+        return f'<ChunkBuffer {self._size} bytes in {len(self._chunks)} chunks>'
+
+    @property
+    def chunk_count(self) -> int:
+        return len(self._chunks)
+
+    @property
+    def memory_usage(self) -> int:
+        """Bytes held by the chunks, views only count what they show"""
+        return sum(len(chunk) if type(chunk) is memoryview else sys.getsizeof(chunk)
+                   for chunk in self._chunks)
+
+    def view_owners(self) -> Set[int]:
+        """Ids of the objects that memoryview chunks point into"""
+        return {id(chunk.obj) for chunk in self._chunks if type(chunk) is memoryview}
+
+    def extend(self, data) -> None:
+        """Append data to the end of the buffer"""
+        size = len(data)
+        if not size:
+            return
+        chunks = self._chunks
+        if size < COALESCE_SIZE:
+            last = chunks[-1] if chunks else None
+            if type(last) is bytearray and len(last) < COALESCE_SIZE:
+                last += data
+            else:
+                chunks.append(bytearray(data))
+        elif type(data) is bytes:
+            chunks.append(data)
+        elif type(data) is memoryview:
+            chunks.append(data if data.format == 'B' else data.cast('B'))
+        else:
+            chunks.append(bytes(data))
+        self._size += size
+
+    def clear(self) -> None:
+        self._chunks.clear()
+        self._pos = 0
+        self._size = 0
+
+    def compact(self) -> None:
+        """
+        Copy what is buffered into a single bytes chunk. Drops the
+        references to memory that chunks were views of, along with
+        consumed data and spare capacity of coalesced chunks.
+        """
+        if not self._size:
+            self.clear()
+            return
+        data = self.take()
+        self._chunks.append(data)
+        self._size = len(data)
+
+    def find(self, sub: bytes, start: int = 0) -> int:
+        """
+        Return the lowest offset where ``sub`` is found at or after
+        ``start``, or -1. Matches may span chunk boundaries.
+        """
+        sub_len = len(sub)
+        if start < 0:
+            start = 0
+        if self._size - start < sub_len:
+            return -1
+        chunks = self._chunks
+        lo = self._pos
+
+        # A match inside the first chunk always precedes any match that
+        # crosses into the next one, so try it before walking the deque.
+        i = _chunk_find(chunks[0], sub, lo + start)
+        if i != -1:
+            return i - lo
+        if len(chunks) == 1:
+            return -1
+
+        keep = sub_len - 1
+        offset = 0
+        tail = b''
+        for chunk in chunks:
+            clen = len(chunk)
+            end = offset + clen - lo
+            if end > start:
+                if tail:
+                    # Only matches straddling the boundary can be found here
+                    # since both tail and head are shorter than ``sub``.
+                    base = offset - len(tail)
+                    window = tail + chunk[lo:lo + keep]
+                    i = window.find(sub, max(0, start - base))
+                    if i != -1:
+                        return base + i
+                i = _chunk_find(chunk, sub, lo + max(0, start - offset))
+                if i != -1:
+                    return offset + i - lo
+            if keep:
+                if clen - lo >= keep:
+                    tail = bytes(chunk[clen - keep:])
+                else:
+                    tail = (tail + chunk[lo:])[-keep:]
+            offset = end
+            lo = 0
+        return -1
+
+    def startswith(self, prefix: bytes, start: int = 0) -> bool:
+        return self.peek(len(prefix), start) == prefix
+
+    def peek(self, n: int = -1, start: int = 0) -> bytes:
+        """Return up to ``n`` bytes from offset ``start`` without consuming"""
+        if n < 0 or start + n > self._size:
+            n = self._size - start
+        if n <= 0:
+            return b''
+        parts = []
+        skip = start
+        lo = self._pos
+        for chunk in self._chunks:
+            avail = len(chunk) - lo
+            if skip >= avail:
+                skip -= avail
+                lo = 0
+                continue
+            lo += skip
+            skip = 0
+            take = min(n, len(chunk) - lo)
+            parts.append(memoryview(chunk)[lo:lo + take])
+            n -= take
+            lo = 0
+            if not n:
+                break
+        if len(parts) == 1:
+            return bytes(parts[0])
+        return b''.join(parts)
+
+    def take(self, n: int = -1) -> bytes:
+        """Remove and return up to ``n`` bytes from the front"""
+        if n < 0 or n > self._size:
+            n = self._size
+        if not n:
+            return b''
+        chunks = self._chunks
+        pos = self._pos
+        first = chunks[0]
+        flen = len(first)
+
+        # Fast path, request is served by the first chunk alone
+        end = pos + n
+        if end <= flen:
+            if type(first) is bytes:
+                data = first if not pos and flen == n else first[pos:end]
+            else:
+                data = bytes(memoryview(first)[pos:end])
+            self._size -= n
+            if end == flen:
+                chunks.popleft()
+                end = 0
+            self._pos = end
+            return data
+
+        parts = []
+        remaining = n
+        while remaining:
+            chunk = chunks[0]
+            avail = len(chunk) - pos
+            if avail <= remaining:
+                parts.append(memoryview(chunk)[pos:] if pos else chunk)
+                chunks.popleft()
+                remaining -= avail
+                pos = 0
+            else:
+                parts.append(memoryview(chunk)[pos:pos + remaining])
+                pos += remaining
+                remaining = 0
+        self._pos = pos
+        self._size -= n
+        if not chunks:
+            self._pos = 0
+        return b''.join(parts)
+
+    def discard(self, n: int) -> None:
+        """Drop ``n`` bytes from the front without copying them"""
+        if n >= self._size:
+            self.clear()
+            return
+        self._advance(n)
+
+    def _advance(self, n: int) -> None:
+        chunks = self._chunks
+        pos = self._pos + n
+        self._size -= n
+        while chunks and pos >= len(chunks[0]):
+            pos -= len(chunks.popleft())
+        self._pos = pos
+
+
+class BufferPool:
+    """
+    Free list of fixed size receive blocks shared between sessions,
+    so sessions churning through connections do not reallocate them.
+    """
+
+    __slots__ = ('_block_size', '_max_free', '_free', '_allocated')
+
+    def __init__(self, block_size: int = BLOCK_SIZE, max_free: int = 64):
+        self._block_size: int = block_size
+        self._max_free: int = max_free
+        self._free: List[bytearray] = []
+        self._allocated: int = 0
+
+    def __repr__(self):
+        return (f'<BufferPool block_size={self._block_size} '
+                f'free={len(self._free)} allocated={self._allocated}>')
+
+    @property
+    def block_size(self) -> int:
+        return self._block_size
+
+    @property
+    def free_count(self) -> int:
+        return len(self._free)
+
+    @property
+    def allocated(self) -> int:
+        return self._allocated
+
+    def acquire(self) -> bytearray:
+        if self._free:
+            return self._free.pop()
+        self._allocated += 1
+        return bytearray(self._block_size)
+
+    def release(self, block: bytearray) -> None:
+        if len(block) != self._block_size or len(self._free) >= self._max_free:
+            self._allocated -= 1
+            return
+        self._free.append(block)
+
+    def trim(self, keep: int = 0) -> int:
+        """Let go of free blocks beyond ``keep``, returns how many"""
+        dropped = max(0, len(self._free) - keep)
+        if dropped:
+            del self._free[keep:]
+            self._allocated -= dropped
+        return dropped
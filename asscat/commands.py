@@ -1,35 +1,342 @@
+from argparse import ArgumentParser
 from asyncio import AbstractEventLoop
-from typing import Optional, List
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from asscat import transfer
+from asscat.broadcast import CONCURRENCY, TIMEOUT
+from asscat.utils import UPGRADE_CONCURRENCY
+
+
+class _UsageError(ValueError):
+    """Invalid arguments, reported along with the command's usage"""
+
+
+def _count(value: str) -> int:
+    count = int(value)
+    if count <= 0:
+        raise ValueError(value)
+    return count
+
+
+def _seconds(value: str) -> float:
+    seconds = float(value)
+    if not seconds > 0:
+        raise ValueError(value)
+    return seconds
+
+
+def _ids(value: str) -> List[int]:
+    return [int(sid) for sid in value.split(',') if sid]
+
+
+def _words(value: str) -> Tuple[str, ...]:
+    return tuple(name for name in value.split(',') if name)
+
+
+def _options(
+        args: List[str],
+        names: Dict[str, Callable[[str], Any]],
+) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Split leading ``-x VALUE`` options off args, ``--`` ends them.
+    Values are converted by the callable of their option, values it
+    rejects raise _UsageError.
+    """
+    options = {}
+    while len(args) > 1 and args[0] in names:
+        name, value, args = args[0], args[1], args[2:]
+        try:
+            options[name] = names[name](value)
+        except ValueError:
+            raise _UsageError(f'Invalid value for {name}: {value!r}') from None
+    if args and args[0] == '--':
+        args = args[1:]
+    return options, args
+
+
+class _Command(NamedTuple):
+    func: Callable[..., Awaitable]
+    # Turns the argument list into what func is called with
+    parser: Optional[Union[ArgumentParser, Callable[[List[str]], Any]]] = None
 
 
 class Cmds:
-    __slots__ = ('_loop', '_commands')
+    """
+    Dispatches input lines to built-in commands, everything else is
+    returned untouched to go to the session.
 
-    def __init__(self, loop):
+    Lines are classified as bytes: with an ``escape`` prefix a single
+    startswith() check, otherwise a lookup of the first byte in a table
+    of the bytes command names start with. Only lines that pass are
+    split, the first word is looked up as bytes and only the arguments
+    of a matching command are decoded.
+    """
+    __slots__ = ('_loop', '_commands', '_manager', '_output', '_escape', '_names', '_first')
+
+    def __init__(
+            self,
+            loop,
+            manager=None,
+            output: Callable[[str], None] = print,
+            escape: bytes | None = None,
+    ):
         self._loop: AbstractEventLoop = loop
-        self._commands = {
-            'sessions': self.sessions,
-            'back': self.back,
-            'exit': self.exit,
-        }
+        self._manager = manager
+        self._output = output
+        self._escape: Optional[bytes] = escape or None
+        self._names: Dict[bytes, _Command] = {}
+        self._first: bytearray = bytearray(256)
+        # split() skips leading whitespace, so does the table
+        for byte in b' \t':
+            self._first[byte] = 1
+        self._commands: Dict[str, _Command] = {}
+        for name, func in (
+                ('sessions', self.sessions),
+                ('broadcast', self.broadcast),
+                ('upload', self.upload),
+                ('download', self.download),
+                ('upgrade', self.upgrade),
+                ('memory', self.memory),
+                ('search', self.search),
+                ('back', self.back),
+                ('exit', self.exit),
+        ):
+            self._add(name, _Command(func))
+
+    @property
+    def commands(self) -> List[str]:
+        return list(self._commands)
+
+    def _add(self, name: str, command: _Command) -> None:
+        if not name or name.split() != [name]:
+            raise ValueError(f'Invalid command name {name!r}')
+        self._commands[name] = command
+        self._names[name.encode()] = command
+        self._first[name.encode()[0]] = 1
+
+    def match(self, raw_cmd: bytes) -> Optional[Tuple[_Command, List[bytes]]]:
+        """The command ``raw_cmd`` invokes and its raw words, or None"""
+        escape = self._escape
+        if escape is not None:
+            if not raw_cmd.startswith(escape):
+                return None
+            raw_cmd = raw_cmd[len(escape):]
+        elif not raw_cmd or not self._first[raw_cmd[0]]:
+            return None
+        words = raw_cmd.split()
+        command = self._names.get(words[0]) if words else None
+        if command is None:
+            return None
+        return command, words
 
     async def parse(self, raw_cmd: bytes):
-        cmd = raw_cmd.decode().split()
-        if cmd[0] in self._commands.keys():
-            return await self._commands[cmd[0]](cmd[1:])
-        return raw_cmd
+        # Same as match(), inlined as it runs for every keystroke
+        escape = self._escape
+        line = raw_cmd
+        if escape is not None:
+            if not line.startswith(escape):
+                return raw_cmd
+            line = line[len(escape):]
+        elif not line or not self._first[line[0]]:
+            return raw_cmd
+        words = line.split(None, 1)
+        command = self._names.get(words[0]) if words else None
+        if command is None:
+            return raw_cmd
+        args = words[1].decode(errors='replace').split() if len(words) > 1 else []
+        parser = command.parser
+        if isinstance(parser, ArgumentParser):
+            try:
+                args = parser.parse_args(args)
+            except SystemExit:
+                # argparse printed its usage already
+                return None
+        elif parser is not None:
+            args = parser(args)
+        try:
+            return await command.func(args)
+        except _UsageError as e:
+            doc = command.func.__doc__
+            self._output(f'{e}\n{doc.strip().splitlines()[0]}' if doc else str(e))
+            return None
 
-    async def register(self, func, name):
-        self._commands.update({name: func})
+    async def register(
+            self,
+            func,
+            name: str,
+            parser: ArgumentParser | Callable[[List[str]], Any] | None = None,
+    ):
+        """
+        Add ``func`` as command ``name``. With a ``parser``, built once
+        here, func gets what it makes of the arguments, e.g. a Namespace.
+        """
+        self._add(name, _Command(func, parser))
 
     async def sessions(self, args: List[str]):
         if not args:
             pass
 
-    async def help(self):
+    async def broadcast(self, args: List[str]):
+        """
+        broadcast [-s ID,ID,...] [-t TIMEOUT] [-c CONCURRENCY] COMMAND...
+
+        Run COMMAND on all sessions, or the listed ones, and print each
+        result as soon as its session answered.
+        """
+        if self._manager is None:
+            return
+        options, args = _options(args, {'-s': _ids, '-t': _seconds, '-c': _count})
+        session_ids = options.get('-s')
+        timeout = options.get('-t', TIMEOUT)
+        concurrency = options.get('-c', CONCURRENCY)
+        if not args:
+            self._output(self.broadcast.__doc__.strip().splitlines()[0])
+            return
+
+        results = []
+        async for result in self._manager.broadcast(
+                ' '.join(args), session_ids,
+                concurrency=concurrency, timeout=timeout):
+            if result.error is not None:
+                self._output(f'[{result.session_id}] error: {result.error}')
+            else:
+                self._output(f'[{result.session_id}] exit {result.exit_status} '
+                             f'({result.elapsed:.2f}s)\n'
+                             f'{result.output.decode(errors="replace")}')
+            results.append(result)
+        return results
+
+    async def upload(self, args: List[str]):
+        """
+        upload [-s ID] [-c CHUNK_SIZE] [-w WINDOW] LOCAL REMOTE
+
+        Copy a local file to the active session, or session ID.
+        """
+        return await self._transfer(transfer.upload, self.upload, args)
+
+    async def download(self, args: List[str]):
+        """
+        download [-s ID] [-c CHUNK_SIZE] [-w WINDOW] REMOTE LOCAL
+
+        Copy a file of the active session, or session ID, to this host.
+        """
+        return await self._transfer(transfer.download, self.download, args)
+
+    async def _transfer(self, func, command, args: List[str]):
+        if self._manager is None:
+            return
+        options, args = _options(args, {'-s': int, '-c': _count, '-w': _count})
+        if len(args) != 2:
+            self._output(command.__doc__.strip().splitlines()[0])
+            return
+        sid = options.get('-s', self._manager.active_session_id)
+        session = self._manager.get_session(sid)
+        if session is None:
+            self._output(f'No session {sid}')
+            return
+        result = await func(
+            session, args[0], args[1],
+            chunk_size=options.get('-c', transfer.CHUNK_SIZE),
+            window=options.get('-w', transfer.WINDOW))
+        if result.error is not None:
+            self._output(f'[{result.session_id}] {command.__name__} failed: {result.error}')
+        else:
+            self._output(f'[{result.session_id}] {result.source} -> {result.destination}: '
+                         f'{result.size} bytes in {result.elapsed:.2f}s '
+                         f'({result.rate:.2f} MB/s, {result.retries} retries)')
+        return result
+
+    async def upgrade(self, args: List[str]):
+        """
+        upgrade [-s ID,ID,...] [-c CONCURRENCY] [-b BINARY,BINARY,...]
+
+        Upgrade all sessions, or the listed ones, to a pty.
+        """
+        if self._manager is None:
+            return
+        options, args = _options(args, {'-s': _ids, '-c': _count, '-b': _words})
+        if args:
+            self._output(self.upgrade.__doc__.strip().splitlines()[0])
+            return
+        kwargs = {}
+        if '-b' in options:
+            kwargs['binaries'] = options['-b']
+        results = []
+        async for result in self._manager.upgrade(
+                options.get('-s'),
+                concurrency=options.get('-c', UPGRADE_CONCURRENCY),
+                **kwargs):
+            if result.error is not None:
+                self._output(f'[{result.session_id}] upgrade failed: {result.error}')
+            else:
+                self._output(f'[{result.session_id}] pty via {result.binary} '
+                             f'in {result.latency * 1000:.0f}ms')
+            results.append(result)
+        return results
+
+    async def memory(self, args: List[str]):
+        """
+        memory [-n COUNT]
+
+        List the sessions holding the most memory, largest first.
+        """
+        if self._manager is None:
+            return
+        options, args = _options(args, {'-n': _count})
+        if args:
+            self._output(self.memory.__doc__.strip().splitlines()[0])
+            return
+        footprints = self._manager.top_memory(options.get('-n', 10))
+        for f in footprints:
+            self._output(f'[{f.session_id}] {f.total / 1024:.1f} KiB: reader {f.reader}, '
+                         f'writer {f.writer}, recv {f.recv_blocks}, scrollback {f.scrollback} '
+                         f'(+{f.mapped} mapped), recorder {f.recorder}, idle {f.idle:.0f}s')
+        return footprints
+
+    async def search(self, args: List[str]):
+        """
+        search [-s ID,ID,...] [-n LIMIT] [-r] [-i] PATTERN...
+
+        Find PATTERN in the output of all sessions, or the listed ones.
+        -r makes it a regular expression, -i ignores case.
+        """
+        if self._manager is None:
+            return
+        flags, options = set(), {}
+        while args and args[0] in ('-r', '-i', '-s', '-n'):
+            if args[0] in ('-r', '-i'):
+                flags.add(args.pop(0))
+                continue
+            parsed, args = _options(args, {'-s': _ids, '-n': _count})
+            if not parsed:
+                break
+            options.update(parsed)
+        if args and args[0] == '--':
+            args = args[1:]
+        if not args:
+            self._output(self.search.__doc__.strip().splitlines()[0])
+            return
+        try:
+            hits = self._manager.search(
+                ' '.join(args), regex='-r' in flags, ignore_case='-i' in flags,
+                session_ids=options.get('-s'), limit=options.get('-n', 100))
+        except ValueError as e:
+            self._output(str(e))
+            return
+        for hit in hits:
+            self._output(f'[{hit.session_id}] line {hit.line + 1} @{hit.offset}: '
+                         f'{hit.text.decode(errors="replace")}')
+        if not hits:
+            self._output('No matches')
+        return hits
+
+    async def back(self, args: List[str]):
+        pass
+
+    async def help(self, args: List[str]):
         pass
 
-    async def exit(self):
+    async def exit(self, args: List[str]):
         pass
 
 
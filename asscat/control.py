@@ -0,0 +1,451 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+from asyncio import (
+    Event,
+    Future,
+    IncompleteReadError,
+    LimitOverrunError,
+    Queue,
+    Server,
+    StreamReader,
+    StreamWriter,
+    Task,
+    current_task,
+    gather,
+    get_running_loop,
+    open_unix_connection,
+    start_unix_server,
+)
+from base64 import b64decode, b64encode
+from collections import deque
+from itertools import count
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional, Tuple
+
+from asscat.admission import AdmissionPolicy
+from asscat.logger import setup_logger
+
+# Where the manager listens for control clients
+CONTROL_PATH = os.path.join(os.path.expanduser('~'), '.asscat', 'control.sock')
+# Bytes of session output queued for one client, more is dropped
+CLIENT_QUEUE = 1024 * 1024
+# Longest request line a client may send
+MAX_REQUEST = 1024 * 1024
+
+
+def _line(message: Dict[str, Any]) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+
+
+class ControlConnection:
+    """
+    Server side of one control client. Output of the sessions it is
+    attached to is queued by taps that never wait, the queue is bounded
+    by ``queue_limit`` bytes and a writer task drains it to the client.
+    Output that doesn't fit is dropped and reported to the client once
+    it caught up, so a slow client only ever loses its own output.
+    """
+    __slots__ = ('_server', '_writer', '_queue', '_queued', '_queue_limit',
+                 '_dropped', '_wakeup', '_taps', '_task', '_closed')
+
+    def __init__(self, server: ControlServer, writer: StreamWriter, queue_limit: int):
+        self._server: ControlServer = server
+        self._writer: StreamWriter = writer
+        # Session id and output, None once the session closed
+        self._queue: Deque[Tuple[int, Optional[bytes]]] = deque()
+        self._queued: int = 0
+        self._queue_limit: int = queue_limit
+        self._dropped: Dict[int, int] = {}
+        self._wakeup: Event = Event()
+        self._taps: Dict[int, Callable] = {}
+        self._task: Optional[Task] = None
+        self._closed: bool = False
+
+    @property
+    def attached(self) -> Tuple[int, ...]:
+        return tuple(self._taps)
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def dropped(self) -> int:
+        return sum(self._dropped.values())
+
+    def attach(self, session, replay: int = 0) -> None:
+        sid = session.session_id
+        if sid in self._taps:
+            return
+        if replay > 0 and session.scrollback is not None:
+            scrollback = session.scrollback
+            self.output(sid, scrollback.read(max(0, len(scrollback) - replay)))
+        tap = self._taps[sid] = lambda data: self.output(sid, data)
+        session.add_tap(tap)
+
+    def detach(self, session_id: int) -> bool:
+        tap = self._taps.pop(session_id, None)
+        if tap is None:
+            return False
+        session = self._server.manager.get_session(session_id)
+        if session is not None:
+            session.remove_tap(tap)
+        return True
+
+    def output(self, session_id: int, data) -> None:
+        size = len(data)
+        if not size or self._closed:
+            return
+        if self._queued + size > self._queue_limit:
+            self._dropped[session_id] = self._dropped.get(session_id, 0) + size
+            return
+        self._queue.append((session_id, bytes(data)))
+        self._queued += size
+        self._wakeup.set()
+
+    def session_closed(self, session_id: int) -> None:
+        if self._taps.pop(session_id, None) is not None:
+            self._queue.append((session_id, None))
+            self._wakeup.set()
+
+    async def send(self, message: Dict[str, Any]) -> None:
+        self._writer.write(_line(message))
+        await self._writer.drain()
+
+    def start(self) -> None:
+        self._task = get_running_loop().create_task(self._run_writer())
+
+    async def _run_writer(self) -> None:
+        try:
+            await self._write_queued()
+        except ConnectionError:
+            self.close()
+
+    async def _write_queued(self) -> None:
+        queue, writer = self._queue, self._writer
+        while not self._closed:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while queue:
+                lines = []
+                while queue and len(lines) < 64:
+                    sid, data = queue.popleft()
+                    if data is None:
+                        lines.append(_line({'event': 'closed', 'session': sid}))
+                        continue
+                    self._queued -= len(data)
+                    lines.append(_line({'event': 'output', 'session': sid,
+                                        'data': b64encode(data).decode()}))
+                writer.write(b''.join(lines))
+                await writer.drain()
+            if self._dropped:
+                dropped, self._dropped = self._dropped, {}
+                writer.write(b''.join(_line({'event': 'dropped', 'session': sid, 'bytes': size})
+                                      for sid, size in dropped.items()))
+                await writer.drain()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        for sid in list(self._taps):
+            self.detach(sid)
+        self._queue.clear()
+        self._queued = 0
+        self._wakeup.set()
+        self._writer.close()
+        if self._task is not None and self._task is not current_task():
+            self._task.cancel()
+
+
+class ControlServer:
+    """
+    JSON lines control API of a manager on a Unix socket. Clients send
+    requests ``{"id": 1, "op": "sessions"}`` and get ``{"id": 1, "result":
+    ...}`` or ``{"id": 1, "error": "..."}`` back. Session output arrives
+    as ``{"event": "output", "session": 3, "data": BASE64}`` events, in
+    between the responses. Operations:
+
+    * listeners, sessions
+    * attach {session, replay}: stream output, replay scrollback bytes first
+    * detach {session}
+    * input {session, data | text}: data is base64
+    * create_listener {host, port, ssl, protocol, buffered, admission, start}
+    * start_listener {listener}, stop_listener {listener}
+    * search {pattern, regex, ignore_case, sessions, limit}: lines are base64
+    """
+
+    def __init__(self, manager, path: str = CONTROL_PATH, queue_limit: int = CLIENT_QUEUE):
+        self._manager = manager
+        self._path: str = path
+        self._queue_limit: int = queue_limit
+        self._server: Optional[Server] = None
+        # Task serving requests of each connection
+        self._connections: Dict[ControlConnection, Task] = {}
+        self._ops: Dict[str, Callable] = {
+            'listeners': self._listeners,
+            'sessions': self._sessions,
+            'attach': self._attach,
+            'detach': self._detach,
+            'input': self._input,
+            'create_listener': self._create_listener,
+            'start_listener': self._start_listener,
+            'stop_listener': self._stop_listener,
+            'search': self._search,
+        }
+        self._logger = setup_logger(__name__)
+
+    @property
+    def manager(self):
+        return self._manager
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def connections(self) -> Tuple[ControlConnection, ...]:
+        return tuple(self._connections)
+
+    async def start(self) -> None:
+        """
+        Serve on the socket path. Its directory must belong to this user
+        and be closed to everyone else, the socket is only ever
+        accessible to this user.
+        """
+        path = self._path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # makedirs() leaves an existing directory as it is
+        info = os.stat(directory)
+        if info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise ValueError(f'{directory} must be owned by this user and closed '
+                             f'to group and others to hold the control socket')
+        if os.path.exists(path):
+            # The loop removes an existing socket file, don't take it
+            # from a manager that's still serving on it
+            with socket.socket(socket.AF_UNIX) as probe:
+                try:
+                    probe.connect(path)
+                except OSError:
+                    os.unlink(path)
+                else:
+                    raise ValueError(f'{path} is served by another manager')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The socket file takes its mode from the umask at bind time, no
+        # one else may connect in between
+        umask = os.umask(0o077)
+        try:
+            sock.bind(path)
+        except OSError:
+            sock.close()
+            raise
+        finally:
+            os.umask(umask)
+        self._server = await start_unix_server(self._handle, sock=sock, limit=MAX_REQUEST)
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+        for connection in list(self._connections):
+            connection.close()
+
+    async def wait_closed(self) -> None:
+        """Wait until the connections closed by close() are done"""
+        await gather(*self._connections.values(), return_exceptions=True)
+
+    def session_closed(self, session_id: int) -> None:
+        for connection in self._connections:
+            connection.session_closed(session_id)
+
+    async def _handle(self, reader: StreamReader, writer: StreamWriter) -> None:
+        connection = ControlConnection(self, writer, self._queue_limit)
+        connection.start()
+        self._connections[connection] = current_task()
+        self._logger.info(f'Control client connected, {len(self._connections)} now')
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b'\n')
+                except LimitOverrunError:
+                    await connection.send({'error': 'request too long'})
+                    break
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get('id')
+                    op = self._ops.get(request.get('op'))
+                    if op is None:
+                        raise ValueError(f'unknown op {request.get("op")!r}')
+                    result = await op(connection, request)
+                except KeyError as e:
+                    await connection.send({'id': request_id, 'error': f'missing {e}'})
+                except (ValueError, TypeError, AttributeError, OSError) as e:
+                    await connection.send({'id': request_id, 'error': str(e) or type(e).__name__})
+                else:
+                    await connection.send({'id': request_id, 'result': result})
+        except (IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            connection.close()
+            del self._connections[connection]
+
+    def _session(self, request: Dict[str, Any]):
+        session = self._manager.get_session(int(request['session']))
+        if session is None:
+            raise ValueError(f'no session {request["session"]}')
+        return session
+
+    async def _listeners(self, connection, request):
+        return [m._asdict() for m in self._manager.metrics().listeners]
+
+    async def _sessions(self, connection, request):
+        registry = self._manager.sessions
+        sessions = []
+        for m in self._manager.metrics().sessions:
+            info = m._asdict()
+            info['tags'] = sorted(registry.tags_of(m.session_id))
+            info['attached'] = sum(m.session_id in c.attached for c in self._connections)
+            sessions.append(info)
+        return sessions
+
+    async def _attach(self, connection, request):
+        session = self._session(request)
+        connection.attach(session, int(request.get('replay', 0)))
+        return {'session': session.session_id}
+
+    async def _detach(self, connection, request):
+        return {'detached': connection.detach(int(request['session']))}
+
+    async def _input(self, connection, request):
+        session = self._session(request)
+        if 'data' in request:
+            data = b64decode(request['data'], validate=True)
+        else:
+            data = request['text'].encode()
+        session.stdin_data_received(data)
+        return {'bytes': len(data)}
+
+    async def _create_listener(self, connection, request):
+        manager = self._manager
+        admission = request.get('admission')
+        if admission is not None:
+            admission = AdmissionPolicy(**admission)
+        l_id, listener = await manager.create_listener(
+            request.get('host', '127.0.0.1'), int(request.get('port', 8888)),
+            ssl=request.get('ssl'), buffered=request.get('buffered'),
+            protocol=request.get('protocol', 'TCP'), admission=admission)
+        if request.get('start', True):
+            await manager.start_listener(l_id)
+        return {'listener': l_id, 'address': listener.sockets[0].getsockname()[:2]}
+
+    async def _start_listener(self, connection, request):
+        await self._manager.start_listener(int(request['listener']))
+        return {'listener': int(request['listener'])}
+
+    async def _stop_listener(self, connection, request):
+        l_id = int(request['listener'])
+        manager = self._manager
+        if l_id in manager.listeners:
+            await manager.stop_listener(l_id)
+        elif l_id in manager.sharded_listeners:
+            await manager.stop_sharded_listener(l_id)
+        else:
+            raise ValueError(f'no listener {l_id}')
+        return {'listener': l_id}
+
+    async def _search(self, connection, request):
+        hits = self._manager.search(
+            request['pattern'], regex=bool(request.get('regex')),
+            ignore_case=bool(request.get('ignore_case')),
+            session_ids=request.get('sessions'), limit=int(request.get('limit', 100)))
+        return [{'session': hit.session_id, 'offset': hit.offset, 'line': hit.line,
+                 'text': b64encode(hit.text).decode()} for hit in hits]
+
+
+class ControlError(Exception):
+    """Error a control request was answered with"""
+
+
+class ControlClient:
+    """
+    Client of a manager's control socket for scripts and other UIs.
+    Requests can be made concurrently, events() yields session output
+    and notices as they arrive.
+    """
+
+    def __init__(self, reader: StreamReader, writer: StreamWriter):
+        self._reader: StreamReader = reader
+        self._writer: StreamWriter = writer
+        self._ids = count(1)
+        self._pending: Dict[int, Future] = {}
+        self._events: Queue = Queue()
+        self._task: Task = get_running_loop().create_task(self._read())
+
+    @classmethod
+    async def connect(cls, path: str = CONTROL_PATH) -> ControlClient:
+        reader, writer = await open_unix_connection(path, limit=MAX_REQUEST + CLIENT_QUEUE * 2)
+        return cls(reader, writer)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def request(self, op: str, **params) -> Any:
+        request_id = next(self._ids)
+        future = self._pending[request_id] = get_running_loop().create_future()
+        self._writer.write(_line({'id': request_id, 'op': op, **params}))
+        await self._writer.drain()
+        return await future
+
+    async def send_input(self, session_id: int, data: bytes) -> int:
+        result = await self.request('input', session=session_id, data=b64encode(data).decode())
+        return result['bytes']
+
+    async def events(self) -> AsyncIterator[Dict[str, Any]]:
+        """Events with the output of ``output`` events decoded to bytes, until closed"""
+        while (event := await self._events.get()) is not None:
+            if event.get('event') == 'output':
+                event['data'] = b64decode(event['data'])
+            yield event
+
+    async def _read(self) -> None:
+        error: Exception = ConnectionError('control connection closed')
+        try:
+            while line := await self._reader.readline():
+                message = json.loads(line)
+                future = self._pending.pop(message.get('id'), None)
+                if future is None:
+                    if 'event' in message:
+                        self._events.put_nowait(message)
+                    elif 'error' in message:
+                        error = ControlError(message['error'])
+                elif 'error' in message:
+                    future.set_exception(ControlError(message['error']))
+                else:
+                    future.set_result(message.get('result'))
+        except (ConnectionError, ValueError) as e:
+            error = e
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+            self._events.put_nowait(None)
+
+    async def close(self) -> None:
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+        await self._task
@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import os
+import socket
+from asyncio import (
+    AbstractEventLoop,
+    DatagramProtocol,
+    DatagramTransport,
+    Future,
+    TimerHandle,
+    Transport,
+)
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from asscat.protocols import AssCatProtocol
+
+# Seconds a peer may stay silent before its session is closed
+IDLE_TIMEOUT = 300.
+# Datagrams drained from the socket per readiness event at most
+READ_BATCH = 64
+# Largest datagram accepted when draining the socket directly
+MAX_DATAGRAM = 65535
+# Receive buffer requested for the socket, bursts from many peers
+# overflow the default one quickly
+RCVBUF_SIZE = 4 * 1024 * 1024
+
+
+class DatagramPeerTransport(Transport):
+    """
+    Transport of a single peer on a shared datagram endpoint. Writes
+    become sendto() calls to the peer, closing only closes the session.
+    """
+    __slots__ = ('_listener', '_addr', '_closing', '_reading')
+
+    def __init__(self, listener: DatagramListener, addr: Tuple):
+        super().__init__()
+        self._listener: DatagramListener = listener
+        self._addr: Tuple = addr
+        self._closing: bool = False
+        self._reading: bool = True
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self._addr
+        return self._listener.get_extra_info(name, default)
+
+    def write(self, data) -> None:
+        if not self._closing and data:
+            self._listener.sendto(data, self._addr)
+
+    def writelines(self, list_of_data) -> None:
+        self.write(b''.join(list_of_data))
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def get_write_buffer_size(self) -> int:
+        return self._listener.get_write_buffer_size()
+
+    def get_write_buffer_limits(self):
+        return 0, 0
+
+    def set_write_buffer_limits(self, high=None, low=None) -> None:
+        pass
+
+    def is_reading(self) -> bool:
+        return self._reading
+
+    def pause_reading(self) -> None:
+        # Datagrams can't be held back per peer, the listener drops
+        # them until reading is resumed, as a full socket buffer would
+        self._reading = False
+
+    def resume_reading(self) -> None:
+        self._reading = True
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self) -> None:
+        if not self._closing:
+            self._closing = True
+            self._listener.close_peer(self._addr)
+
+    def abort(self) -> None:
+        self.close()
+
+
+class DatagramListener(DatagramProtocol):
+    """
+    UDP listener that demultiplexes datagrams to one session per remote
+    address. It stands in for asyncio.Server in the manager, sessions
+    are only created once start_serving() was called.
+
+    Peers are kept in an OrderedDict in order of their last datagram,
+    so the least recently heard from peer is always first and a single
+    timer handle suffices to expire idle sessions.
+
+    On loops that expose the socket, the rest of a burst is drained
+    with recvfrom() calls right after the loop delivered the first
+    datagram, up to ``read_batch`` per readiness event.
+
+    Datagrams of a peer whose session paused reading are dropped and
+    counted, so one chatty peer can't grow its reader without bound.
+    """
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            protocol_factory: Callable[[], AssCatProtocol],
+            idle_timeout: float = IDLE_TIMEOUT,
+            read_batch: int = READ_BATCH,
+    ):
+        self._loop: AbstractEventLoop = loop
+        self._protocol_factory = protocol_factory
+        self._idle_timeout: float = idle_timeout
+        self._read_batch: int = read_batch
+        self._transport: Optional[DatagramTransport] = None
+        self._sock: Optional[socket.socket] = None
+        self._peers: OrderedDict[Tuple, Tuple[AssCatProtocol, float]] = OrderedDict()
+        self._expire_handle: Optional[TimerHandle] = None
+        self._serving: bool = False
+        self._paused: bool = False
+        self._dropped: int = 0
+        self._closed: Future = loop.create_future()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        await self.wait_closed()
+
+    @property
+    def sockets(self) -> Tuple:
+        if self._transport is None:
+            return ()
+        return self._transport.get_extra_info('socket'),
+
+    @property
+    def peers_count(self) -> int:
+        return len(self._peers)
+
+    @property
+    def dropped(self) -> int:
+        """Datagrams dropped because their session paused reading"""
+        return self._dropped
+
+    def get_extra_info(self, name, default=None):
+        if self._transport is None:
+            return default
+        return self._transport.get_extra_info(name, default)
+
+    def get_write_buffer_size(self) -> int:
+        if self._transport is None:
+            return 0
+        return self._transport.get_write_buffer_size()
+
+    def is_serving(self) -> bool:
+        return self._serving
+
+    async def start_serving(self) -> None:
+        self._serving = True
+
+    async def serve_forever(self) -> None:
+        self._serving = True
+        await self._closed
+
+    def close(self) -> None:
+        self._serving = False
+        for addr in list(self._peers):
+            self.close_peer(addr)
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+        if self._transport is not None:
+            self._transport.close()
+
+    async def wait_closed(self) -> None:
+        await self._closed
+
+    def connection_made(self, transport: DatagramTransport) -> None:
+        self._transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        except OSError:
+            pass
+        if self._read_batch > 1:
+            try:
+                self._sock = socket.socket(sock.family, sock.type, fileno=os.dup(sock.fileno()))
+                self._sock.setblocking(False)
+            except (OSError, ValueError):
+                self._sock = None
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        for addr in list(self._peers):
+            self.close_peer(addr, exc)
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._transport = None
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+    def pause_writing(self) -> None:
+        self._paused = True
+        for session, _ in self._peers.values():
+            session.pause_writing()
+
+    def resume_writing(self) -> None:
+        self._paused = False
+        for session, _ in self._peers.values():
+            session.resume_writing()
+
+    def sendto(self, data, addr: Tuple) -> None:
+        if self._transport is not None:
+            self._transport.sendto(data, addr)
+
+    def datagram_received(self, data: bytes, addr: Tuple) -> None:
+        if not self._serving:
+            return
+        self._deliver(data, addr)
+        sock = self._sock
+        if sock is None:
+            return
+        recvfrom = sock.recvfrom
+        for _ in range(self._read_batch - 1):
+            try:
+                data, addr = recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self.error_received(exc)
+                return
+            self._deliver(data, addr)
+
+    def _deliver(self, data: bytes, addr: Tuple) -> None:
+        peers = self._peers
+        entry = peers.get(addr)
+        if entry is None:
+            session = self._open_peer(addr)
+            if addr not in peers:
+                return
+        else:
+            session = entry[0]
+            peers.move_to_end(addr)
+            peers[addr] = session, self._loop.time()
+            if not session.transport._reading:
+                session.stats.dropped += 1
+                self._dropped += 1
+                return
+        if data:
+            session.data_received(data)
+
+    def _open_peer(self, addr: Tuple) -> AssCatProtocol:
+        session = self._protocol_factory()
+        self._peers[addr] = session, self._loop.time()
+        session.connection_made(DatagramPeerTransport(self, addr))
+        if self._paused:
+            session.pause_writing()
+        if self._expire_handle is None and self._idle_timeout:
+            self._expire_handle = self._loop.call_later(self._idle_timeout, self._expire)
+        return session
+
+    def close_peer(self, addr: Tuple, exc: Exception | None = None) -> None:
+        entry = self._peers.pop(addr, None)
+        if entry is None:
+            return
+        session = entry[0]
+        transport = session.transport
+        if isinstance(transport, DatagramPeerTransport):
+            transport._closing = True
+        session.connection_lost(exc)
+
+    def _expire(self) -> None:
+        self._expire_handle = None
+        peers = self._peers
+        deadline = self._loop.time() - self._idle_timeout
+        while peers:
+            addr, (_, last_seen) = next(iter(peers.items()))
+            if last_seen > deadline:
+                self._expire_handle = self._loop.call_at(
+                    last_seen + self._idle_timeout, self._expire)
+                return
+            self.close_peer(addr)
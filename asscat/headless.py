@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import signal
+from argparse import Namespace
+from asyncio import get_running_loop
+
+from asscat.logger import setup_logger
+from asscat.manager import AssCatManager
+from asscat.metrics import format_peer
+from asscat.terminal import RawTerminal
+from asscat.utils import admission_policy, liveness_policy
+
+
+async def run_headless(args: Namespace) -> None:
+    """
+    Serve the listener given on the command line without a terminal UI
+    until SIGINT or SIGTERM. Nothing here imports textual. With --raw the
+    terminal is connected to the active session until it detaches.
+    """
+    loop = get_running_loop()
+    logger = setup_logger(__name__)
+    acm = AssCatManager(loop, buffered=args.buffered, admission=admission_policy(args),
+                        liveness=liveness_policy(args))
+    stop = loop.create_future()
+    terminal = None
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+    try:
+        if args.listen:
+            l_id, listener = await acm.create_listener(
+                args.ip_address, args.port, ssl=args.ssl,
+                protocol='UDP' if args.udp else 'TCP')
+            await acm.start_listener(l_id)
+            address = format_peer(listener.sockets[0].getsockname())
+            kind = 'udp' if args.udp else 'tls' if args.ssl else 'tcp'
+            logger.info(f'Listening on {address} ({kind}), headless')
+        if args.control:
+            await acm.start_control_server(args.control)
+        if args.raw:
+            terminal = RawTerminal(loop, acm)
+            terminal.attach().add_done_callback(lambda _: stop.done() or stop.set_result(None))
+        await stop
+    finally:
+        if terminal is not None:
+            terminal.detach()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        await acm.shutdown()
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import socket
+import struct
+import sys
+from array import array
+from time import perf_counter_ns
+from typing import Iterator, Optional, Tuple
+
+# Histogram range in microseconds, larger values count as the highest
+LOWEST = 1
+HIGHEST = 60 * 1000 * 1000
+# Decimal digits of precision kept over the whole range
+SIGNIFICANT_FIGURES = 2
+
+# Input up to this size counts as a keystroke, anything larger is a paste
+KEYSTROKE_SIZE = 8
+# Seconds after which a keystroke no longer waits for its echo, e.g.
+# when typing a password or into a program that doesn't echo
+ECHO_TIMEOUT = 2.
+
+# struct tcp_info up to tcpi_rtt, which is in microseconds
+_TCP_INFO = struct.Struct('8B16I')
+_TCP_INFO_RTT = 8 + 15
+
+
+class LatencyHistogram:
+    """
+    HDR style histogram of latencies in microseconds.
+
+    Values are counted in buckets of powers of two, each split into
+    linear sub buckets, which keeps the relative error below
+    1 / 10 ** significant_figures at any magnitude. Recording is an
+    index computation and an increment, memory is fixed up front.
+    """
+    __slots__ = ('_highest', '_half_magnitude', '_half_count', '_mask',
+                 '_counts', '_total', '_min', '_max', '_sum')
+
+    def __init__(self, highest: int = HIGHEST, significant_figures: int = SIGNIFICANT_FIGURES):
+        if not 1 <= significant_figures <= 5:
+            raise ValueError('significant_figures must be between 1 and 5')
+        sub_bucket_count = 1 << (2 * 10 ** significant_figures - 1).bit_length()
+        self._half_magnitude: int = sub_bucket_count.bit_length() - 2
+        self._half_count: int = sub_bucket_count >> 1
+        self._mask: int = sub_bucket_count - 1
+        self._highest: int = max(highest, sub_bucket_count)
+        self._counts = array('L', bytes(array('L').itemsize * (self._index(self._highest) + 1)))
+        self._total: int = 0
+        self._min: int = 0
+        self._max: int = 0
+        self._sum: int = 0
+
+    def __len__(self):
+        return self._total
+
+    @property
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self._counts)
+
+    def _index(self, value: int) -> int:
+        bucket = (value | self._mask).bit_length() - self._half_magnitude - 1
+        sub_bucket = value >> bucket
+        return ((bucket + 1) << self._half_magnitude) + sub_bucket - self._half_count
+
+    def _value_range(self, index: int) -> Tuple[int, int]:
+        """Lowest and highest value counted at ``index``"""
+        bucket = (index >> self._half_magnitude) - 1
+        sub_bucket = (index & (self._half_count - 1)) + self._half_count
+        if bucket < 0:
+            sub_bucket -= self._half_count
+            bucket = 0
+        low = sub_bucket << bucket
+        return low, low + (1 << bucket) - 1
+
+    @property
+    def min(self) -> int:
+        return self._min
+
+    @property
+    def max(self) -> int:
+        return self._max
+
+    @property
+    def mean(self) -> float:
+        return self._sum / self._total if self._total else 0.
+
+    def record(self, value: int, count: int = 1) -> None:
+        value = min(max(int(value), LOWEST), self._highest)
+        self._counts[self._index(value)] += count
+        if not self._total or value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+        self._total += count
+        self._sum += value * count
+
+    def percentile(self, percentile: float) -> int:
+        """Value at or below which ``percentile`` percent of values lie"""
+        if not self._total:
+            return 0
+        wanted = max(1, -(-self._total * min(percentile, 100.) // 100))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._value_range(index)[1], self._max)
+        return self._max
+
+    def buckets(self) -> Iterator[Tuple[int, int]]:
+        """Highest value and count of every non-empty bucket"""
+        for index, count in enumerate(self._counts):
+            if count:
+                yield self._value_range(index)[1], count
+
+    def merge(self, other: LatencyHistogram) -> None:
+        for value, count in other.buckets():
+            self.record(value, count)
+
+    def reset(self) -> None:
+        for index in range(len(self._counts)):
+            self._counts[index] = 0
+        self._total = self._min = self._max = self._sum = 0
+
+
+def tcp_rtt(sock) -> Optional[int]:
+    """Kernel's smoothed round trip time of a TCP socket in microseconds"""
+    if sock is None or not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        if sock.type != socket.SOCK_STREAM:
+            return None
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, _TCP_INFO.size)
+    except (OSError, AttributeError):
+        return None
+    if len(info) < _TCP_INFO.size:
+        return None
+    return _TCP_INFO.unpack(info)[_TCP_INFO_RTT] or None
+
+
+class KeystrokeLatency:
+    """
+    Keystroke to echo latency of one session.
+
+    A keystroke is timed when it is handed to the transport, the first
+    output after it counts as its echo. Keystrokes typed while one is
+    still waiting ride along. ``echo`` holds the whole round trip,
+    ``network`` the kernel's TCP round trip time sampled at each echo,
+    the gap between the two is spent on the target or in this process.
+    """
+    __slots__ = ('echo', 'network', 'timeouts', '_sock', '_sent')
+
+    def __init__(self, sock=None):
+        self.echo: LatencyHistogram = LatencyHistogram()
+        self.network: LatencyHistogram = LatencyHistogram()
+        self.timeouts: int = 0
+        self._sock = sock
+        self._sent: int = 0
+
+    @property
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self) + self.echo.memory_usage + self.network.memory_usage
+
+    @property
+    def waiting(self) -> bool:
+        return self._sent != 0
+
+    def sent(self, data) -> None:
+        if not self._sent and len(data) <= KEYSTROKE_SIZE:
+            self._sent = perf_counter_ns()
+
+    def received(self) -> None:
+        sent = self._sent
+        if not sent:
+            return
+        self._sent = 0
+        elapsed = (perf_counter_ns() - sent) // 1000
+        if elapsed > ECHO_TIMEOUT * 1000000:
+            self.timeouts += 1
+            return
+        self.echo.record(elapsed)
+        rtt = tcp_rtt(self._sock)
+        if rtt is not None:
+            self.network.record(rtt)
+
+    def summary(self) -> str:
+        """One line of echo and network percentiles in milliseconds"""
+        parts = []
+        for name, hist in (('echo', self.echo), ('net', self.network)):
+            if len(hist):
+                parts.append(f'{name} p50 {hist.percentile(50) / 1000:.1f} '
+                             f'p99 {hist.percentile(99) / 1000:.1f} '
+                             f'max {hist.max / 1000:.1f}ms')
+        if not parts:
+            return 'no keystrokes timed yet'
+        return f'{" | ".join(parts)} ({len(self.echo)} keys)'
@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import socket
+import struct
+from asyncio import AbstractEventLoop, TimerHandle
+from math import ceil
+from typing import Callable, Dict, Hashable, List, NamedTuple, Optional
+
+from asscat.logger import setup_logger
+
+# Seconds a connection is quiet before the kernel sends keepalive
+# probes, seconds between probes and unanswered probes until it drops
+# the connection
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 6
+# Seconds without data after which a session is looked at
+IDLE_TIMEOUT = 300.
+# Seconds a suspect session gets to show a sign of life
+SUSPECT_TIMEOUT = 60.
+# Seconds between two looks at sessions that are idle or suspect
+CHECK_INTERVAL = 15.
+# Resolution and size of the timer wheel, one turn takes 512 seconds
+WHEEL_TICK = 1.
+WHEEL_SLOTS = 512
+
+# Liveness states, sessions in these are tagged with them in the
+# registry, a session that turns dead is closed
+IDLE = 'idle'
+SUSPECT = 'suspect'
+
+_TCP_ESTABLISHED = 1
+# state, ca_state, retransmits, probes, backoff, options, wscale, flags,
+# rto, ato, snd_mss, rcv_mss, unacked, sacked, lost, retrans, fackets,
+# last_data_sent, last_ack_sent, last_data_recv, last_ack_recv
+_TCP_INFO = struct.Struct('8B13I')
+
+
+class LivenessPolicy(NamedTuple):
+    """
+    TCP keepalive options set on accepted sockets and the timeouts of
+    the application level checks. ``probe`` is written to a session that
+    turned suspect, where the kernel can't tell whether the peer is
+    still there; without it such sessions are never declared dead.
+    """
+    keepalive_idle: int = KEEPALIVE_IDLE
+    keepalive_interval: int = KEEPALIVE_INTERVAL
+    keepalive_count: int = KEEPALIVE_COUNT
+    idle_timeout: float = IDLE_TIMEOUT
+    suspect_timeout: float = SUSPECT_TIMEOUT
+    probe: Optional[bytes] = None
+
+
+class TcpInfo(NamedTuple):
+    state: int
+    probes: int
+    last_data_recv: float
+    last_ack_recv: float
+
+
+def set_keepalive(sock, idle: int, interval: int, count: int) -> bool:
+    """
+    Enable TCP keepalive on ``sock``. Where the platform has it, unacked
+    writes are given up after as long as keepalive takes to drop a peer.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        keepidle = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+        if keepidle is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, keepidle, idle)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+        if hasattr(socket, 'TCP_USER_TIMEOUT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT,
+                            (idle + interval * count) * 1000)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def tcp_info(sock) -> Optional[TcpInfo]:
+    """Kernel view of a TCP connection, None where TCP_INFO isn't available"""
+    option = getattr(socket, 'TCP_INFO', None)
+    if option is None:
+        return None
+    try:
+        fields = _TCP_INFO.unpack_from(sock.getsockopt(socket.IPPROTO_TCP, option, 104))
+    except (OSError, ValueError, struct.error):
+        return None
+    return TcpInfo(fields[0], fields[3], fields[19] / 1000, fields[20] / 1000)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: keys due in the same tick share a slot, keys
+    due more than a turn ahead wait for their turn in it. Adding,
+    moving and removing a key is O(1), a tick only visits one slot and
+    a single loop timer runs while there are keys.
+    """
+    __slots__ = ('_loop', '_callback', '_tick', '_slots', '_where', '_current', '_handle')
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            callback: Callable[[List[Hashable]], None],
+            tick: float = WHEEL_TICK,
+            slots: int = WHEEL_SLOTS,
+    ):
+        self._loop: AbstractEventLoop = loop
+        self._callback: Callable[[List[Hashable]], None] = callback
+        self._tick: float = tick
+        # Due tick of each key by slot
+        self._slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]
+        self._where: Dict[Hashable, int] = {}
+        self._current: int = int(loop.time() / tick)
+        self._handle: Optional[TimerHandle] = None
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key) -> bool:
+        return key in self._where
+
+    def add(self, key: Hashable, when: float) -> None:
+        """Call back with ``key`` at loop time ``when``, replaces a pending call"""
+        self.discard(key)
+        if self._handle is None and not self._where:
+            self._current = int(self._loop.time() / self._tick)
+        due = max(ceil(when / self._tick), self._current + 1)
+        slot = due % len(self._slots)
+        self._slots[slot][key] = due
+        self._where[key] = slot
+        if self._handle is None:
+            self._schedule()
+
+    def discard(self, key: Hashable) -> None:
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for slot in self._slots:
+            slot.clear()
+        self._where.clear()
+
+    def _schedule(self) -> None:
+        self._handle = self._loop.call_at((self._current + 1) * self._tick, self._advance)
+
+    def _advance(self) -> None:
+        self._handle = None
+        now = int(self._loop.time() / self._tick)
+        slots = self._slots
+        where = self._where
+        expired = []
+        # Every slot is visited once when the loop fell behind by a turn
+        for tick in range(max(self._current + 1, now - len(slots) + 1), now + 1):
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            due = [key for key, at in slot.items() if at <= now]
+            for key in due:
+                del slot[key]
+                del where[key]
+            expired.extend(due)
+        self._current = now
+        if where:
+            self._schedule()
+        if expired:
+            self._callback(expired)
+
+
+class Liveness:
+    """
+    Finds dead peers among the sessions of a registry.
+
+    Accepted TCP sockets get keepalive options, so the kernel drops
+    peers that stopped answering. On top of that every session has one
+    entry in a timer wheel, due ``idle_timeout`` after its last data.
+    Nothing is done on the receive path: when an entry is due and data
+    came in since, it's moved to the new deadline. Otherwise the session
+    is looked at every CHECK_INTERVAL seconds:
+
+    * idle: the peer's kernel acknowledged something, keepalive probes
+      or writes, within ``idle_timeout``, or there's no way to tell
+    * suspect: nothing was acknowledged, keepalive probes go
+      unanswered, or ``probe`` was written and not answered
+    * dead: still suspect after ``suspect_timeout``, or the peer closed
+      its end. The session's transport is aborted, which calls the
+      manager's client_disconnected_cb()
+
+    Data from the peer makes a session live again at the next look.
+    """
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            registry,
+            policy: LivenessPolicy = LivenessPolicy(),
+    ):
+        if policy.idle_timeout <= 0 or policy.suspect_timeout <= 0:
+            raise ValueError('Liveness timeouts must be positive')
+        self._loop: AbstractEventLoop = loop
+        self._registry = registry
+        self._policy: LivenessPolicy = policy
+        self._wheel: TimerWheel = TimerWheel(loop, self._expired)
+        # Since when suspect sessions are suspect
+        self._suspect: Dict[int, float] = {}
+        self._dead: int = 0
+        self._logger = setup_logger(__name__)
+
+    @property
+    def policy(self) -> LivenessPolicy:
+        return self._policy
+
+    @property
+    def dead(self) -> int:
+        """Sessions closed as dead so far"""
+        return self._dead
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def track(self, session) -> None:
+        policy = self._policy
+        transport = getattr(session, 'transport', None)
+        sock = transport.get_extra_info('socket') if transport is not None else None
+        if sock is None or sock.type != socket.SOCK_STREAM:
+            # UDP sessions expire on their own, sharded ones in their worker
+            return
+        set_keepalive(sock, policy.keepalive_idle, policy.keepalive_interval,
+                      policy.keepalive_count)
+        self._wheel.add(session.session_id, session.stats.last_data + policy.idle_timeout)
+
+    def forget(self, session_id: int) -> None:
+        self._wheel.discard(session_id)
+        self._suspect.pop(session_id, None)
+
+    def state_of(self, session_id: int) -> Optional[str]:
+        tags = self._registry.tags_of(session_id)
+        if SUSPECT in tags:
+            return SUSPECT
+        if IDLE in tags:
+            return IDLE
+        return None
+
+    def close(self) -> None:
+        self._wheel.close()
+        self._suspect.clear()
+
+    def _expired(self, session_ids: List[int]) -> None:
+        now = self._loop.time()
+        for sid in session_ids:
+            session = self._registry.get(sid)
+            if session is not None:
+                self._check(session, now)
+
+    def _check(self, session, now: float) -> None:
+        policy = self._policy
+        sid = session.session_id
+        registry = self._registry
+        transport = session.transport
+        if transport is None or transport.is_closing():
+            return
+        quiet = now - session.stats.last_data
+        suspect_since = self._suspect.get(sid)
+        if quiet < policy.idle_timeout or (
+                suspect_since is not None and session.stats.last_data > suspect_since):
+            # Data came in, live again
+            self._suspect.pop(sid, None)
+            registry.untag(sid, IDLE, SUSPECT)
+            self._wheel.add(sid, session.stats.last_data + policy.idle_timeout)
+            return
+
+        info = tcp_info(transport.get_extra_info('socket'))
+        if info is not None and info.state != _TCP_ESTABLISHED:
+            self._kill(session, 'peer closed the connection')
+            return
+        if info is not None:
+            alive = info.probes == 0 and info.last_ack_recv < policy.idle_timeout
+        else:
+            # Only a probe can tell
+            alive = policy.probe is None
+
+        if alive:
+            if suspect_since is not None:
+                self._suspect.pop(sid)
+                registry.untag(sid, SUSPECT)
+            registry.tag(sid, IDLE)
+        elif suspect_since is None:
+            self._suspect[sid] = now
+            registry.untag(sid, IDLE)
+            registry.tag(sid, SUSPECT)
+            self._logger.info(f'Session {sid} is suspect, quiet for {quiet:.0f}s')
+            if policy.probe is not None:
+                transport.write(policy.probe)
+        elif now - suspect_since >= policy.suspect_timeout:
+            self._kill(session, f'suspect for {now - suspect_since:.0f}s')
+            return
+        self._wheel.add(sid, now + min(CHECK_INTERVAL, policy.suspect_timeout))
+
+    def _kill(self, session, reason: str) -> None:
+        sid = session.session_id
+        self._dead += 1
+        self._logger.info(f'Session {sid} is dead, {reason}')
+        self.forget(sid)
+        session.transport.abort()
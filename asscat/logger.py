@@ -1,32 +1,155 @@
+import atexit
 import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler
+from typing import List, Optional
 
-from textual import logging as tlogging
+LOG_FILE = 'asscat.log'
+# Records formatted and written per wakeup of the logging thread at most
+BATCH_SIZE = 512
 
+_lock = threading.Lock()
+_pipeline: Optional['LogPipeline'] = None
 
-def setup_logger(name) -> logging.Logger:
 
+class _EnqueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the logging thread, so the
+    caller only pays for creating the record and a queue put.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class LogPipeline:
+    """
+    Background thread that drains the log queue in batches, formats the
+    records, writes them to the log file with one write and passes them
+    on to the Textual app of this process, if one is linked, otherwise
+    to stderr unless that was turned off.
+    """
+
+    def __init__(self, filename: str = LOG_FILE):
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._formatter = logging.Formatter(
+            fmt='%(asctime)s %(levelname)s %(name)s - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S',
+        )
+        self._filename: str = filename
+        self._file = None
+        self._app = None
+        self._app_loop = None
+        self._stderr: bool = True
+        self._thread = threading.Thread(target=self._run, name='asscat-logging', daemon=True)
+        self.handler = _EnqueueHandler(self._queue)
+        self.handler.setLevel(logging.DEBUG)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def set_app(self, app, loop) -> None:
+        self._app = app
+        self._app_loop = loop
+
+    def set_stderr(self, enabled: bool) -> None:
+        self._stderr = enabled
+
+    def _run(self) -> None:
+        q = self._queue
+        while True:
+            batch: List[logging.LogRecord] = [q.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._write([record for record in batch if record is not None])
+            if stop:
+                return
+
+    def _write(self, records: List[logging.LogRecord]) -> None:
+        if not records:
+            return
+        messages = []
+        for record in records:
+            try:
+                messages.append(self._formatter.format(record))
+            except Exception:  # noqa
+                self.handler.handleError(record)
+        try:
+            if self._file is None:
+                self._file = open(self._filename, 'a', encoding='utf-8')
+            self._file.write('\n'.join(messages) + '\n')
+            self._file.flush()
+        except OSError:
+            self.handler.handleError(records[0])
+
+        app, loop = self._app, self._app_loop
+        if app is None or loop is None or loop.is_closed():
+            if self._stderr:
+                print('\n'.join(messages), file=sys.stderr)
+            return
+        # One wakeup of the app's loop per batch
+        loop.call_soon_threadsafe(_log_to_app, app, messages)
+
+
+def _log_to_app(app, messages: List[str]) -> None:
+    for message in messages:
+        app.log.logging(message)
+
+
+def _get_pipeline() -> LogPipeline:
+    global _pipeline
+    with _lock:
+        if _pipeline is None:
+            _pipeline = LogPipeline()
+            _pipeline.start()
+            logging.getLogger().addHandler(_pipeline.handler)
+            atexit.register(shutdown_logging)
+        return _pipeline
+
+
+def setup_logger(name) -> logging.Logger:
+    """
+    Return the named logger. The queue based pipeline is installed on
+    the root logger once per process, loggers only ever enqueue records.
+    """
+    _get_pipeline()
     logger = logging.getLogger(name)
-    fileformatter = logging.Formatter(
-        fmt='%(asctime)s %(levelname)s %(name)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
-    )
-
-    handler = logging.FileHandler(
-        filename='asscat.log',
-        mode='a',
-        encoding='utf-8',
-    )
-    handler.setFormatter(fileformatter)
-    handler.setLevel(logging.DEBUG)
-    tuihandler = tlogging.TextualHandler()
-    tuihandler.setLevel(logging.DEBUG)
-    logger.addHandler(handler)
-    logger.addHandler(tuihandler)
     logger.setLevel(logging.DEBUG)
-    logging.basicConfig(
-        handlers=[handler, tuihandler]
-    )
     return logger
 
 
+def set_log_app(app, loop=None) -> None:
+    """Forward log messages to ``app``, ``loop`` defaults to the running one"""
+    if loop is None:
+        import asyncio
+        loop = asyncio.get_running_loop()
+    _get_pipeline().set_app(app, loop)
+
+
+def set_log_stderr(enabled: bool) -> None:
+    """Whether messages go to stderr while no app is linked"""
+    _get_pipeline().set_stderr(enabled)
+
 
+def shutdown_logging() -> None:
+    """Write out everything queued and stop the logging thread"""
+    global _pipeline
+    with _lock:
+        pipeline, _pipeline = _pipeline, None
+    if pipeline is not None:
+        logging.getLogger().removeHandler(pipeline.handler)
+        pipeline.stop()
@@ -1,14 +1,50 @@
 from __future__ import annotations
 
 
+import os
 import uvloop
 
-from asyncio import AbstractEventLoop, Server, get_event_loop
+from asyncio import AbstractEventLoop, Server, TimerHandle, get_event_loop
+from itertools import count
 from ssl import SSLContext
-from typing import List, TypeVar, Dict, Optional, Tuple
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    TYPE_CHECKING,
+)
 
-from asscat.logger import setup_logger
-from asscat.protocols import AssCatProtocol
+from asscat import broadcast as _broadcast
+from asscat.admission import (
+    PAUSE,
+    AdmissionControl,
+    AdmissionPolicy,
+    AdmissionStats,
+    PausableServer,
+    check_policy,
+)
+from asscat.ac_types import SocketType
+from asscat.control import CLIENT_QUEUE, CONTROL_PATH, ControlServer
+from asscat.datagram import DatagramListener, IDLE_TIMEOUT
+from asscat.liveness import Liveness, LivenessPolicy
+from asscat.logger import setup_logger, set_log_app
+from asscat.memory import IDLE_RECLAIM, POOL_KEEP, RECLAIM_INTERVAL, SessionFootprint, footprint
+from asscat import metrics as _metrics
+from asscat.protocols import AssCatProtocol, AssCatBufferedProtocol
+from asscat.recording import Recordings, DROP
+from asscat.registry import SessionRegistry, ACTIVE, CONNECTED
+from asscat.scrollback import ScrollbackBudget, Scrollback, MEMORY_LIMIT
+from asscat.search import INDEX_MEMORY, IndexStats, SearchHit, SearchIndex
+from asscat.tls import DEFAULT_PROFILE, TLS_DIR, CertProfile, ContextCache, TLSStats, ensure_profile
+from asscat.utils import UPGRADE_CONCURRENCY, UpgradeResult, upgrade_ptys
+
+if TYPE_CHECKING:
+    from asscat.shards import ShardController
 
 ACMGR = TypeVar('ACMGR', bound='AssCatManager')
 ACAPP = TypeVar('ACAPP', bound='AssCatApp')
@@ -16,91 +52,553 @@ ACAPP = TypeVar('ACAPP', bound='AssCatApp')
 
 class AssCatManager:
 
-    def __init__(self, loop: AbstractEventLoop | None = None):
+    def __init__(
+            self,
+            loop: AbstractEventLoop | None = None,
+            buffered: bool = False,
+            scrollback_memory: int = MEMORY_LIMIT,
+            recording_dir: str | None = None,
+            recording_policy: str = DROP,
+            idle_reclaim: float | None = IDLE_RECLAIM,
+            tls_dir: str = TLS_DIR,
+            search_memory: int | None = INDEX_MEMORY,
+            admission: AdmissionPolicy = AdmissionPolicy(),
+            liveness: LivenessPolicy | None = LivenessPolicy(),
+    ):
         self._loop: AbstractEventLoop = get_event_loop() if loop is None else loop
-        self._listeners: List[Server] | None = []
-        self._conns_in: Dict[int,] = {}
-        self._conns_out: Dict[int,] = {}
+        self._listeners: Dict[int, Server | PausableServer | DatagramListener] = {}
+        self._listener_ids = count()
+        self._listener_stats: Dict[int, _metrics.ListenerStats] = {}
+        self._metrics_server: Server | None = None
+        self._control: ControlServer | None = None
+        self._tls_dir: str = tls_dir
+        self._tls: ContextCache = ContextCache()
+        self._listener_tls: Dict[int, SSLContext] = {}
+        self._shards: Dict[int, ShardController] = {}
+        self._sessions: SessionRegistry = SessionRegistry()
+        self._admission: AdmissionControl = AdmissionControl(self._loop, self._session_admitted, admission)
+        self._liveness: Liveness | None = None
+        if liveness is not None:
+            self._liveness = Liveness(self._loop, self._sessions, liveness)
+        self._upgrades: Dict[int, UpgradeResult] = {}
         self._active_session_id: int | None = None
         self._protocol: str | None = None
+        self._buffered: bool = buffered
+        self._scrollback: ScrollbackBudget = ScrollbackBudget(scrollback_memory, loop=self._loop)
+        self._search: SearchIndex | None = None
+        if search_memory:
+            self._search = SearchIndex(self._loop, self._scrollback, search_memory)
+        self._recordings: Recordings | None = None
+        if recording_dir is not None:
+            self._recordings = Recordings(self._loop, recording_dir, policy=recording_policy)
+        self._idle_reclaim: float | None = idle_reclaim
+        self._reclaim_handle: TimerHandle | None = None
+        # Sessions released while idle, by the time of their last data
+        self._reclaimed: Dict[int, float] = {}
         self._app: ACAPP | None = None
         self._logger = setup_logger(__name__)
 
     @property
-    def listeners(self) -> List[Optional[Server]]:
+    def listeners(self) -> Dict[int, Server | PausableServer | DatagramListener]:
         return self._listeners
 
+    @property
+    def sharded_listeners(self) -> Dict[int, ShardController]:
+        return self._shards
+
     @property
     def listeners_count(self):
         return len(self._listeners)
 
+    @property
+    def sessions(self) -> SessionRegistry:
+        return self._sessions
+
     @property
     def incoming_connections_count(self):
-        return len(self._conns_in)
+        return len(self._sessions)
+
+    @property
+    def scrollback_memory(self) -> int:
+        """Bytes of session output currently held in memory"""
+        return self._scrollback.used
+
+    def get_scrollback(self, session_id: int) -> Optional[Scrollback]:
+        return self._scrollback.get(session_id)
+
+    @property
+    def recordings(self) -> Recordings | None:
+        return self._recordings
 
     async def create_listener(
             self,
             host='127.0.0.1',
             port=8888,
-            ssl: bool = None
-    ) -> Tuple[int, Server]:
+            ssl: bool | str | CertProfile | SSLContext | None = None,
+            buffered: bool | None = None,
+            protocol: SocketType = 'TCP',
+            admission: AdmissionPolicy | None = None,
+    ) -> Tuple[int, Server | PausableServer | DatagramListener]:
+        """
+        Listen on host:port. ``ssl`` makes it a TLS listener: True serves
+        the default certificate profile, a string the profile of that
+        name, both generated self-signed on first use.
+
+        ``admission`` limits the sessions of the listener on top of the
+        global limits. Without it the listener takes the backlog, queue
+        and overflow policy of the global policy and has no limits of
+        its own.
+        """
+        if protocol.upper() == 'UDP':
+            if ssl:
+                raise ValueError('TLS is not available for UDP listeners')
+            if admission is not None:
+                raise ValueError('Admission control is not available for UDP listeners')
+            return await self.create_datagram_listener(host, port)
 
-        if ssl and not isinstance(ssl, SSLContext):
-            ssl = None
+        if admission is None:
+            admission = self._admission.policy._replace(max_sessions=None, rate=None, burst=None)
+        check_policy(admission)
+
+        ssl = await self.ssl_context(ssl, host) if ssl else None
+
+        if buffered is None:
+            buffered = self._buffered
+        protocol_cls = AssCatBufferedProtocol if buffered else AssCatProtocol
+
+        l_id = next(self._listener_ids)
+        factory = lambda: protocol_cls(self._loop, self, l_id)  # noqa: E731
+        if admission.overflow == PAUSE:
+            server = PausableServer(self._loop, factory, host, port, ssl, admission.backlog)
+            self._admission.add_listener(l_id, admission, server.pause, server.resume)
+        else:
+            server = await self._loop.create_server(
+                protocol_factory=factory,
+                host=host,
+                port=port,
+                reuse_port=True,
+                reuse_address=True,
+                ssl=ssl,
+                backlog=admission.backlog,
+                start_serving=False,
+            )
+            self._admission.add_listener(l_id, admission)
+        self._listeners[l_id] = server
+        if ssl is not None:
+            self._listener_tls[l_id] = ssl
+        return l_id, server
 
-        l_id = self.listeners_count
-        server: Server = await self._loop.create_server(
-            protocol_factory=lambda: AssCatProtocol(self._loop, self, l_id),
-            host=host,
-            port=port,
+    async def ssl_context(
+            self,
+            ssl: bool | str | CertProfile | SSLContext,
+            host: str | None = None,
+    ) -> SSLContext:
+        """
+        Server context for ``ssl``. Contexts are cached per profile, so
+        listeners of a profile share session tickets and clients resume
+        across them.
+        """
+        if isinstance(ssl, SSLContext):
+            return ssl
+        if not isinstance(ssl, CertProfile):
+            name = DEFAULT_PROFILE if ssl is True else ssl
+            hosts = () if host is None else (host,)
+            ssl = await self._loop.run_in_executor(
+                None, ensure_profile, name, self._tls_dir, hosts)
+        return self._tls.get(ssl)
+
+    def tls_stats(self) -> Dict[CertProfile, TLSStats]:
+        """Full and resumed handshakes by certificate profile"""
+        return self._tls.stats()
+
+    async def create_datagram_listener(
+            self,
+            host='127.0.0.1',
+            port=8888,
+            idle_timeout: float = IDLE_TIMEOUT,
+    ) -> Tuple[int, DatagramListener]:
+        """
+        Listen for UDP datagrams on host:port. Every remote address gets
+        its own session, which is closed after ``idle_timeout`` seconds
+        without a datagram from the peer.
+        """
+        l_id = next(self._listener_ids)
+        _, listener = await self._loop.create_datagram_endpoint(
+            lambda: DatagramListener(
+                self._loop,
+                lambda: AssCatProtocol(self._loop, self, l_id),
+                idle_timeout=idle_timeout,
+            ),
+            local_addr=(host, port),
             reuse_port=True,
-            reuse_address=True,
-            ssl=ssl,
-            start_serving=False,
         )
-        self._listeners.append(server)
-        return l_id, server
+        self._listeners[l_id] = listener
+        return l_id, listener
+
+    async def create_sharded_listener(
+            self,
+            host='127.0.0.1',
+            port=8888,
+            workers: int | None = None,
+            buffered: bool | None = None,
+    ) -> Tuple[int, ShardController]:
+        """
+        Serve host:port from ``workers`` processes bound with SO_REUSEPORT,
+        one per CPU by default. Their sessions show up in this manager.
+        """
+        from asscat.shards import ShardController
+
+        if buffered is None:
+            buffered = self._buffered
+        l_id = next(self._listener_ids)
+        controller = ShardController(
+            self, l_id, host, port,
+            workers=workers or os.cpu_count() or 1,
+            buffered=buffered,
+        )
+        await controller.start()
+        self._shards[l_id] = controller
+        return l_id, controller
+
+    async def stop_sharded_listener(self, _id):
+        controller = self._shards.pop(_id, None)
+        if controller is not None:
+            await controller.stop()
+            self._logger.info(f'Stopped sharded listener #{_id}')
 
     async def start_listener(self, _id):
         await self._listeners[_id].start_serving()
         self._logger.info(f'Started listener #{_id}')
 
     async def stop_listener(self, _id):
-        if self._listeners:
-            listener = self.get_listener(_id)
-            self._listeners[_id].close()
-            self._listeners.remove(listener)
+        listener = self._listeners.pop(_id, None)
+        self._listener_stats.pop(_id, None)
+        self._listener_tls.pop(_id, None)
+        self._admission.remove_listener(_id)
+        if listener is not None:
+            listener.close()
             self._logger.info(f'Stopped listener #{_id}')
 
     def get_listener(self, _id):
         return self._listeners[_id]
 
+    def get_session(self, session_id: int | None):
+        return self._sessions.get(session_id)
+
     def client_connected_cb(self, session: AssCatProtocol, peername) -> None:
+        self._admission.offer(session, peername)
+
+    def _session_admitted(self, session: AssCatProtocol, peername, held: bytes = b'') -> None:
         sid = session.session_id
-        self._conns_in.update({
-            sid: session
-        })
+        self._sessions.add(session, peername, session.server_id)
+        stats = self._listener_stats.get(session.server_id)
+        if stats is None:
+            stats = self._listener_stats[session.server_id] = _metrics.ListenerStats()
+        stats.accepted += 1
+        session.set_scrollback(self._scrollback.create(sid))
+        if self._recordings is not None:
+            session.set_recorder(self._recordings.create(sid, peername))
+        if held:
+            # Output that came in while the session waited for admission
+            session.scrollback.append(held)
+            if session.recorder is not None:
+                session.recorder.output(held)
+        if self._liveness is not None:
+            self._liveness.track(session)
         self._logger.info(f'Connection from {peername}, {sid}')
-        if not self._active_session_id:
-            self._active_session_id = sid
+        if self._active_session_id is None:
+            self.set_active_session(sid)
+        if self._idle_reclaim and self._reclaim_handle is None:
+            self._schedule_reclaim()
+        if self._search is not None:
+            self._search.schedule()
+
+    @property
+    def active_session_id(self) -> int | None:
+        return self._active_session_id
+
+    def set_active_session(self, session_id: int | None) -> None:
+        current = self._sessions.get(self._active_session_id)
+        if current is not None:
+            self._sessions.set_state(self._active_session_id, CONNECTED)
+            current.deactivate()
+        self._active_session_id = None
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._active_session_id = session_id
+            self._sessions.set_state(session_id, ACTIVE)
+            session.activate()
 
     def client_disconnected_cb(self, session_id):
-        del self._conns_in[session_id]
+        session = self._sessions.remove(session_id)
+        if session is None:
+            # Closed while waiting for admission, or rejected
+            self._admission.discard(session_id)
+            return
+        stats = self._listener_stats.get(session.server_id)
+        if stats is not None:
+            stats.closed += 1
+        if self._recordings is not None:
+            self._recordings.discard(session_id)
+        # Kept for viewing and search without open files, the oldest
+        # closed sessions make room
+        for discarded in self._scrollback.retire(session_id):
+            if self._search is not None:
+                self._search.discard(discarded)
+        self._upgrades.pop(session_id, None)
+        self._reclaimed.pop(session_id, None)
+        if self._liveness is not None:
+            self._liveness.forget(session_id)
+        if self._control is not None:
+            self._control.session_closed(session_id)
         if session_id == self._active_session_id:
             self._active_session_id = None
+        self._admission.closed(session_id, session.server_id)
+
+    def broadcast(
+            self,
+            command: str,
+            session_ids: Iterable[int] | None = None,
+            predicate: Callable[[AssCatProtocol], bool] | None = None,
+            concurrency: int = _broadcast.CONCURRENCY,
+            timeout: float = _broadcast.TIMEOUT,
+    ) -> AsyncIterator[_broadcast.BroadcastResult]:
+        """
+        Run ``command`` on all sessions, or those in ``session_ids`` and
+        accepted by ``predicate``, and iterate the results as they finish.
+        """
+        sessions = self._select(session_ids, predicate)
+        self._logger.info(f'Broadcasting to {len(sessions)} sessions: {command!r}')
+        return _broadcast.broadcast(sessions, command, concurrency, timeout)
+
+    async def upgrade(
+            self,
+            session_ids: Iterable[int] | None = None,
+            predicate: Callable[[AssCatProtocol], bool] | None = None,
+            concurrency: int = UPGRADE_CONCURRENCY,
+            **kwargs,
+    ) -> AsyncIterator[UpgradeResult]:
+        """
+        Upgrade all sessions without a pty yet, or those selected, to a
+        pty and iterate the results as they finish. Upgraded sessions
+        are tagged 'pty', get_upgrade() returns their result.
+        """
+        sessions = [
+            session for session in self._select(session_ids, predicate)
+            if 'pty' not in self._sessions.tags_of(session.session_id)
+        ]
+        self._logger.info(f'Upgrading {len(sessions)} sessions to a pty')
+        async for result in upgrade_ptys(sessions, concurrency, **kwargs):
+            sid = result.session_id
+            if sid in self._sessions:
+                self._upgrades[sid] = result
+                if result.ok:
+                    self._sessions.tag(sid, 'pty')
+            self._logger.info(f'Session {sid} pty upgrade: {result.binary or result.error} '
+                              f'after {result.latency * 1000:.0f}ms')
+            yield result
+
+    def get_upgrade(self, session_id: int) -> UpgradeResult | None:
+        return self._upgrades.get(session_id)
+
+    def _select(
+            self,
+            session_ids: Iterable[int] | None,
+            predicate: Callable[[AssCatProtocol], bool] | None,
+    ) -> List[AssCatProtocol]:
+        if session_ids is None:
+            sessions = list(self._sessions)
+        else:
+            sessions = self._sessions.select(session_ids)
+        if predicate is not None:
+            sessions = [session for session in sessions if predicate(session)]
+        return sessions
+
+    def metrics(self) -> _metrics.MetricsSnapshot:
+        """Counters of all sessions and listeners at this moment"""
+        now = self._loop.time()
+        registry = self._sessions
+        sessions = []
+        for session in registry:
+            sid = session.session_id
+            metrics = _metrics.session_metrics(
+                session, registry.listener_of(sid), registry.state_of(sid), now)
+            if metrics is not None:
+                sessions.append(metrics)
+        listeners = []
+        listener_ids = sorted(set(self._listeners) | set(self._shards))
+        for l_id in listener_ids:
+            stats = self._listener_stats.get(l_id) or _metrics.ListenerStats()
+            admission = self._admission.stats(l_id) or AdmissionStats()
+            listeners.append(_metrics.ListenerMetrics(
+                l_id, self._listener_kind(l_id), self._listener_address(l_id),
+                stats.accepted, stats.closed, registry.count(listener_id=l_id),
+                self._admission.waiting(l_id), admission.rate_limited,
+                admission.session_limited, admission.queued, admission.rejected,
+                admission.pauses, getattr(self._listeners.get(l_id), 'dropped', 0)))
+        return _metrics.MetricsSnapshot(now, sessions, listeners)
+
+    def _listener_kind(self, _id) -> str:
+        if _id in self._shards:
+            return 'sharded'
+        if isinstance(self._listeners.get(_id), DatagramListener):
+            return 'udp'
+        if _id in self._listener_tls:
+            return 'tls'
+        return 'tcp'
+
+    def _listener_address(self, _id) -> str:
+        listener = self._listeners.get(_id)
+        if listener is None:
+            controller = self._shards.get(_id)
+            return '' if controller is None else _metrics.format_peer(controller.address)
+        sockets = listener.sockets
+        return _metrics.format_peer(sockets[0].getsockname()) if sockets else ''
+
+    def memory_usage(self, session_id: int) -> SessionFootprint | None:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        return footprint(session, self._loop.time())
+
+    def top_memory(self, count: int = 10) -> List[SessionFootprint]:
+        """The ``count`` sessions holding the most memory, largest first"""
+        now = self._loop.time()
+        footprints = [footprint(session, now) for session in self._sessions]
+        footprints.sort(key=lambda f: f.total, reverse=True)
+        return footprints[:count]
+
+    def reclaim_idle(self, idle_for: float | None = None) -> int:
+        """
+        Release the buffers of sessions without data for ``idle_for``
+        seconds, the active one excepted. Sessions are released once
+        per quiet period. Returns how many were released.
+        """
+        idle_for = self._idle_reclaim if idle_for is None else idle_for
+        if idle_for is None:
+            return 0
+        deadline = self._loop.time() - idle_for
+        reclaimed = self._reclaimed
+        released = 0
+        for session in self._sessions:
+            sid = session.session_id
+            stats = getattr(session, 'stats', None)
+            if (stats is None or sid == self._active_session_id or
+                    stats.last_data > deadline or reclaimed.get(sid) == stats.last_data):
+                continue
+            release = getattr(session, 'release_memory', None)
+            if release is not None:
+                release()
+            reclaimed[sid] = stats.last_data
+            released += 1
+        if released:
+            AssCatBufferedProtocol.pool.trim(POOL_KEEP)
+            self._logger.info(f'Released buffers of {released} idle sessions')
+        return released
+
+    def _schedule_reclaim(self) -> None:
+        self._reclaim_handle = self._loop.call_later(
+            min(self._idle_reclaim, RECLAIM_INTERVAL), self._reclaim)
+
+    def _reclaim(self) -> None:
+        self._reclaim_handle = None
+        self.reclaim_idle()
+        if self._sessions:
+            self._schedule_reclaim()
+
+    def search(
+            self,
+            pattern: bytes | str,
+            regex: bool = False,
+            ignore_case: bool = False,
+            session_ids: Iterable[int] | None = None,
+            limit: int = 100,
+    ) -> List[SearchHit]:
+        """
+        Find ``pattern`` in the scrollback of all sessions, or those in
+        ``session_ids``, through the search index if there is one.
+        """
+        index = self._search
+        if index is None:
+            index = SearchIndex(self._loop, self._scrollback)
+        return index.search(pattern, regex, ignore_case, session_ids, limit)
+
+    def search_stats(self) -> IndexStats | None:
+        return None if self._search is None else self._search.stats()
+
+    def write_metrics(self, path: str) -> None:
+        """Dump the metrics in the Prometheus text format to ``path``"""
+        _metrics.write_prometheus(self.metrics(), path)
+
+    async def start_metrics_server(self, host='127.0.0.1', port: int = _metrics.METRICS_PORT) -> Server:
+        """Serve the metrics for Prometheus on a loopback address"""
+        server = await _metrics.start_metrics_server(self.metrics, host, port)
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        self._metrics_server = server
+        self._logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return self._metrics_server
+
+    @property
+    def liveness(self) -> Liveness | None:
+        return self._liveness
+
+    @property
+    def control(self) -> ControlServer | None:
+        return self._control
+
+    async def start_control_server(
+            self,
+            path: str = CONTROL_PATH,
+            queue_limit: int = CLIENT_QUEUE,
+    ) -> ControlServer:
+        """
+        Serve the control API on the Unix socket ``path``, for other
+        terminals and scripts to list, attach to and drive sessions.
+        """
+        control = ControlServer(self, path, queue_limit)
+        await control.start()
+        if self._control is not None:
+            self._control.close()
+        self._control = control
+        self._logger.info(f'Serving control API on {path}')
+        return control
 
     def set_textual_app(self, app):
         self._app = app
+        set_log_app(app)
         self._logger.info('Linked Textual app')
 
     def _shutdown(self):
         self._logger.info('Shutting down manager...')
         self._closing = True
-        for listener in self._listeners:
+        for listener in self._listeners.values():
             listener.close()
+        self._admission.close()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            self._metrics_server = None
+        if self._control is not None:
+            self._control.close()
+            self._control = None
+        if self._reclaim_handle is not None:
+            self._reclaim_handle.cancel()
+            self._reclaim_handle = None
+        if self._search is not None:
+            self._search.close()
+        if self._liveness is not None:
+            self._liveness.close()
+        self._scrollback.close()
 
     async def shutdown(self):
+        control = self._control
         self._shutdown()
+        if control is not None:
+            await control.wait_closed()
+        for _id in list(self._shards):
+            await self.stop_sharded_listener(_id)
+        if self._recordings is not None:
+            await self._recordings.close()
 
 
 async def acm_create_listener():
@@ -0,0 +1,106 @@
+from collections import deque
+from functools import lru_cache
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+
+class PatternMatcher:
+    """
+    Aho-Corasick automaton over a set of byte patterns.
+
+    Goto and failure links are folded into one dense transition table
+    when compiled, so scanning costs one table lookup per input byte
+    regardless of how many patterns are registered. The automaton state
+    can be carried between calls to ``scan`` to continue on new data.
+    """
+
+    __slots__ = ('_patterns', '_table', '_out', '_max_len')
+
+    def __init__(self, patterns: Iterable[bytes]):
+        patterns = tuple(dict.fromkeys(bytes(p) for p in patterns))
+        if not patterns:
+            raise ValueError('At least one pattern is required')
+        if not all(patterns):
+            raise ValueError('Patterns should be at least one-byte strings')
+        self._patterns: Tuple[bytes, ...] = patterns
+        self._max_len: int = max(map(len, patterns))
+        self._table: List[List[int]] = []
+        self._out: List[int] = []
+        self._build()
+
+    def __repr__(self):
+        return f'<PatternMatcher {list(self._patterns)!r}>'
+
+    @classmethod
+    @lru_cache(maxsize=32)
+    def compile(cls, patterns: Tuple[bytes, ...]) -> 'PatternMatcher':
+        """Return a cached matcher for a tuple of patterns"""
+        return cls(patterns)
+
+    @property
+    def patterns(self) -> Tuple[bytes, ...]:
+        return self._patterns
+
+    @property
+    def max_len(self) -> int:
+        return self._max_len
+
+    def _build(self) -> None:
+        table = [[0] * 256]
+        # Index of the longest pattern ending in a state, -1 for none
+        out = [-1]
+        for idx, pattern in enumerate(self._patterns):
+            state = 0
+            for byte in pattern:
+                nxt = table[state][byte]
+                if not nxt:
+                    nxt = len(table)
+                    table[state][byte] = nxt
+                    table.append([0] * 256)
+                    out.append(-1)
+                state = nxt
+            out[state] = idx
+
+        # Breadth first over the trie turns failure links into direct
+        # transitions, since parents are complete before their children.
+        fail = [0] * len(table)
+        queue = deque()
+        for byte, nxt in enumerate(table[0]):
+            if nxt:
+                queue.append(nxt)
+        while queue:
+            state = queue.popleft()
+            row = table[state]
+            fail_row = table[fail[state]]
+            if out[state] == -1:
+                out[state] = out[fail[state]]
+            for byte in range(256):
+                nxt = row[byte]
+                if nxt:
+                    fail[nxt] = fail_row[byte]
+                    queue.append(nxt)
+                else:
+                    row[byte] = fail_row[byte]
+
+        self._table = table
+        self._out = out
+
+    def scan(
+            self,
+            data: Sequence[int],
+            state: int = 0,
+    ) -> Tuple[int, Optional[int], int]:
+        """
+        Feed ``data`` into the automaton starting from ``state``.
+
+        Returns ``(end, index, state)``. On a match ``end`` is the offset
+        in ``data`` right after the matched pattern and ``index`` the
+        position of that pattern in ``patterns``. Otherwise ``end`` is -1,
+        ``index`` is None and ``state`` can be passed to the next call.
+        """
+        table = self._table
+        out = self._out
+        for pos, byte in enumerate(data):
+            state = table[state][byte]
+            if out[state] != -1:
+                return pos + 1, out[state], state
+        return -1, None, state
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import sys
+from typing import NamedTuple
+
+# Seconds without data after which a session's buffers are released
+IDLE_RECLAIM = 300.
+# Seconds between two looks for sessions that went idle at most
+RECLAIM_INTERVAL = 60.
+# Free receive blocks the shared pool keeps once sessions went idle
+POOL_KEEP = 4
+
+
+class SessionFootprint(NamedTuple):
+    """Approximate bytes a session holds, by where they are held"""
+    session_id: int
+    idle: float
+    objects: int
+    reader: int
+    writer: int
+    recv_blocks: int
+    scrollback: int
+    mapped: int
+    recorder: int
+    latency: int
+
+    @property
+    def total(self) -> int:
+        """Everything but mapped scrollback, which the kernel can drop"""
+        return (self.objects + self.reader + self.writer + self.recv_blocks +
+                self.scrollback + self.recorder + self.latency)
+
+
+def _object_size(session) -> int:
+    size = sys.getsizeof(session)
+    attrs = getattr(session, '__dict__', None)
+    if attrs is not None:
+        size += sys.getsizeof(attrs)
+    for name in ('stats', 'transport'):
+        value = getattr(session, name, None)
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+
+def footprint(session, now: float) -> SessionFootprint:
+    """
+    Estimate what ``session`` holds in memory. Objects are counted by
+    their own size, buffers by what they allocated, so the numbers are
+    a lower bound that tracks what the session can give back.
+    """
+    reader = getattr(session, 'reader', None)
+    writer = getattr(session, 'writer', None)
+    scrollback = getattr(session, 'scrollback', None)
+    recorder = getattr(session, 'recorder', None)
+    latency = getattr(session, 'latency', None)
+    stats = getattr(session, 'stats', None)
+    return SessionFootprint(
+        session.session_id,
+        now - stats.last_data if stats is not None else 0.,
+        _object_size(session),
+        reader.memory_usage if reader is not None else 0,
+        writer.memory_usage if writer is not None else 0,
+        getattr(session, 'recv_memory', 0),
+        scrollback.memory_usage if scrollback is not None else 0,
+        scrollback.mapped if scrollback is not None else 0,
+        recorder.pending if recorder is not None else 0,
+        latency.memory_usage if latency is not None else 0,
+    )
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import os
+import tempfile
+from asyncio import (
+    IncompleteReadError,
+    LimitOverrunError,
+    Server,
+    StreamReader,
+    StreamWriter,
+    TimeoutError,
+    start_server,
+    wait_for,
+)
+from ipaddress import ip_address
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+# Port of the metrics endpoint, next to the usual exporter ports
+METRICS_PORT = 9464
+# Seconds a scraper gets to send its request
+REQUEST_TIMEOUT = 5.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class SessionStats:
+    """Counters of one session, bumped on its hot paths"""
+    __slots__ = ('connected_at', 'last_data', 'bytes_in', 'chunks_in',
+                 'bytes_out', 'chunks_out', 'read_pauses', 'read_resumes',
+                 'write_pauses', 'write_resumes', 'dropped')
+
+    def __init__(self, now: float):
+        self.connected_at: float = now
+        self.last_data: float = now
+        self.bytes_in: int = 0
+        self.chunks_in: int = 0
+        self.bytes_out: int = 0
+        self.chunks_out: int = 0
+        self.read_pauses: int = 0
+        self.read_resumes: int = 0
+        self.write_pauses: int = 0
+        self.write_resumes: int = 0
+        # Datagrams dropped while reading was paused
+        self.dropped: int = 0
+
+
+class ListenerStats:
+    """Counters of one listener"""
+    __slots__ = ('accepted', 'closed')
+
+    def __init__(self):
+        self.accepted: int = 0
+        self.closed: int = 0
+
+
+class SessionMetrics(NamedTuple):
+    session_id: int
+    listener_id: Optional[int]
+    peer: str
+    state: Optional[str]
+    bytes_in: int
+    bytes_out: int
+    chunks_in: int
+    chunks_out: int
+    read_pauses: int
+    read_resumes: int
+    write_pauses: int
+    write_resumes: int
+    buffered: int
+    buffer_high_water: int
+    idle: float
+    uptime: float
+    dropped: int = 0
+
+
+class ListenerMetrics(NamedTuple):
+    listener_id: int
+    kind: str
+    address: str
+    accepted: int
+    closed: int
+    active: int
+    waiting: int = 0
+    rate_limited: int = 0
+    session_limited: int = 0
+    queued: int = 0
+    rejected: int = 0
+    pauses: int = 0
+    dropped: int = 0
+
+
+class MetricsSnapshot(NamedTuple):
+    time: float
+    sessions: List[SessionMetrics]
+    listeners: List[ListenerMetrics]
+
+
+def format_peer(peername) -> str:
+    if isinstance(peername, (tuple, list)) and len(peername) >= 2:
+        return f'{peername[0]}:{peername[1]}'
+    return '' if peername is None else str(peername)
+
+
+def session_metrics(session, listener_id, state, now: float) -> Optional[SessionMetrics]:
+    """Metrics of one session from its and its reader's and writer's counters"""
+    stats: Optional[SessionStats] = getattr(session, 'stats', None)
+    if stats is None:
+        return None
+    bytes_out, chunks_out = stats.bytes_out, stats.chunks_out
+    writer = getattr(session, 'writer', None)
+    if writer is not None:
+        bytes_out += writer.stats.bytes_written
+        chunks_out += writer.stats.sends
+    read_pauses, read_resumes = stats.read_pauses, stats.read_resumes
+    buffered = high_water = 0
+    reader = getattr(session, 'reader', None)
+    if reader is not None:
+        reader_stats = reader.stats
+        buffered, high_water = reader.buffered, reader_stats.high_water
+        read_pauses += reader_stats.pauses
+        read_resumes += reader_stats.resumes
+    transport = getattr(session, 'transport', None)
+    peer = getattr(session, 'peername', None)
+    if peer is None and transport is not None:
+        peer = transport.get_extra_info('peername')
+    return SessionMetrics(
+        session.session_id, listener_id, format_peer(peer), state,
+        stats.bytes_in, bytes_out, stats.chunks_in, chunks_out,
+        read_pauses, read_resumes, stats.write_pauses, stats.write_resumes,
+        buffered, high_water, now - stats.last_data, now - stats.connected_at,
+        stats.dropped,
+    )
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+# Metric name, type, help text and the snapshot field it is read from
+_SESSION_METRICS: Tuple[Tuple[str, str, str, str], ...] = (
+    ('asscat_session_received_bytes_total', 'counter', 'Bytes received from the peer', 'bytes_in'),
+    ('asscat_session_sent_bytes_total', 'counter', 'Bytes sent to the peer', 'bytes_out'),
+    ('asscat_session_received_chunks_total', 'counter', 'Reads that delivered data', 'chunks_in'),
+    ('asscat_session_sent_chunks_total', 'counter', 'Writes handed to the transport', 'chunks_out'),
+    ('asscat_session_read_pauses_total', 'counter', 'Times reading from the peer was paused',
+     'read_pauses'),
+    ('asscat_session_read_resumes_total', 'counter', 'Times reading from the peer was resumed',
+     'read_resumes'),
+    ('asscat_session_write_pauses_total', 'counter', 'Times the peer was too slow to take writes',
+     'write_pauses'),
+    ('asscat_session_write_resumes_total', 'counter', 'Times writing to the peer was resumed',
+     'write_resumes'),
+    ('asscat_session_buffered_bytes', 'gauge', 'Bytes waiting in the session reader', 'buffered'),
+    ('asscat_session_buffer_high_water_bytes', 'gauge', 'Most bytes ever waiting in the reader',
+     'buffer_high_water'),
+    ('asscat_session_idle_seconds', 'gauge', 'Seconds since the peer last sent data', 'idle'),
+    ('asscat_session_uptime_seconds', 'gauge', 'Seconds since the session connected', 'uptime'),
+    ('asscat_session_dropped_datagrams_total', 'counter',
+     'Datagrams dropped while reading was paused', 'dropped'),
+)
+_LISTENER_METRICS: Tuple[Tuple[str, str, str, str], ...] = (
+    ('asscat_listener_accepted_total', 'counter', 'Sessions accepted', 'accepted'),
+    ('asscat_listener_closed_total', 'counter', 'Sessions closed', 'closed'),
+    ('asscat_listener_sessions', 'gauge', 'Sessions currently open', 'active'),
+    ('asscat_listener_waiting_sessions', 'gauge', 'Sessions waiting for admission', 'waiting'),
+    ('asscat_listener_rate_limited_total', 'counter',
+     'Connections over the accept rate', 'rate_limited'),
+    ('asscat_listener_session_limited_total', 'counter',
+     'Connections over the session limit', 'session_limited'),
+    ('asscat_listener_queued_total', 'counter', 'Connections queued for admission', 'queued'),
+    ('asscat_listener_rejected_total', 'counter', 'Connections closed by admission control',
+     'rejected'),
+    ('asscat_listener_pauses_total', 'counter', 'Times the listener stopped accepting', 'pauses'),
+    ('asscat_listener_dropped_datagrams_total', 'counter',
+     'Datagrams dropped while their session was paused', 'dropped'),
+)
+
+
+def _format(value) -> str:
+    return repr(round(value, 3)) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(snapshot: MetricsSnapshot) -> str:
+    """The snapshot in the Prometheus text exposition format"""
+    lines = []
+    groups = (
+        (_SESSION_METRICS, snapshot.sessions,
+         lambda m: _labels(session=m.session_id, listener=m.listener_id, peer=m.peer)),
+        (_LISTENER_METRICS, snapshot.listeners,
+         lambda m: _labels(listener=m.listener_id, kind=m.kind, address=m.address)),
+    )
+    for metrics, rows, labels_of in groups:
+        labels = [labels_of(row) for row in rows]
+        for name, kind, help_text, field in metrics:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{label} {_format(getattr(row, field))}'
+                         for row, label in zip(rows, labels))
+    lines.append('# HELP asscat_sessions Sessions currently open')
+    lines.append('# TYPE asscat_sessions gauge')
+    lines.append(f'asscat_sessions {len(snapshot.sessions)}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(snapshot: MetricsSnapshot, path: str) -> None:
+    """
+    Write the snapshot for node_exporter's textfile collector. The file
+    is replaced atomically, a scrape never sees half of it.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.asscat-metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(prometheus_text(snapshot))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+async def _respond(writer: StreamWriter, status: str, body: bytes, content_type: str) -> None:
+    writer.write(
+        f'HTTP/1.1 {status}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: close\r\n\r\n'.encode() + body
+    )
+    await writer.drain()
+
+
+async def start_metrics_server(
+        snapshot: Callable[[], MetricsSnapshot],
+        host: str = '127.0.0.1',
+        port: int = METRICS_PORT,
+) -> Server:
+    """
+    Serve GET /metrics on host:port in the Prometheus text format. Only
+    loopback addresses are accepted, sessions and peers are not meant
+    to be scraped from the network.
+    """
+    if not _is_loopback(host):
+        raise ValueError(f'Metrics are only served on loopback addresses, not {host!r}')
+
+    async def handle(reader: StreamReader, writer: StreamWriter) -> None:
+        try:
+            head = await wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+            method, path, *_ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+            if method not in ('GET', 'HEAD'):
+                await _respond(writer, '405 Method Not Allowed', b'', 'text/plain')
+            elif path.split('?', 1)[0] != '/metrics':
+                await _respond(writer, '404 Not Found', b'', 'text/plain')
+            else:
+                body = prometheus_text(snapshot()).encode()
+                await _respond(writer, '200 OK', body if method == 'GET' else b'', CONTENT_TYPE)
+        except (IncompleteReadError, LimitOverrunError, TimeoutError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await start_server(handle, host, port, reuse_address=True)
+
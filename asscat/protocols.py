@@ -3,14 +3,21 @@ import itertools
 
 from asyncio import (
     AbstractEventLoop,
+    BufferedProtocol,
     Protocol,
     Transport,
-    StreamReader,
-    StreamWriter,
 )
 from asyncio.streams import FlowControlMixin  # noqa
 
-from typing import Optional
+from typing import Callable, List, Optional, Set, Tuple
+
+from asscat.buffers import BufferPool
+from asscat.latency import KeystrokeLatency
+from asscat.metrics import SessionStats
+from asscat.streams import AssCatReader, AssCatWriter
+
+# Receive block is rotated once less than this is left to recv into
+MIN_RECV_SIZE = 16 * 1024
 
 
 class AssCatProtocol(FlowControlMixin, Protocol):
@@ -49,11 +56,24 @@ class AssCatProtocol(FlowControlMixin, Protocol):
         self._manager = manager
         self._read_blocked = False
         self._server_id = server_id
+        self._scrollback = None
+        self._recorder = None
+        self._latency: Optional[KeystrokeLatency] = None
+        self._stats: SessionStats = SessionStats(loop.time())
+        self._taps: Optional[Tuple[Callable, ...]] = None
 
     @property
     def session_id(self):
         return self._session_id
 
+    @property
+    def server_id(self):
+        return self._server_id
+
+    @property
+    def transport(self):
+        return self._transport
+
     @property
     def reader(self):
         return self._reader
@@ -62,12 +82,85 @@ class AssCatProtocol(FlowControlMixin, Protocol):
     def writer(self):
         return self._writer
 
+    @property
+    def write_pauses(self) -> int:
+        return self._stats.write_pauses
+
+    @property
+    def stats(self) -> SessionStats:
+        return self._stats
+
+    @property
+    def scrollback(self):
+        return self._scrollback
+
+    def set_scrollback(self, scrollback) -> None:
+        self._scrollback = scrollback
+
+    @property
+    def recorder(self):
+        return self._recorder
+
+    def set_recorder(self, recorder) -> None:
+        self._recorder = recorder
+        if recorder is not None:
+            recorder.set_flow_control(self._pause_reading, self._resume_reading)
+
+    @property
+    def latency(self) -> Optional[KeystrokeLatency]:
+        return self._latency
+
+    def track_latency(self) -> KeystrokeLatency:
+        """Start timing keystrokes to their echo, if not done already"""
+        if self._latency is None:
+            transport = self._transport
+            sock = transport.get_extra_info('socket') if transport is not None else None
+            self._latency = KeystrokeLatency(sock)
+        return self._latency
+
+    def add_tap(self, tap: Callable) -> None:
+        """
+        Call ``tap`` with every chunk of output. Chunks may be memoryviews
+        into receive blocks, taps copy what they keep.
+        """
+        self._taps = (self._taps or ()) + (tap,)
+
+    def remove_tap(self, tap: Callable) -> None:
+        self._taps = tuple(t for t in self._taps or () if t is not tap) or None
+
+    def release_memory(self) -> None:
+        """Give back buffer memory, called once the session went quiet"""
+        reader = self._reader
+        if reader is not None:
+            reader.release()
+        scrollback = self._scrollback
+        if scrollback is not None:
+            scrollback.release()
+
+    def _pause_reading(self) -> None:
+        transport = self._transport
+        if transport is not None and not transport.is_closing():
+            self._stats.read_pauses += 1
+            transport.pause_reading()
+
+    def _resume_reading(self) -> None:
+        transport = self._transport
+        if transport is not None and not transport.is_closing():
+            self._stats.read_resumes += 1
+            transport.resume_reading()
+
     def _replace_writer(self, writer):
         transport = writer.transport
         self._stream_writer = writer
         self._transport = transport
         self._over_ssl = transport.get_extra_info('sslcontext') is not None
 
+    def activate(self) -> None:
+        """Called when the session becomes the active one"""
+
+    def deactivate(self) -> None:
+        """Called when another session becomes the active one"""
+
     def stdin_connection_made(self, transport) -> None:
         self._stdin_transport = transport
 
@@ -76,13 +169,13 @@ class AssCatProtocol(FlowControlMixin, Protocol):
 
     def connection_made(self, transport: Transport) -> None:
         self._transport = transport
-        self._reader = StreamReader(loop=self._loop)
+        self._reader = AssCatReader(loop=self._loop)
 
         self._reader.set_transport(transport)
 
         self._over_ssl = transport.get_extra_info('sslcontext') is not None
 
-        self._writer = StreamWriter(
+        self._writer = AssCatWriter(
             transport=transport,
             protocol=self,
             reader=self._reader,
@@ -110,17 +203,52 @@ class AssCatProtocol(FlowControlMixin, Protocol):
             self._writer = None
             self._task = None
             self._transport = None
+            self._manager.client_disconnected_cb(self._session_id)
+
+    def pause_writing(self) -> None:
+        self._stats.write_pauses += 1
+        super().pause_writing()
+
+    def resume_writing(self) -> None:
+        self._stats.write_resumes += 1
+        super().resume_writing()
 
     def data_received(self, data: bytes) -> None:
+        stats = self._stats
+        stats.bytes_in += len(data)
+        stats.chunks_in += 1
+        stats.last_data = self._loop.time()
         stdout = self._stdout_transport
         reader = self._reader
+        scrollback = self._scrollback
+        if scrollback is not None:
+            scrollback.append(data)
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.output(data)
+        latency = self._latency
+        if latency is not None:
+            latency.received()
         if stdout is not None:
             stdout.write(data)
+        taps = self._taps
+        if taps is not None:
+            for tap in taps:
+                tap(data)
         if reader is not None:
             reader.feed_data(data)
 
     def stdin_data_received(self, data: bytes) -> None:
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.input(data)
         self._transport.write(data)
+        stats = self._stats
+        stats.bytes_out += len(data)
+        stats.chunks_out += 1
+        latency = self._latency
+        if latency is not None:
+            latency.sent(data)
 
     def eof_received(self):
         reader = self._reader
@@ -130,7 +258,7 @@ class AssCatProtocol(FlowControlMixin, Protocol):
             return False
         return True
 
-    def _get_close_waiter(self):
+    def _get_close_waiter(self, stream=None):
         return self._closed
 
     def __del__(self):
@@ -147,3 +275,105 @@ class AssCatProtocol(FlowControlMixin, Protocol):
             self._stdout_transport.pipe.close()
         if self._stdin_transport:
             self._stdin_transport.pipe.close()
+
+
+class AssCatBufferedProtocol(AssCatProtocol, BufferedProtocol):
+    """
+    AssCatProtocol variant that lets the transport recv straight into
+    a pooled receive block. Received ranges are passed to the reader
+    as memoryviews, so socket data is not copied before it is read.
+
+    A block is only written over again once the reader and the stdout
+    transport no longer reference any of it. Otherwise it's retired
+    and a fresh one is taken from the pool, retired blocks go back on
+    a later rotation once the reader dropped its views of them.
+    """
+    pool = BufferPool()
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            manager,
+            server_id,
+            pool: BufferPool = None,
+    ):
+        super().__init__(loop, manager, server_id)
+        if pool is not None:
+            self.pool = pool
+        self._recv_block: Optional[bytearray] = None
+        self._recv_view: Optional[memoryview] = None
+        self._recv_pos: int = 0
+        self._retired: List[bytearray] = []
+
+    def _referenced_blocks(self) -> Optional[Set[int]]:
+        """
+        Ids of the receive blocks the reader still has views of, or None
+        if a stdout transport that hasn't written everything yet may
+        point into any of them.
+        """
+        stdout = self._stdout_transport
+        if stdout is not None and stdout.get_write_buffer_size() > 0:
+            return None
+        reader = self._reader
+        return reader.view_owners() if reader is not None else set()
+
+    def _rotate_recv_block(self) -> None:
+        referenced = self._referenced_blocks()
+        if referenced is not None:
+            # Hand retired blocks nothing points into anymore back to
+            # the pool, an unread reader keeps only its last views.
+            retired = self._retired
+            if retired:
+                self._retired = [block for block in retired if id(block) in referenced]
+                for block in retired:
+                    if id(block) not in referenced:
+                        self.pool.release(block)
+            if self._recv_block is not None and id(self._recv_block) not in referenced:
+                self._recv_pos = 0
+                return
+        if self._recv_block is not None:
+            self._retired.append(self._recv_block)
+        self._recv_block = self.pool.acquire()
+        self._recv_view = memoryview(self._recv_block)
+        self._recv_pos = 0
+
+    @property
+    def recv_memory(self) -> int:
+        """Bytes of receive blocks held, the current and retired ones"""
+        blocks = len(self._retired) + (self._recv_block is not None)
+        return blocks * self.pool.block_size
+
+    def release_memory(self) -> None:
+        # Once the reader let go of its views, only a stdout transport
+        # that hasn't written everything yet may still point into a block
+        super().release_memory()
+        stdout = self._stdout_transport
+        if stdout is not None and stdout.get_write_buffer_size() > 0:
+            return
+        for block in self._retired:
+            self.pool.release(block)
+        self._retired.clear()
+        if self._recv_block is not None:
+            self.pool.release(self._recv_block)
+            self._recv_block = None
+            self._recv_view = None
+            self._recv_pos = 0
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if (self._recv_block is None or
+                len(self._recv_block) - self._recv_pos < MIN_RECV_SIZE):
+            self._rotate_recv_block()
+        return self._recv_view[self._recv_pos:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        start = self._recv_pos
+        self._recv_pos = start + nbytes
+        self.data_received(self._recv_view[start:self._recv_pos])
+
+    def connection_lost(self, exc: Exception, transport=None) -> None:
+        super().connection_lost(exc, transport)
+        # Views may still sit in the reader, so the blocks are left to
+        # the garbage collector instead of going back to the pool.
+        self._recv_view = None
+        self._recv_block = None
+        self._retired.clear()
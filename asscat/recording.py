@@ -0,0 +1,362 @@
+from __future__ import annotations
+
+import codecs
+import gzip
+import io
+import json
+import os
+import time
+import zlib
+from asyncio import AbstractEventLoop, Future, TimerHandle, gather
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Threads compressing and writing recordings
+WORKERS = 2
+# Recorded bytes after which a batch is handed to the compressor
+BATCH_SIZE = 64 * 1024
+# Seconds a non-empty batch waits for more data at most
+FLUSH_INTERVAL = 1.
+# Bytes a recording may have waiting for the compressor
+MAX_PENDING = 8 * 1024 * 1024
+
+# What happens once a recording has MAX_PENDING bytes waiting
+DROP = 'drop'
+PAUSE = 'pause'
+
+OUTPUT = 'o'
+INPUT = 'i'
+MARKER = 'm'
+
+
+def default_compression() -> str:
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+class Event(NamedTuple):
+    time: float
+    kind: str
+    data: str
+
+
+class _Encoder:
+    """
+    Turns batches of raw events into compressed asciicast lines. Only
+    ever used by one worker thread at a time, its recorder submits the
+    next batch once the previous one is written. The file is opened by
+    the first write, off the event loop.
+    """
+    __slots__ = ('_path', '_file', '_compressor', '_decoders')
+
+    def __init__(self, path: str, compression: str):
+        self._path: str = path
+        self._file = None
+        if compression == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        # Multi byte characters may be split between two chunks
+        self._decoders = {
+            OUTPUT: codecs.getincrementaldecoder('utf-8')('replace'),
+            INPUT: codecs.getincrementaldecoder('utf-8')('replace'),
+        }
+
+    def write(self, header: Optional[Dict], events: List[Tuple[float, str, bytes]]) -> None:
+        lines = []
+        if header is not None:
+            lines.append(json.dumps(header))
+        decoders = self._decoders
+        for t, kind, data in events:
+            decoder = decoders.get(kind)
+            text = data.decode() if decoder is None else decoder.decode(data)
+            lines.append(json.dumps([round(t, 6), kind, text], ensure_ascii=False))
+        if self._file is None:
+            self._file = open(self._path, 'wb')
+        if lines:
+            lines.append('')
+            self._file.write(self._compressor.compress('\n'.join(lines).encode()))
+
+    def close(self) -> None:
+        if self._file is None:
+            # Opening it failed
+            return
+        try:
+            self._file.write(self._compressor.flush())
+        finally:
+            self._file.close()
+
+
+class Recorder:
+    """
+    Records the output and input of one session as asciicast v2.
+
+    The loop only appends (time, kind, bytes) tuples to a batch. Full
+    batches, or any after FLUSH_INTERVAL, go to the compressor thread,
+    one at a time per recorder so events stay in order.
+
+    Once ``max_pending`` bytes wait for the compressor, the ``drop``
+    policy discards new events and leaves a marker event with the bytes
+    lost, the ``pause`` policy calls ``pause`` (pausing the session's
+    transport) and ``resume`` once half of that has been written.
+    """
+    __slots__ = (
+        '_loop', '_executor', '_encoder', '_header', '_start', '_policy',
+        '_max_pending', '_batch', '_batch_size', '_queued', '_pending',
+        '_writing', '_flush_handle', '_dropped', '_paused', '_pause',
+        '_resume', '_closing', '_closed', '_path',
+    )
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            executor: ThreadPoolExecutor,
+            path: str,
+            compression: str,
+            header: Dict,
+            policy: str = DROP,
+            max_pending: int = MAX_PENDING,
+            pause: Callable[[], None] | None = None,
+            resume: Callable[[], None] | None = None,
+    ):
+        self._loop: AbstractEventLoop = loop
+        self._executor: ThreadPoolExecutor = executor
+        self._path: str = path
+        self._encoder: _Encoder = _Encoder(path, compression)
+        self._header: Optional[Dict] = header
+        self._start: float = loop.time()
+        self._policy: str = policy
+        self._max_pending: int = max_pending
+        self._batch: List[Tuple[float, str, bytes]] = []
+        self._batch_size: int = 0
+        self._queued: Deque[Tuple[List, int]] = deque()
+        self._pending: int = 0
+        self._writing: bool = False
+        self._flush_handle: Optional[TimerHandle] = None
+        self._dropped: int = 0
+        self._paused: bool = False
+        self._pause = pause
+        self._resume = resume
+        self._closing: bool = False
+        self._closed: Future = loop.create_future()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def pending(self) -> int:
+        """Recorded bytes not yet written out"""
+        return self._pending
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def set_flow_control(self, pause: Callable[[], None], resume: Callable[[], None]) -> None:
+        self._pause = pause
+        self._resume = resume
+
+    def output(self, data) -> None:
+        self._record(OUTPUT, data)
+
+    def input(self, data) -> None:
+        self._record(INPUT, data)
+
+    def _record(self, kind: str, data) -> None:
+        if self._closing or not data:
+            return
+        size = len(data)
+        if self._pending + size > self._max_pending:
+            if self._policy == DROP:
+                self._dropped += size
+                return
+            if not self._paused and self._pause is not None:
+                self._paused = True
+                self._pause()
+        now = self._loop.time() - self._start
+        if self._dropped and self._policy == DROP:
+            # Leave a note where the gap is
+            note = f'dropped {self._dropped} bytes'.encode()
+            self._batch.append((now, MARKER, note))
+            self._dropped = 0
+        self._batch.append((now, kind, bytes(data)))
+        self._batch_size += size
+        self._pending += size
+        if self._batch_size >= BATCH_SIZE:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(FLUSH_INTERVAL, self._flush)
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._batch or self._header is not None:
+            self._queued.append((self._batch, self._batch_size))
+            self._batch = []
+            self._batch_size = 0
+        self._submit()
+
+    def _submit(self) -> None:
+        if self._writing:
+            return
+        if self._queued:
+            events, size = self._queued.popleft()
+            header, self._header = self._header, None
+            self._writing = True
+            fut = self._loop.run_in_executor(self._executor, self._encoder.write, header, events)
+            fut.add_done_callback(lambda f: self._written(f, size))
+        elif self._closing and not self._closed.done():
+            self._writing = True
+            fut = self._loop.run_in_executor(self._executor, self._encoder.close)
+            fut.add_done_callback(self._finished)
+
+    def _written(self, fut: Future, size: int) -> None:
+        self._writing = False
+        self._pending -= size
+        if fut.exception() is not None:
+            # The file is unusable, throw away what's left
+            self._queued.clear()
+            self._batch.clear()
+            self._pending = 0
+            self._closing = True
+        if self._paused and self._pending <= self._max_pending // 2:
+            self._paused = False
+            if self._resume is not None:
+                self._resume()
+        self._submit()
+
+    def _finished(self, fut: Future) -> None:
+        self._writing = False
+        if not self._closed.done():
+            self._closed.set_result(None)
+        fut.exception()
+
+    def close(self) -> Future:
+        """Write out what's left and close the file, returns a future"""
+        if not self._closing:
+            self._closing = True
+            if self._paused and self._resume is not None:
+                self._paused = False
+                self._resume()
+            self._flush()
+        return self._closed
+
+
+class Recordings:
+    """
+    Creates a recorder per session in ``directory`` and owns the
+    compressor threads they share.
+    """
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            directory: str,
+            compression: str | None = None,
+            policy: str = DROP,
+            max_pending: int = MAX_PENDING,
+            workers: int = WORKERS,
+    ):
+        if compression is None:
+            compression = default_compression()
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        if compression not in ('gzip', 'zstd'):
+            raise ValueError(f'Unknown compression {compression!r}')
+        if policy not in (DROP, PAUSE):
+            raise ValueError(f'Unknown recording policy {policy!r}')
+        os.makedirs(directory, exist_ok=True)
+        self._loop: AbstractEventLoop = loop
+        self._directory: str = directory
+        self._compression: str = compression
+        self._policy: str = policy
+        self._max_pending: int = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asscat-record')
+        self._recorders: Dict[int, Recorder] = {}
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    def get(self, session_id: int) -> Optional[Recorder]:
+        return self._recorders.get(session_id)
+
+    def create(self, session_id: int, peername=None, width: int = 80, height: int = 24) -> Recorder:
+        now = time.time()
+        suffix = 'zst' if self._compression == 'zstd' else 'gz'
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        path = os.path.join(self._directory, f'session-{session_id}-{stamp}.cast.{suffix}')
+        if isinstance(peername, (tuple, list)) and len(peername) >= 2:
+            peername = f'{peername[0]}:{peername[1]}'
+        header = {
+            'version': 2,
+            'width': width,
+            'height': height,
+            'timestamp': int(now),
+            'title': f'session {session_id} {peername or ""}'.rstrip(),
+        }
+        recorder = Recorder(self._loop, self._executor, path, self._compression, header,
+                            self._policy, self._max_pending)
+        self._recorders[session_id] = recorder
+        return recorder
+
+    def discard(self, session_id: int) -> Optional[Future]:
+        recorder = self._recorders.pop(session_id, None)
+        if recorder is not None:
+            return recorder.close()
+        return None
+
+    async def close(self) -> None:
+        closing = [recorder.close() for recorder in self._recorders.values()]
+        self._recorders.clear()
+        await gather(*closing, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+
+
+def _open_text(path: str) -> io.TextIOBase:
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('Reading zstd recordings needs the zstandard package')
+        raw = open(path, 'rb')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True),
+                                encoding='utf-8')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+class RecordingReader:
+    """
+    Streams a recording back one event at a time, the file is
+    decompressed as it is iterated and never loaded as a whole.
+    """
+
+    def __init__(self, path: str):
+        self._file = _open_text(path)
+        self.header: Dict = json.loads(self._file.readline())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self) -> Iterator[Event]:
+        for line in self._file:
+            if line.strip():
+                t, kind, data = json.loads(line)
+                yield Event(t, kind, data)
+
+    def output(self) -> Iterator[str]:
+        """Just the session output, in order"""
+        return (event.data for event in self if event.kind == OUTPUT)
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_address, ip_network
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+IPAddress = Union[IPv4Address, IPv6Address, str]
+
+# Session states kept by the registry
+CONNECTED = 'connected'
+ACTIVE = 'active'
+
+# Prefix lengths addresses are bucketed by for network lookups
+V4_BUCKET = 16
+V6_BUCKET = 48
+
+
+def _host_of(peername) -> IPAddress:
+    """Parsed address of a peername tuple, the raw value if it is none"""
+    host = peername[0] if isinstance(peername, (tuple, list)) and peername else peername
+    try:
+        return ip_address(host)
+    except ValueError:
+        return '' if host is None else str(host)
+
+
+def _bucket_of(host: IPAddress) -> Optional[Tuple[int, int]]:
+    if isinstance(host, str):
+        return None
+    if host.version == 4:
+        return 4, int(host) >> (32 - V4_BUCKET)
+    return 6, int(host) >> (128 - V6_BUCKET)
+
+
+def _index_add(index: Dict, key, session_id: int) -> None:
+    ids = index.get(key)
+    if ids is None:
+        index[key] = {session_id}
+    else:
+        ids.add(session_id)
+
+
+def _index_discard(index: Dict, key, session_id: int) -> None:
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(session_id)
+        if not ids:
+            del index[key]
+
+
+class _Entry:
+    __slots__ = ('session', 'host', 'listener_id', 'state', 'tags')
+
+    def __init__(self, session, host: IPAddress, listener_id: int, state: str):
+        self.session = session
+        self.host: IPAddress = host
+        self.listener_id: int = listener_id
+        self.state: str = state
+        self.tags: Set[str] = set()
+
+
+class SessionRegistry:
+    """
+    Sessions indexed by id, peer address, listener id, state and tag.
+
+    Adding, removing and re-indexing a session is O(1), every index
+    keeps sets of session ids so counts are len() calls. Addresses are
+    additionally bucketed by /16 (IPv4) and /48 (IPv6) prefix, a
+    network lookup only visits the buckets that overlap the network.
+    """
+    __slots__ = ('_entries', '_by_host', '_by_bucket', '_by_listener', '_by_state', '_by_tag')
+
+    def __init__(self):
+        self._entries: Dict[int, _Entry] = {}
+        self._by_host: Dict[IPAddress, Set[int]] = {}
+        self._by_bucket: Dict[Tuple[int, int], Set[IPAddress]] = {}
+        self._by_listener: Dict[int, Set[int]] = {}
+        self._by_state: Dict[str, Set[int]] = {}
+        self._by_tag: Dict[str, Set[int]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, session_id) -> bool:
+        return session_id in self._entries
+
+    def __iter__(self) -> Iterator:
+        return (entry.session for entry in self._entries.values())
+
+    def ids(self) -> List[int]:
+        return list(self._entries)
+
+    def get(self, session_id: int | None):
+        entry = self._entries.get(session_id)
+        return None if entry is None else entry.session
+
+    def add(self, session, peername, listener_id: int, state: str = CONNECTED) -> None:
+        session_id = session.session_id
+        if session_id in self._entries:
+            self.remove(session_id)
+        host = _host_of(peername)
+        self._entries[session_id] = _Entry(session, host, listener_id, state)
+        if host not in self._by_host:
+            bucket = _bucket_of(host)
+            if bucket is not None:
+                self._by_bucket.setdefault(bucket, set()).add(host)
+        _index_add(self._by_host, host, session_id)
+        _index_add(self._by_listener, listener_id, session_id)
+        _index_add(self._by_state, state, session_id)
+
+    def remove(self, session_id: int):
+        """Drop the session from all indexes, returns it or None"""
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return None
+        host = entry.host
+        _index_discard(self._by_host, host, session_id)
+        if host not in self._by_host:
+            bucket = _bucket_of(host)
+            if bucket is not None:
+                _index_discard(self._by_bucket, bucket, host)
+        _index_discard(self._by_listener, entry.listener_id, session_id)
+        _index_discard(self._by_state, entry.state, session_id)
+        for tag in entry.tags:
+            _index_discard(self._by_tag, tag, session_id)
+        return entry.session
+
+    def set_state(self, session_id: int, state: str) -> None:
+        entry = self._entries.get(session_id)
+        if entry is None or entry.state == state:
+            return
+        _index_discard(self._by_state, entry.state, session_id)
+        entry.state = state
+        _index_add(self._by_state, state, session_id)
+
+    def state_of(self, session_id: int) -> Optional[str]:
+        entry = self._entries.get(session_id)
+        return None if entry is None else entry.state
+
+    def listener_of(self, session_id: int) -> Optional[int]:
+        entry = self._entries.get(session_id)
+        return None if entry is None else entry.listener_id
+
+    def tag(self, session_id: int, *tags: str) -> None:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return
+        for tag in tags:
+            if tag not in entry.tags:
+                entry.tags.add(tag)
+                _index_add(self._by_tag, tag, session_id)
+
+    def untag(self, session_id: int, *tags: str) -> None:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return
+        for tag in tags:
+            if tag in entry.tags:
+                entry.tags.discard(tag)
+                _index_discard(self._by_tag, tag, session_id)
+
+    def tags_of(self, session_id: int) -> Set[str]:
+        entry = self._entries.get(session_id)
+        return set() if entry is None else set(entry.tags)
+
+    def by_listener(self, listener_id: int) -> Set[int]:
+        return set(self._by_listener.get(listener_id, ()))
+
+    def by_state(self, state: str) -> Set[int]:
+        return set(self._by_state.get(state, ()))
+
+    def by_tag(self, tag: str) -> Set[int]:
+        return set(self._by_tag.get(tag, ()))
+
+    def by_host(self, host) -> Set[int]:
+        return set(self._by_host.get(_host_of(host), ()))
+
+    def by_network(self, network: Union[str, IPv4Network, IPv6Network]) -> Set[int]:
+        """Ids of sessions whose peer address lies in ``network``"""
+        if isinstance(network, str):
+            network = ip_network(network, strict=False)
+        if network.version == 4:
+            bucket_len, width = V4_BUCKET, 32
+        else:
+            bucket_len, width = V6_BUCKET, 128
+        result: Set[int] = set()
+        if network.prefixlen >= bucket_len:
+            buckets = [(network.version, int(network.network_address) >> (width - bucket_len))]
+        else:
+            # Walk the buckets that exist, there are never more than hosts
+            prefix = int(network.network_address) >> (width - network.prefixlen)
+            shift = bucket_len - network.prefixlen
+            buckets = [
+                key for key in self._by_bucket
+                if key[0] == network.version and key[1] >> shift == prefix
+            ]
+        # Buckets inside a wider network need no per host check
+        covered = network.prefixlen <= bucket_len
+        for bucket in buckets:
+            for host in self._by_bucket.get(bucket, ()):
+                if covered or host in network:
+                    result |= self._by_host[host]
+        return result
+
+    def count(
+            self,
+            state: str | None = None,
+            listener_id: int | None = None,
+            tag: str | None = None,
+    ) -> int:
+        """
+        Sessions matching all given filters. A single filter is a
+        len() of its index, combinations intersect the smallest sets.
+        """
+        sets = []
+        if state is not None:
+            sets.append(self._by_state.get(state, ()))
+        if listener_id is not None:
+            sets.append(self._by_listener.get(listener_id, ()))
+        if tag is not None:
+            sets.append(self._by_tag.get(tag, ()))
+        if not sets:
+            return len(self._entries)
+        if len(sets) == 1:
+            return len(sets[0])
+        sets.sort(key=len)
+        smallest, rest = sets[0], sets[1:]
+        return sum(1 for sid in smallest if all(sid in ids for ids in rest))
+
+    def counts_by_state(self) -> Dict[str, int]:
+        return {state: len(ids) for state, ids in self._by_state.items()}
+
+    def counts_by_listener(self) -> Dict[int, int]:
+        return {listener_id: len(ids) for listener_id, ids in self._by_listener.items()}
+
+    def select(self, session_ids: Iterable[int]) -> List:
+        """Sessions for the ids that are registered, in the given order"""
+        entries = self._entries
+        return [entries[sid].session for sid in session_ids if sid in entries]
+
+    def clear(self) -> None:
+        for index in (self._entries, self._by_host, self._by_bucket,
+                      self._by_listener, self._by_state, self._by_tag):
+            index.clear()
@@ -0,0 +1,498 @@
+import os
+import shutil
+import tempfile
+from asyncio import AbstractEventLoop
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from mmap import mmap, ACCESS_READ
+from typing import Callable, Deque, List, Optional
+
+# In-memory tail kept per session before it's spilled to disk
+TAIL_SIZE = 256 * 1024
+# Segment files are rolled over once they reach this size
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Shared memory cap for all in-memory tails
+MEMORY_LIMIT = 64 * 1024 * 1024
+# Line count is checkpointed about every LINE_MARK_SIZE bytes, lines in
+# between are found by scanning forward from the checkpoint
+LINE_MARK_SIZE = 64 * 1024
+# Closed sessions whose scrollback is kept for viewing and search, older
+# ones are discarded along with their segment files
+CLOSED_SESSIONS = 64
+
+
+class ScrollbackBudget:
+    """
+    Global memory cap for the in-memory tails of all Scrollback stores.
+
+    Stores are kept in least recently appended order. Whenever the total
+    goes above ``max_memory`` the quietest stores spill their tail to disk
+    first, so busy sessions keep their recent output in memory. Stores of
+    the last ``max_closed`` closed sessions are kept without open files.
+
+    With a ``loop``, segment files are written, closed and removed by a
+    single writer thread, in the order stores asked for it. Without one
+    that happens right away, on the calling thread.
+    """
+
+    __slots__ = ('_max_memory', '_used', '_stores', '_spill_dir', '_max_closed', '_closed',
+                 '_loop', '_executor')
+
+    def __init__(
+            self,
+            max_memory: int = MEMORY_LIMIT,
+            spill_dir: str = None,
+            max_closed: int = CLOSED_SESSIONS,
+            loop: AbstractEventLoop | None = None,
+    ):
+        self._max_memory: int = max_memory
+        self._used: int = 0
+        self._stores: OrderedDict[int, 'Scrollback'] = OrderedDict()
+        self._spill_dir: Optional[str] = spill_dir
+        self._max_closed: int = max_closed
+        # Closed sessions in the order they closed
+        self._closed: OrderedDict[int, None] = OrderedDict()
+        self._loop: Optional[AbstractEventLoop] = loop
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __len__(self):
+        return len(self._stores)
+
+    def __iter__(self):
+        return iter(self._stores.values())
+
+    @property
+    def max_memory(self) -> int:
+        return self._max_memory
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    @property
+    def spill_dir(self) -> str:
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='asscat-scrollback-')
+        return self._spill_dir
+
+    def create(self, session_id: int, tail_size: int = TAIL_SIZE) -> 'Scrollback':
+        store = Scrollback(session_id, self, tail_size)
+        self._stores[session_id] = store
+        return store
+
+    def get(self, session_id: int) -> Optional['Scrollback']:
+        return self._stores.get(session_id)
+
+    def _charge(self, store: 'Scrollback', size: int) -> None:
+        self._used += size
+        self._stores.move_to_end(store.session_id)
+        if self._used > self._max_memory:
+            self._reclaim()
+
+    def _credit(self, size: int) -> None:
+        self._used -= size
+
+    def _submit(self, func: Callable, *args, done: Callable = None) -> None:
+        """
+        Run ``func`` in the writer thread, then ``done`` with the exception
+        it raised or None on the loop
+        """
+        if self._loop is None:
+            func(*args)
+            if done is not None:
+                done(None)
+            return
+        if self._executor is None:
+            # One thread, so writes to a segment land in order
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='asscat-scrollback')
+        fut = self._loop.run_in_executor(self._executor, func, *args)
+        if done is not None:
+            fut.add_done_callback(lambda f: done(f.exception()))
+
+    def _reclaim(self) -> None:
+        for store in list(self._stores.values()):
+            if self._used <= self._max_memory:
+                break
+            store.spill()
+
+    def retire(self, session_id: int) -> List[int]:
+        """
+        Keep the store of a closed session, with its tail spilled and its
+        files closed. Returns the sessions discarded to stay within
+        ``max_closed``.
+        """
+        store = self._stores.get(session_id)
+        if store is None:
+            return []
+        store.retire()
+        closed = self._closed
+        closed[session_id] = None
+        discarded = []
+        while len(closed) > self._max_closed:
+            oldest, _ = closed.popitem(last=False)
+            self.discard(oldest)
+            discarded.append(oldest)
+        return discarded
+
+    def discard(self, session_id: int) -> None:
+        self._closed.pop(session_id, None)
+        store = self._stores.pop(session_id, None)
+        if store is not None:
+            store.close()
+
+    def close(self) -> None:
+        for store in self._stores.values():
+            store.close()
+        self._stores.clear()
+        self._closed.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+
+class _Segment:
+    """
+    One segment file. ``write()``, ``close_file()`` and ``remove()`` run
+    in the writer thread, the rest on the loop. Mappings are made from
+    a file opened just for that, so the write end is the only fd kept.
+    """
+    __slots__ = ('path', 'start', 'size', 'written', 'failed', '_file', '_map', '_map_size')
+
+    def __init__(self, path: str, start: int):
+        self.path: str = path
+        self.start: int = start
+        # Bytes spilled into the segment, ``written`` of them are on disk
+        self.size: int = 0
+        self.written: int = 0
+        # A write failed, later writes would land at the wrong offset
+        self.failed: bool = False
+        self._file = None
+        self._map: Optional[mmap] = None
+        self._map_size: int = 0
+
+    @property
+    def mapped(self) -> int:
+        return self._map_size if self._map is not None else 0
+
+    def write(self, data) -> None:
+        if self.failed:
+            raise OSError(f'Earlier write to {self.path} failed')
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'ab', buffering=0)
+            self._file.write(data)
+        except OSError:
+            self.failed = True
+            raise
+
+    def close_file(self) -> None:
+        """Close the write end, the next write reopens it"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self) -> None:
+        self.close_file()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def view(self) -> mmap:
+        # A segment that is still written to outgrows its mapping
+        if self._map is None or self._map_size != self.written:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, 'rb') as f:
+                self._map = mmap(f.fileno(), self.written, access=ACCESS_READ)
+            self._map_size = self.written
+        return self._map
+
+    def unmap(self) -> None:
+        """Drop the mapping, the next read maps the file again"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class Scrollback:
+    """
+    Append-only output history of one session.
+
+    The newest output stays in a bounded in-memory tail. Older output is
+    appended to segment files and read back through mmap. Spilled output
+    stays readable from memory until the writer thread wrote it, only the
+    newest segment keeps its file open. Offsets are
+    absolute byte positions since the session started, lines are counted
+    from zero. Appending is O(1) amortized, reads find their segment by
+    bisection and lines through sparse (offset, line count) checkpoints.
+    """
+
+    __slots__ = ('_session_id', '_budget', '_tail_size', '_tail', '_tail_start',
+                 '_pending', '_pending_start', '_pending_size', '_mapped',
+                 '_segments', '_seg_starts', '_lines', '_mark_offsets', '_mark_lines',
+                 '_retired', '_closed')
+
+    def __init__(self, session_id: int, budget: ScrollbackBudget, tail_size: int = TAIL_SIZE):
+        self._session_id: int = session_id
+        self._budget: ScrollbackBudget = budget
+        self._tail_size: int = tail_size
+        self._tail: bytearray = bytearray()
+        self._tail_start: int = 0
+        # Spilled tails not written yet, they start at ``_pending_start``
+        self._pending: Deque[bytearray] = deque()
+        self._pending_start: int = 0
+        self._pending_size: int = 0
+        # Segment last read from, the only one kept mapped
+        self._mapped: Optional[_Segment] = None
+        self._segments: List[_Segment] = []
+        self._seg_starts: List[int] = []
+        self._lines: int = 0
+        # Number of complete lines before ``_mark_offsets[i]``
+        self._mark_offsets: List[int] = [0]
+        self._mark_lines: List[int] = [0]
+        # The session closed, segments are closed again after each read
+        self._retired: bool = False
+        self._closed: bool = False
+
+    def __len__(self):
+        return self._tail_start + len(self._tail)
+
+    def __repr__(self):
+        return (f'<Scrollback session={self._session_id} size={len(self)} '
+                f'lines={self.line_count} in_memory={len(self._tail)} '
+                f'segments={len(self._segments)}>')
+
+    @property
+    def session_id(self) -> int:
+        return self._session_id
+
+    @property
+    def memory_usage(self) -> int:
+        return len(self._tail) + self._pending_size
+
+    @property
+    def mapped(self) -> int:
+        """Bytes of segment files currently mapped for reading"""
+        return sum(segment.mapped for segment in self._segments)
+
+    @property
+    def line_count(self) -> int:
+        """Number of lines, including an unterminated last line"""
+        size = len(self)
+        if not size:
+            return 0
+        return self._lines + (self._last_byte() != 0x0a)
+
+    def _last_byte(self) -> int:
+        if self._tail:
+            return self._tail[-1]
+        return self.read(len(self) - 1, 1)[0]
+
+    def append(self, data) -> None:
+        if self._closed or not data:
+            return
+        start = len(self)
+        if start - self._mark_offsets[-1] >= LINE_MARK_SIZE:
+            self._mark_offsets.append(start)
+            self._mark_lines.append(self._lines)
+        # Counted in the tail, data may be a memoryview without count()
+        tail = self._tail
+        mark = len(tail)
+        tail += data
+        self._lines += tail.count(b'\n', mark)
+        self._budget._charge(self, len(data))
+        if len(self._tail) > self._tail_size:
+            self.spill()
+
+    def spill(self) -> None:
+        """Hand the in-memory tail to the writer thread"""
+        tail = self._tail
+        if not tail or self._closed:
+            return
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or segment.size >= SEGMENT_SIZE or segment.failed:
+            segment = self._new_segment()
+        size = len(tail)
+        segment.size += size
+        self._pending.append(tail)
+        self._pending_size += size
+        self._tail_start += size
+        self._tail = bytearray()
+        self._budget._credit(size)
+        self._budget._submit(segment.write, tail, done=lambda exc: self._written(segment, size, exc))
+
+    def _written(self, segment: _Segment, size: int, exc: Optional[BaseException]) -> None:
+        if self._closed:
+            return
+        self._pending.popleft()
+        self._pending_size -= size
+        self._pending_start += size
+        if exc is None:
+            segment.written += size
+        else:
+            # What did not make it to disk is skipped by reads
+            segment.failed = True
+
+    def release(self) -> None:
+        """
+        Spill the tail, unmap all segments and close the open one, for
+        sessions that went quiet. Reading them again maps the segments
+        again.
+        """
+        self.spill()
+        for segment in self._segments:
+            segment.unmap()
+        self._mapped = None
+        if self._segments:
+            self._budget._submit(self._segments[-1].close_file)
+
+    def retire(self) -> None:
+        """Release everything for good, the session closed"""
+        self.release()
+        self._retired = True
+
+    def _new_segment(self) -> _Segment:
+        if self._segments:
+            # Full, only read from now on
+            self._budget._submit(self._segments[-1].close_file)
+        name = f'{self._session_id}-{len(self._segments):05d}.seg'
+        segment = _Segment(os.path.join(self._budget.spill_dir, name), self._tail_start)
+        self._segments.append(segment)
+        self._seg_starts.append(segment.start)
+        return segment
+
+    def _view(self, segment: _Segment) -> mmap:
+        """
+        Map ``segment`` and unmap the one read before, every mapping holds
+        an fd. Closed sessions keep none mapped.
+        """
+        mapped = self._mapped
+        if mapped is not None and mapped is not segment:
+            mapped.unmap()
+        self._mapped = segment
+        return segment.view()
+
+    def _unmap_retired(self) -> None:
+        mapped = self._mapped
+        if self._retired and mapped is not None:
+            mapped.unmap()
+            self._mapped = None
+
+    def read(self, offset: int, size: int = -1) -> bytes:
+        """Return up to ``size`` bytes starting at absolute ``offset``"""
+        total = len(self)
+        if offset < 0:
+            offset = max(0, total + offset)
+        end = total if size < 0 else min(total, offset + size)
+        if offset >= end:
+            return b''
+        parts = []
+        pos = offset
+        durable = self._pending_start
+        if pos < durable:
+            idx = bisect_right(self._seg_starts, pos) - 1
+            while pos < end and pos < durable and idx < len(self._segments):
+                segment = self._segments[idx]
+                lo = pos - segment.start
+                hi = min(segment.written, end - segment.start)
+                if lo < hi:
+                    parts.append(self._view(segment)[lo:hi])
+                # Output lost to a failed write is skipped
+                stop = segment.size if segment.failed else segment.written
+                pos = min(durable, segment.start + min(stop, end - segment.start))
+                idx += 1
+            self._unmap_retired()
+        if pos < end and pos < self._tail_start:
+            base = self._pending_start
+            for chunk in self._pending:
+                chunk_end = base + len(chunk)
+                if chunk_end > pos:
+                    hi = min(end, chunk_end)
+                    parts.append(bytes(chunk[pos - base:hi - base]))
+                    pos = hi
+                    if pos >= end:
+                        break
+                base = chunk_end
+        if pos < end:
+            parts.append(bytes(self._tail[pos - self._tail_start:end - self._tail_start]))
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def _find_newline(self, offset: int) -> int:
+        """Absolute offset of the next b'\\n' at or after ``offset``, or -1"""
+        if offset < self._pending_start:
+            idx = bisect_right(self._seg_starts, offset) - 1
+            try:
+                for segment in self._segments[idx:]:
+                    lo = max(0, offset - segment.start)
+                    if lo >= segment.written:
+                        continue
+                    i = self._view(segment).find(b'\n', lo)
+                    if i != -1:
+                        return segment.start + i
+            finally:
+                self._unmap_retired()
+        if offset < self._tail_start:
+            base = self._pending_start
+            for chunk in self._pending:
+                if base + len(chunk) > offset:
+                    i = chunk.find(b'\n', max(0, offset - base))
+                    if i != -1:
+                        return base + i
+                base += len(chunk)
+        i = self._tail.find(b'\n', max(0, offset - self._tail_start))
+        return -1 if i == -1 else self._tail_start + i
+
+    def line_offset(self, line: int) -> int:
+        """Absolute byte offset where ``line`` starts"""
+        if line < 0:
+            line += self.line_count
+        if not 0 <= line < max(1, self.line_count):
+            raise IndexError('line out of range')
+        if not line:
+            return 0
+        # Closest checkpoint with fewer complete lines, so ``line`` starts
+        # after one of the newlines following it.
+        idx = bisect_left(self._mark_lines, line) - 1
+        offset = self._mark_offsets[idx]
+        for _ in range(line - self._mark_lines[idx]):
+            offset = self._find_newline(offset) + 1
+        return offset
+
+    def line_at(self, offset: int) -> int:
+        """Line the byte at absolute ``offset`` is on"""
+        idx = bisect_right(self._mark_offsets, offset) - 1
+        mark = self._mark_offsets[idx]
+        return self._mark_lines[idx] + self.read(mark, offset - mark).count(b'\n')
+
+    def lines(self, start: int, count: int = 1) -> List[bytes]:
+        """Return ``count`` lines starting at line ``start`` with line endings"""
+        result = []
+        if not len(self):
+            return result
+        offset = self.line_offset(start)
+        for _ in range(count):
+            if offset >= len(self):
+                break
+            end = self._find_newline(offset)
+            end = len(self) if end == -1 else end + 1
+            result.append(self.read(offset, end - offset))
+            offset = end
+        return result
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._budget._credit(len(self._tail))
+        self._tail = bytearray()
+        self._pending.clear()
+        self._pending_size = 0
+        self._mapped = None
+        for segment in self._segments:
+            segment.unmap()
+            self._budget._submit(segment.remove)
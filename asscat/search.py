@@ -0,0 +1,424 @@
+from __future__ import annotations
+
+import re
+import sys
+from array import array
+from asyncio import AbstractEventLoop, TimerHandle
+from bisect import bisect_left
+from collections import deque
+from typing import Deque, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+# Output is indexed in blocks of this size, a hit in the index means
+# the block is read back from the scrollback and searched
+BLOCK_SIZE = 16 * 1024
+# Bytes before a block that are indexed with it, patterns up to this
+# long are found where they cross a block boundary
+OVERLAP = 256
+# Blocks per index segment, segments are evicted as a whole
+SEGMENT_BLOCKS = 256
+# Memory the index may use, oldest segments are evicted beyond
+INDEX_MEMORY = 64 * 1024 * 1024
+# Seconds between two looks for new output
+INDEX_DELAY = 0.25
+# Seconds indexing may hold the loop before it yields to I/O
+SLICE_TIME = 0.005
+# Bytes of the matching line kept in a hit
+LINE_LIMIT = 200
+
+# Rough bytes per distinct trigram in a segment that's still filled,
+# the dict slot, the key and a small postings array
+_KEY_COST = 160
+
+
+class SearchHit(NamedTuple):
+    session_id: int
+    offset: int
+    line: int
+    text: bytes
+
+
+class IndexStats(NamedTuple):
+    segments: int
+    blocks: int
+    indexed: int
+    evicted: int
+    memory: int
+
+
+def _trigrams(text: bytes) -> Set[int]:
+    """Distinct trigrams of ``text`` as ints"""
+    return {(a << 16) | (b << 8) | c for a, b, c in set(zip(text, text[1:], text[2:]))}
+
+
+# Characters with a meaning of their own in a pattern, a lone } is not
+_SPECIAL = frozenset(b'.^$*+?{[]()|\\')
+_REPEAT = re.compile(rb'\{(\d*)(,?)(\d*)\}')
+_VERBOSE = re.compile(rb'\(\?[aiLmsu-]*x')
+
+
+def _skip_class(pattern: bytes, i: int) -> int:
+    """Index past the character class opening at ``pattern[i]``"""
+    i += 1
+    if pattern[i:i + 1] == b'^':
+        i += 1
+    if pattern[i:i + 1] == b']':
+        i += 1
+    while pattern[i] != 0x5d:
+        i += 2 if pattern[i] == 0x5c else 1
+    return i + 1
+
+
+def _skip_group(pattern: bytes, i: int) -> int:
+    """Index past the group opening at ``pattern[i]``"""
+    depth = 0
+    while True:
+        c = pattern[i]
+        if c == 0x5c:
+            i += 2
+            continue
+        if c == 0x5b:
+            i = _skip_class(pattern, i)
+            continue
+        i += 1
+        if c == 0x28:
+            depth += 1
+        elif c == 0x29:
+            depth -= 1
+            if not depth:
+                return i
+
+
+def _literal(pattern: bytes, flags: int) -> bytes:
+    """
+    Longest run of plain characters a match of ``pattern`` must contain.
+
+    Scans the source of the pattern instead of parsing it, only runs
+    outside of groups and classes count. Anything it can't follow gives
+    b'', the pattern is then searched without the index.
+    """
+    if flags & re.VERBOSE or _VERBOSE.search(pattern):
+        return b''
+    best, run = b'', bytearray()
+    i, size = 0, len(pattern)
+    try:
+        while i < size:
+            c = pattern[i]
+            if c not in _SPECIAL:
+                run.append(c)
+                i += 1
+                continue
+            if c == 0x5c:
+                escaped = pattern[i + 1]
+                i += 2
+                if not chr(escaped).isalnum():
+                    run.append(escaped)
+                    continue
+                if escaped == 0x78 or chr(escaped).isdigit():
+                    # Hex, octal and backreferences run on for more digits
+                    return b''
+            elif c == 0x7c:
+                # Alternatives at the top, no run is certain to match
+                return b''
+            elif c == 0x7b:
+                repeat = _REPEAT.match(pattern, i)
+                if repeat is None:
+                    run.append(c)
+                    i += 1
+                    continue
+                i = repeat.end()
+                if run and int(repeat.group(1) or 0) == 0:
+                    run.pop()
+            elif c in b'*?':
+                # The previous character may not be there at all
+                if run:
+                    run.pop()
+                i += 1
+            elif c == 0x5b:
+                i = _skip_class(pattern, i)
+            elif c == 0x28:
+                i = _skip_group(pattern, i)
+            else:
+                # + keeps the character it repeats, but what follows does
+                # not come right after it
+                i += 1
+            if len(run) > len(best):
+                best = bytes(run)
+            run = bytearray()
+    except IndexError:
+        return b''
+    if len(run) > len(best):
+        best = bytes(run)
+    return best
+
+
+class _Segment:
+    """
+    Inverted index from trigrams to the blocks of up to SEGMENT_BLOCKS
+    blocks. Filled through a dict, then sealed into sorted arrays that
+    take a fraction of its memory.
+    """
+    __slots__ = ('sessions', 'starts', 'ends', 'text_size', 'memory_usage',
+                 '_postings', '_keys', '_offsets', '_ids')
+
+    def __init__(self):
+        self.sessions: array = array('L')
+        self.starts: array = array('Q')
+        self.ends: array = array('Q')
+        self.text_size: int = 0
+        self.memory_usage: int = 0
+        self._postings: Optional[Dict[int, array]] = {}
+        self._keys: Optional[array] = None
+        self._offsets: Optional[array] = None
+        self._ids: Optional[array] = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @property
+    def sealed(self) -> bool:
+        return self._postings is None
+
+    def add(self, session_id: int, start: int, end: int, keys: Iterable[int]) -> None:
+        block = len(self.sessions)
+        self.sessions.append(session_id)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.text_size += end - start
+        postings = self._postings
+        added = 0
+        for key in keys:
+            ids = postings.get(key)
+            if ids is None:
+                ids = postings[key] = array('H')
+                self.memory_usage += _KEY_COST
+            ids.append(block)
+            added += 1
+        self.memory_usage += 2 * added + 20
+
+    def seal(self) -> None:
+        postings = self._postings
+        if postings is None:
+            return
+        keys = sorted(postings)
+        offsets = array('L', [0])
+        ids = array('H')
+        for key in keys:
+            ids.extend(postings[key])
+            offsets.append(len(ids))
+        self._keys = array('L', keys)
+        self._offsets = offsets
+        self._ids = ids
+        self._postings = None
+        self.memory_usage = sum(sys.getsizeof(a) for a in (
+            self._keys, offsets, ids, self.sessions, self.starts, self.ends))
+
+    def _posting(self, key: int):
+        postings = self._postings
+        if postings is not None:
+            return postings.get(key, ())
+        keys = self._keys
+        i = bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return ()
+        return self._ids[self._offsets[i]:self._offsets[i + 1]]
+
+    def candidates(self, keys: Iterable[int]) -> List[int]:
+        """Blocks that have all ``keys``"""
+        postings = sorted((self._posting(key) for key in keys), key=len)
+        if not postings or not postings[0]:
+            return []
+        blocks = set(postings[0])
+        for ids in postings[1:]:
+            blocks.intersection_update(ids)
+            if not blocks:
+                break
+        return sorted(blocks)
+
+
+class SearchIndex:
+    """
+    Trigram index over the scrollback of all sessions.
+
+    Nothing is added on the receive path: every INDEX_DELAY seconds the
+    index reads the blocks sessions completed since from their
+    scrollback, lowercased, in slices of at most SLICE_TIME seconds and
+    one block per session in turn. Blocks go into the newest segment
+    until it's full and sealed. Once the index uses more than
+    ``max_memory`` the oldest segments are dropped, their output is then
+    no longer found.
+
+    Searches look up the trigrams of a literal, or of the longest
+    literal run of a regex, to find candidate blocks and search those in
+    the scrollback. Output not in a block yet is searched directly.
+    Hits point at the session and the absolute scrollback offset.
+    """
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            scrollbacks,
+            max_memory: int = INDEX_MEMORY,
+            block_size: int = BLOCK_SIZE,
+    ):
+        self._loop: AbstractEventLoop = loop
+        self._scrollbacks = scrollbacks
+        self._max_memory: int = max_memory
+        self._block_size: int = block_size
+        self._segments: Deque[_Segment] = deque([_Segment()])
+        # Offset up to which each session's output is indexed
+        self._indexed: Dict[int, int] = {}
+        self._sealed_memory: int = 0
+        self._evicted: int = 0
+        self._handle: Optional[TimerHandle] = None
+
+    @property
+    def memory_usage(self) -> int:
+        return self._sealed_memory + self._segments[-1].memory_usage
+
+    def stats(self) -> IndexStats:
+        return IndexStats(
+            len(self._segments), sum(len(s) for s in self._segments),
+            sum(s.text_size for s in self._segments), self._evicted, self.memory_usage)
+
+    def indexed(self, session_id: int) -> int:
+        return self._indexed.get(session_id, 0)
+
+    def schedule(self) -> None:
+        if self._handle is None:
+            self._handle = self._loop.call_later(INDEX_DELAY, self._run)
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _run(self) -> None:
+        self._handle = None
+        if self.update(SLICE_TIME):
+            # More to do, let I/O run first
+            self._handle = self._loop.call_soon(self._run)
+        elif len(self._scrollbacks):
+            self.schedule()
+
+    def update(self, time_limit: float | None = None) -> bool:
+        """Index completed blocks, returns whether time ran out before all were"""
+        deadline = None if time_limit is None else self._loop.time() + time_limit
+        block_size = self._block_size
+        indexed = self._indexed
+        pending = True
+        while pending:
+            pending = False
+            for scrollback in list(self._scrollbacks):
+                sid = scrollback.session_id
+                start = indexed.get(sid, 0)
+                if len(scrollback) - start < block_size:
+                    continue
+                if deadline is not None and self._loop.time() >= deadline:
+                    return True
+                self._add_block(scrollback, start, start + block_size)
+                indexed[sid] = start + block_size
+                pending = True
+        return False
+
+    def _add_block(self, scrollback, start: int, end: int) -> None:
+        lo = max(0, start - OVERLAP)
+        text = scrollback.read(lo, end - lo).lower()
+        segment = self._segments[-1]
+        segment.add(scrollback.session_id, start, end, _trigrams(text))
+        if len(segment) >= SEGMENT_BLOCKS:
+            segment.seal()
+            self._sealed_memory += segment.memory_usage
+            self._segments.append(_Segment())
+        while self.memory_usage > self._max_memory and len(self._segments) > 1:
+            oldest = self._segments.popleft()
+            self._sealed_memory -= oldest.memory_usage
+            self._evicted += oldest.text_size
+
+    def discard(self, session_id: int) -> None:
+        """Forget where a session was indexed up to, its blocks age out"""
+        self._indexed.pop(session_id, None)
+
+    def search(
+            self,
+            pattern: bytes | str,
+            regex: bool = False,
+            ignore_case: bool = False,
+            session_ids: Iterable[int] | None = None,
+            limit: int = 100,
+    ) -> List[SearchHit]:
+        """
+        Find ``pattern`` in the output of all sessions, or those in
+        ``session_ids``. Regex matches may extend up to OVERLAP bytes
+        beyond the block they start in.
+        """
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        flags = re.IGNORECASE if ignore_case else 0
+        if regex:
+            try:
+                compiled = re.compile(pattern, flags)
+            except re.error as e:
+                raise ValueError(f'Invalid regex: {e}') from e
+            literal = _literal(pattern, flags)
+        else:
+            compiled = re.compile(re.escape(pattern), flags)
+            literal = pattern
+        wanted = None if session_ids is None else set(session_ids)
+        scrollbacks = {s.session_id: s for s in self._scrollbacks
+                       if wanted is None or s.session_id in wanted}
+        hits: Dict[Tuple[int, int], SearchHit] = {}
+
+        literal = literal[:OVERLAP].lower()
+        if len(literal) < 3:
+            # Nothing to look up, every byte has to be searched
+            for sid, scrollback in scrollbacks.items():
+                if not self._scan(scrollback, 0, len(scrollback), compiled, hits, limit):
+                    break
+            return sorted(hits.values())
+
+        keys = _trigrams(literal)
+        for segment in self._segments:
+            for block in segment.candidates(keys):
+                scrollback = scrollbacks.get(segment.sessions[block])
+                if scrollback is None:
+                    continue
+                if not self._scan(scrollback, segment.starts[block] - OVERLAP,
+                                  segment.ends[block], compiled, hits, limit):
+                    return sorted(hits.values())
+        for sid, scrollback in scrollbacks.items():
+            if not self._scan(scrollback, self._indexed.get(sid, 0) - OVERLAP,
+                              len(scrollback), compiled, hits, limit):
+                break
+        return sorted(hits.values())
+
+    @staticmethod
+    def _scan(scrollback, lo: int, hi: int, compiled, hits: Dict, limit: int) -> bool:
+        """Add matches starting in [lo, hi), returns False once ``limit`` is reached"""
+        lo = max(0, lo)
+        chunk = 1024 * 1024
+        sid = scrollback.session_id
+        for start in range(lo, hi, chunk):
+            end = min(hi, start + chunk)
+            base = max(0, start - OVERLAP)
+            text = scrollback.read(base, end + OVERLAP - base)
+            # Line of the first match comes from the scrollback, later
+            # ones count on from there
+            line_no, counted = -1, 0
+            for match in compiled.finditer(text, start - base):
+                offset = base + match.start()
+                if offset >= end:
+                    break
+                if (sid, offset) in hits:
+                    continue
+                if line_no < 0:
+                    line_no = scrollback.line_at(offset)
+                else:
+                    line_no += text.count(b'\n', counted, match.start())
+                counted = match.start()
+                first = text.rfind(b'\n', 0, match.start()) + 1
+                last = text.find(b'\n', match.end())
+                line = text[first:len(text) if last == -1 else last][:LINE_LIMIT]
+                hits[sid, offset] = SearchHit(sid, offset, line_no, line)
+                if len(hits) >= limit:
+                    return False
+        return True
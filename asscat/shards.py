@@ -0,0 +1,542 @@
+from __future__ import annotations
+
+import itertools
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+from asyncio import (
+    AbstractEventLoop,
+    BaseTransport,
+    Future,
+    Protocol,
+    Transport,
+    get_running_loop,
+    wait_for,
+)
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from asscat.latency import KeystrokeLatency
+from asscat.logger import setup_logger
+from asscat.manager import AssCatManager
+from asscat.metrics import SessionStats
+from asscat.protocols import AssCatProtocol
+
+# Session ids of shard N start at (N + 1) << SHARD_ID_SHIFT, which keeps
+# them apart from each other and from sessions of the controller itself.
+SHARD_ID_SHIFT = 32
+
+# Frame header: type, session id, payload length
+HEADER = struct.Struct('!BQI')
+
+HELLO = 1
+OPEN = 2
+CLOSE = 3
+OUTPUT = 4
+INPUT = 5
+ACTIVATE = 6
+DEACTIVATE = 7
+SHUTDOWN = 8
+# Sent once the shard's listener accepts connections, after HELLO
+LISTENING = 9
+
+
+def shard_of(session_id: int) -> Optional[int]:
+    """Shard owning a session id, None for sessions of the controller"""
+    shard = (session_id >> SHARD_ID_SHIFT) - 1
+    return shard if shard >= 0 else None
+
+
+class FrameProtocol(Protocol):
+    """Length prefixed frames over a local stream socket"""
+
+    def __init__(self):
+        self._transport: Optional[Transport] = None
+        self._buffer = bytearray()
+
+    def connection_made(self, transport: BaseTransport) -> None:
+        self._transport = transport
+
+    def send(self, msg_type: int, session_id: int = 0, payload=b'') -> None:
+        transport = self._transport
+        if transport is None or transport.is_closing():
+            return
+        transport.writelines((HEADER.pack(msg_type, session_id, len(payload)), payload))
+
+    def send_json(self, msg_type: int, session_id: int, obj) -> None:
+        self.send(msg_type, session_id, json.dumps(obj).encode())
+
+    def data_received(self, data: bytes) -> None:
+        buf = self._buffer
+        buf += data
+        pos = 0
+        size = len(buf)
+        while size - pos >= HEADER.size:
+            msg_type, session_id, length = HEADER.unpack_from(buf, pos)
+            end = pos + HEADER.size + length
+            if end > size:
+                break
+            self.frame_received(msg_type, session_id, bytes(buf[pos + HEADER.size:end]))
+            pos = end
+        if pos:
+            del buf[:pos]
+
+    def frame_received(self, msg_type: int, session_id: int, payload: bytes) -> None:
+        raise NotImplementedError
+
+
+class _ForwardTransport:
+    """
+    Stands in as stdout transport of the active session in a shard,
+    so AssCatProtocol.data_received forwards output over the link.
+    """
+    __slots__ = ('_link', '_session_id')
+
+    def __init__(self, link: ShardLink, session_id: int):
+        self._link = link
+        self._session_id = session_id
+
+    def write(self, data) -> None:
+        self._link.send(OUTPUT, self._session_id, data)
+
+    def get_write_buffer_size(self) -> int:
+        transport = self._link._transport
+        return transport.get_write_buffer_size() if transport is not None else 0
+
+
+class ShardLink(FrameProtocol):
+    """Worker side of the link to the controller"""
+
+    def __init__(self, manager: ShardManager):
+        super().__init__()
+        self._manager = manager
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self._transport = None
+        self._manager.request_shutdown()
+
+    def pause_writing(self) -> None:
+        # Controller can't keep up, stop reading the forwarded session
+        self._manager.pause_active()
+
+    def resume_writing(self) -> None:
+        self._manager.resume_active()
+
+    def frame_received(self, msg_type: int, session_id: int, payload: bytes) -> None:
+        manager = self._manager
+        if msg_type == INPUT:
+            manager.send_input(session_id, payload)
+        elif msg_type == ACTIVATE:
+            manager.activate(session_id)
+        elif msg_type == DEACTIVATE:
+            manager.deactivate()
+        elif msg_type == SHUTDOWN:
+            manager.request_shutdown()
+
+
+class ShardManager(AssCatManager):
+    """AssCatManager running inside a shard worker process"""
+
+    def __init__(self, shard_id: int, loop: AbstractEventLoop | None = None, **kwargs):
+        super().__init__(loop, **kwargs)
+        self._shard_id: int = shard_id
+        self._link: Optional[ShardLink] = None
+        self._stopped: Future = self._loop.create_future()
+        self._forwarding: Optional[AssCatProtocol] = None
+
+    @property
+    def shard_id(self) -> int:
+        return self._shard_id
+
+    def set_link(self, link: ShardLink) -> None:
+        self._link = link
+
+    def _session_admitted(self, session: AssCatProtocol, peername, held: bytes = b'') -> None:
+        super()._session_admitted(session, peername, held)
+        # Queued or rejected connections are never announced
+        if self._link is not None:
+            self._link.send_json(OPEN, session.session_id, {
+                'peer': list(peername) if peername else None,
+                'shard': self._shard_id,
+                'pid': os.getpid(),
+            })
+
+    def set_active_session(self, session_id: int | None) -> None:
+        """The controller decides which session is active, see activate()"""
+
+    def client_disconnected_cb(self, session_id):
+        admitted = self._sessions.get(session_id) is not None
+        super().client_disconnected_cb(session_id)
+        if self._forwarding is not None and self._forwarding.session_id == session_id:
+            self._forwarding = None
+        if admitted and self._link is not None:
+            self._link.send(CLOSE, session_id)
+
+    def send_input(self, session_id: int, data: bytes) -> None:
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.stdin_data_received(data)
+
+    def activate(self, session_id: int) -> None:
+        self.deactivate()
+        session = self._sessions.get(session_id)
+        if session is None or self._link is None:
+            return
+        session.stdout_connection_made(_ForwardTransport(self._link, session_id))
+        self._forwarding = session
+        self._active_session_id = session_id
+
+    def deactivate(self) -> None:
+        session = self._forwarding
+        if session is not None:
+            session.stdout_connection_made(None)
+        self._forwarding = None
+        self._active_session_id = None
+
+    def pause_active(self) -> None:
+        session = self._forwarding
+        if session is not None and session.transport is not None:
+            session.transport.pause_reading()
+
+    def resume_active(self) -> None:
+        session = self._forwarding
+        if session is not None and session.transport is not None:
+            session.transport.resume_reading()
+
+    def request_shutdown(self) -> None:
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+
+    async def wait_stopped(self) -> None:
+        await self._stopped
+
+
+async def _serve_shard(shard_id: int, host: str, port: int, ipc_path: str, buffered: bool):
+    AssCatProtocol.conn_counter = itertools.count((shard_id + 1) << SHARD_ID_SHIFT)
+    loop = get_running_loop()
+    manager = ShardManager(shard_id, loop, buffered=buffered)
+    _, link = await loop.create_unix_connection(lambda: ShardLink(manager), ipc_path)
+    manager.set_link(link)
+    # The other shards share the port already, sessions may be opened as
+    # soon as the listener starts and OPEN must not overtake HELLO
+    link.send(HELLO, shard_id, str(os.getpid()).encode())
+    l_id, server = await manager.create_listener(host, port)
+    await manager.start_listener(l_id)
+    link.send(LISTENING, shard_id)
+    try:
+        await manager.wait_stopped()
+    finally:
+        await manager.shutdown()
+        for session in list(manager.sessions):
+            if session.transport is not None:
+                session.transport.close()
+
+
+def _shard_main(shard_id: int, host: str, port: int, ipc_path: str, buffered: bool):
+    import uvloop
+    uvloop.run(_serve_shard(shard_id, host, port, ipc_path, buffered))
+
+
+class RemoteSession:
+    """
+    Controller side handle of a session owned by a shard. Exposes the
+    parts of the AssCatProtocol interface the manager and TUI use.
+    """
+    __slots__ = ('_session_id', '_link', '_peername', '_shard_id', '_server_id',
+                 '_stdout_transport', '_scrollback', '_recorder', '_latency', '_loop', '_stats',
+                 '_taps')
+
+    def __init__(self, session_id: int, link: ControllerLink, peername, server_id,
+                 loop: AbstractEventLoop):
+        self._loop: AbstractEventLoop = loop
+        self._stats: SessionStats = SessionStats(loop.time())
+        self._session_id: int = session_id
+        self._link: ControllerLink = link
+        self._peername = peername
+        self._shard_id: int = link.shard_id
+        self._server_id = server_id
+        self._stdout_transport = None
+        self._scrollback = None
+        self._recorder = None
+        self._latency: Optional[KeystrokeLatency] = None
+        self._taps: Optional[Tuple[Callable, ...]] = None
+
+    def __repr__(self):
+        return f'<RemoteSession {self._session_id} shard={self._shard_id} peer={self._peername}>'
+
+    @property
+    def session_id(self) -> int:
+        return self._session_id
+
+    @property
+    def shard_id(self) -> int:
+        return self._shard_id
+
+    @property
+    def server_id(self):
+        return self._server_id
+
+    @property
+    def peername(self):
+        return self._peername
+
+    @property
+    def stats(self) -> SessionStats:
+        """Counted as data passes the link, the shard holds the socket"""
+        return self._stats
+
+    @property
+    def scrollback(self):
+        return self._scrollback
+
+    def set_scrollback(self, scrollback) -> None:
+        self._scrollback = scrollback
+
+    @property
+    def recorder(self):
+        return self._recorder
+
+    def set_recorder(self, recorder) -> None:
+        # The socket lives in the shard, recordings can't pause it
+        self._recorder = recorder
+
+    @property
+    def latency(self) -> Optional[KeystrokeLatency]:
+        return self._latency
+
+    def track_latency(self) -> KeystrokeLatency:
+        # Echo latency includes the hop through the shard, the socket
+        # isn't ours to ask for its round trip time
+        if self._latency is None:
+            self._latency = KeystrokeLatency()
+        return self._latency
+
+    def stdout_connection_made(self, transport) -> None:
+        self._stdout_transport = transport
+
+    def add_tap(self, tap: Callable) -> None:
+        self._taps = (self._taps or ()) + (tap,)
+
+    def remove_tap(self, tap: Callable) -> None:
+        self._taps = tuple(t for t in self._taps or () if t is not tap) or None
+
+    def activate(self) -> None:
+        self._link.send(ACTIVATE, self._session_id)
+
+    def deactivate(self) -> None:
+        self._link.send(DEACTIVATE, self._session_id)
+
+    def data_received(self, data: bytes) -> None:
+        stats = self._stats
+        stats.bytes_in += len(data)
+        stats.chunks_in += 1
+        stats.last_data = self._loop.time()
+        scrollback = self._scrollback
+        if scrollback is not None:
+            scrollback.append(data)
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.output(data)
+        latency = self._latency
+        if latency is not None:
+            latency.received()
+        stdout = self._stdout_transport
+        if stdout is not None:
+            stdout.write(data)
+        taps = self._taps
+        if taps is not None:
+            for tap in taps:
+                tap(data)
+
+    def stdin_data_received(self, data: bytes) -> None:
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.input(data)
+        self._link.send(INPUT, self._session_id, data)
+        stats = self._stats
+        stats.bytes_out += len(data)
+        stats.chunks_out += 1
+        latency = self._latency
+        if latency is not None:
+            latency.sent(data)
+
+
+class ControllerLink(FrameProtocol):
+    """Controller side of the link to one shard worker"""
+
+    def __init__(self, controller: ShardController):
+        super().__init__()
+        self._controller = controller
+        self._shard_id: Optional[int] = None
+        self._sessions: Dict[int, RemoteSession] = {}
+
+    @property
+    def shard_id(self) -> Optional[int]:
+        return self._shard_id
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self._transport = None
+        manager = self._controller.manager
+        for session_id in list(self._sessions):
+            manager.client_disconnected_cb(session_id)
+        self._sessions.clear()
+        self._controller.link_lost(self)
+
+    def frame_received(self, msg_type: int, session_id: int, payload: bytes) -> None:
+        if msg_type == OUTPUT:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.data_received(payload)
+        elif msg_type == OPEN:
+            info = json.loads(payload)
+            peer = tuple(info['peer']) if info['peer'] else None
+            session = RemoteSession(session_id, self, peer, self._controller.listener_id,
+                                    self._controller.loop)
+            self._sessions[session_id] = session
+            self._controller.manager.client_connected_cb(session, peer)
+        elif msg_type == CLOSE:
+            if self._sessions.pop(session_id, None) is not None:
+                self._controller.manager.client_disconnected_cb(session_id)
+        elif msg_type == HELLO:
+            self._shard_id = session_id
+            self._controller.link_ready(self)
+        elif msg_type == LISTENING:
+            self._controller.link_listening(self)
+
+
+class ShardController:
+    """
+    Runs ``workers`` processes that each bind host:port with SO_REUSEPORT
+    on their own event loop, so the kernel spreads accepts over them.
+    Workers report sessions over a Unix socket link. Output is only
+    forwarded for the session that is active in the controlling manager.
+    """
+
+    def __init__(
+            self,
+            manager: AssCatManager,
+            listener_id: int,
+            host: str,
+            port: int,
+            workers: int,
+            buffered: bool = False,
+    ):
+        self._manager = manager
+        self._loop: AbstractEventLoop = manager._loop
+        self._listener_id = listener_id
+        self._host = host
+        self._port = port
+        self._workers = workers
+        self._buffered = buffered
+        self._ipc_dir: Optional[str] = None
+        self._ipc_server = None
+        self._processes: List[multiprocessing.Process] = []
+        self._links: Dict[int, ControllerLink] = {}
+        # Shards whose listener accepts connections
+        self._listening: Set[int] = set()
+        self._ready: Optional[Future] = None
+        self._logger = setup_logger(__name__)
+
+    def __repr__(self):
+        return (f'<ShardController {self._host}:{self._port} '
+                f'workers={self._workers} ready={len(self._listening)}>')
+
+    @property
+    def manager(self) -> AssCatManager:
+        return self._manager
+
+    @property
+    def listener_id(self) -> int:
+        return self._listener_id
+
+    @property
+    def loop(self) -> AbstractEventLoop:
+        return self._loop
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._host, self._port
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def pids(self) -> List[int]:
+        return [p.pid for p in self._processes]
+
+    async def start(self, timeout: float = 10.) -> None:
+        self._ipc_dir = tempfile.mkdtemp(prefix='asscat-shards-')
+        ipc_path = os.path.join(self._ipc_dir, 'ctl.sock')
+        self._ready = self._loop.create_future()
+        self._ipc_server = await self._loop.create_unix_server(
+            lambda: ControllerLink(self), ipc_path)
+
+        # Workers run their own event loop, don't inherit this one
+        ctx = multiprocessing.get_context('spawn')
+        for shard_id in range(self._workers):
+            process = ctx.Process(
+                target=_shard_main,
+                args=(shard_id, self._host, self._port, ipc_path, self._buffered),
+                name=f'asscat-shard-{shard_id}',
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+        try:
+            await wait_for(self._ready, timeout)
+        except BaseException:
+            await self._terminate()
+            raise
+        self._logger.info(f'Started {self._workers} shards on {self._host}:{self._port}')
+
+    def link_ready(self, link: ControllerLink) -> None:
+        self._links[link.shard_id] = link
+
+    def link_listening(self, link: ControllerLink) -> None:
+        self._listening.add(link.shard_id)
+        if len(self._listening) == self._workers and not self._ready.done():
+            self._ready.set_result(None)
+
+    def link_lost(self, link: ControllerLink) -> None:
+        if self._links.get(link.shard_id) is link:
+            del self._links[link.shard_id]
+            self._listening.discard(link.shard_id)
+            self._logger.info(f'Lost shard #{link.shard_id}')
+
+    async def stop(self) -> None:
+        for link in self._links.values():
+            link.send(SHUTDOWN)
+        for process in self._processes:
+            await self._loop.run_in_executor(None, process.join, 5.)
+            if process.is_alive():
+                process.terminate()
+        self._processes.clear()
+        self._close_ipc()
+        self._logger.info(f'Stopped shards on {self._host}:{self._port}')
+
+    async def _terminate(self) -> None:
+        """Kill workers that did not come up and clean up after them"""
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            await self._loop.run_in_executor(None, process.join, 5.)
+            if process.is_alive():
+                process.kill()
+        self._processes.clear()
+        self._close_ipc()
+        self._logger.error(f'Shards on {self._host}:{self._port} did not start')
+
+    def _close_ipc(self) -> None:
+        if self._ipc_server is not None:
+            self._ipc_server.close()
+            self._ipc_server = None
+        if self._ipc_dir is not None:
+            try:
+                os.unlink(os.path.join(self._ipc_dir, 'ctl.sock'))
+                os.rmdir(self._ipc_dir)
+            except OSError:
+                pass
+            self._ipc_dir = None
@@ -1,23 +1,57 @@
+import re
 import sys
 from abc import ABC
 from asyncio import (
     AbstractEventLoop,
     StreamReader,
     StreamWriter,
-    StreamReaderProtocol, sleep, Future, IncompleteReadError, LimitOverrunError,
+    StreamReaderProtocol, sleep, Future, IncompleteReadError, LimitOverrunError, TimerHandle,
 )
 from asyncio.streams import FlowControlMixin  # noqa
-from typing import Optional
+from typing import Optional, Iterable, Set, Tuple, Union
 
+from asscat.buffers import ChunkBuffer
 from asscat.exceptions import BufferLimitError
+from asscat.matcher import PatternMatcher
 
 BUF_LIMIT = 4096
+# Unread bytes kept for a session nothing reads from, older ones are
+# dropped instead of pausing the transport. Output went to the
+# scrollback, taps and the recorder already.
+UNREAD_LIMIT = 64 * 1024
+# Seconds after the last read during which a reader counts as being
+# read from, and a full buffer pauses the transport. A transport still
+# paused once it passed without a read is resumed again.
+READ_GRACE = 1.
+# Coalesced writes are sent right away once they reach this size
+COALESCE_LIMIT = 64 * 1024
+
+
+class ReaderStats:
+    """Counters of one AssCatReader"""
+    __slots__ = ('chunks', 'bytes_fed', 'high_water', 'pauses', 'resumes', 'dropped')
+
+    def __init__(self):
+        self.chunks: int = 0
+        self.bytes_fed: int = 0
+        # Most bytes ever waiting in the buffer at once
+        self.high_water: int = 0
+        self.pauses: int = 0
+        self.resumes: int = 0
+        # Unread bytes dropped while nothing was reading
+        self.dropped: int = 0
+
+    def __repr__(self):
+        return (f'<ReaderStats chunks={self.chunks} bytes_fed={self.bytes_fed} '
+                f'high_water={self.high_water} pauses={self.pauses} resumes={self.resumes} '
+                f'dropped={self.dropped}>')
 
 
 class AssCatReader:
 
     __slots__ = ('_loop', '_limit', '_buffer', '_eof', '_waiter',
-                 '_exception', '_transport', '_paused', '_traceback')
+                 '_exception', '_transport', '_paused', '_traceback', '_stats', '_read_at',
+                 '_grace_handle')
 
     def __init__(self, loop: AbstractEventLoop, limit: int = BUF_LIMIT):
         self._loop: AbstractEventLoop = loop
@@ -29,12 +63,16 @@ class AssCatReader:
             raise BufferLimitError("Buffer limit must be greater zero")
 
         self._limit = limit
-        self._buffer: bytearray = bytearray()
+        self._buffer: ChunkBuffer = ChunkBuffer()
         self._eof: bool = False
         self._waiter: Optional[Future] = None
         self._exception: Optional[Exception] = None
         self._transport = None
         self._paused: bool = False
+        self._stats: ReaderStats = ReaderStats()
+        # Loop time of the last read or wait for data
+        self._read_at: Optional[float] = None
+        self._grace_handle: Optional[TimerHandle] = None
 
     def __repr__(self):
         info = ['StreamReader']
@@ -54,6 +92,41 @@ class AssCatReader:
             info.append('paused')
         return '<{}>'.format(' '.join(info))
 
+    @property
+    def buffered(self) -> int:
+        """Number of bytes waiting in the buffer"""
+        return len(self._buffer)
+
+    @property
+    def stats(self) -> ReaderStats:
+        return self._stats
+
+    @property
+    def memory_usage(self) -> int:
+        """Approximate bytes held by the reader and its buffer"""
+        return sys.getsizeof(self) + sys.getsizeof(self._buffer) + self._buffer.memory_usage
+
+    def view_owners(self) -> Set[int]:
+        """Ids of the receive blocks buffered data still points into"""
+        return self._buffer.view_owners()
+
+    def compact(self) -> None:
+        """Copy buffered data out of the memory it was received into"""
+        self._buffer.compact()
+
+    def release(self) -> None:
+        """
+        Drop data no read is waiting for and resume the transport if
+        the buffer paused it. Meant for sessions that went quiet, their
+        output went to the scrollback already and readers of commands
+        skip ahead to their own markers anyway.
+        """
+        if self._waiter is not None:
+            self._buffer.compact()
+            return
+        self._buffer.clear()
+        self._resume_transport()
+
     def exception(self):
         return self._exception
 
@@ -74,14 +147,99 @@ class AssCatReader:
                 waiter.set_result(None)
 
     def _maybe_resume_transport(self):
+        self._read_at = self._loop.time()
         if self._paused and len(self._buffer) <= self._limit:
+            self._resume_transport()
+
+    def _resume_transport(self):
+        handle = self._grace_handle
+        if handle is not None:
+            handle.cancel()
+            self._grace_handle = None
+        if self._paused:
             self._paused = False
+            self._stats.resumes += 1
             self._transport.resume_reading()
 
+    def _check_reads(self):
+        """
+        Resume a paused transport once nothing read for READ_GRACE, a
+        read that timed out or gave up must not stall the session. Later
+        data is then dropped beyond UNREAD_LIMIT by feed_data().
+        """
+        self._grace_handle = None
+        if not self._paused:
+            return
+        read_at = self._read_at
+        if read_at is not None:
+            left = read_at + READ_GRACE - self._loop.time()
+            if left > 0:
+                self._grace_handle = self._loop.call_later(left, self._check_reads)
+                return
+        buffered = len(self._buffer)
+        if buffered > UNREAD_LIMIT:
+            self._buffer.discard(buffered - UNREAD_LIMIT)
+            self._stats.dropped += buffered - UNREAD_LIMIT
+        self._resume_transport()
+
+    def set_transport(self, transport):
+        assert self._transport is None, 'Transport already set'
+        self._transport = transport
+
     def feed_eof(self):
         self._eof = True
+        handle = self._grace_handle
+        if handle is not None:
+            handle.cancel()
+            self._grace_handle = None
+        self._wakeup_waiter()
+
+    def feed_data(self, data):
+        """
+        Buffer ``data``. Past twice the limit, the transport is paused
+        while something reads from the reader, until READ_GRACE passed
+        without a read. Otherwise unread data beyond UNREAD_LIMIT is
+        dropped from the front, so a session nobody reads from keeps
+        receiving.
+        """
+        assert not self._eof, 'feed_data after feed_eof'
+
+        if not data:
+            return
+
+        buffer = self._buffer
+        buffer.extend(data)
+        stats = self._stats
+        stats.chunks += 1
+        stats.bytes_fed += len(data)
+        buffered = len(buffer)
+        if buffered > stats.high_water:
+            stats.high_water = buffered
+        waiting = self._waiter is not None
         self._wakeup_waiter()
 
+        if (self._transport is None or
+                self._paused or
+                buffered <= 2 * self._limit):
+            return
+        read_at = self._read_at
+        if waiting or (read_at is not None and self._loop.time() - read_at < READ_GRACE):
+            try:
+                self._transport.pause_reading()
+            except NotImplementedError:
+                # The transport can't be paused.
+                # We'll just have to buffer all data.
+                # Forget the transport so we don't keep trying.
+                self._transport = None
+            else:
+                self._paused = True
+                stats.pauses += 1
+                if self._grace_handle is None:
+                    self._grace_handle = self._loop.call_later(READ_GRACE, self._check_reads)
+        elif buffered > 2 * UNREAD_LIMIT:
+            buffer.discard(buffered - UNREAD_LIMIT)
+            stats.dropped += buffered - UNREAD_LIMIT
+
     def at_eof(self):
         """Return True if the buffer is empty and 'feed_eof' was called."""
         return self._eof and not self._buffer
@@ -105,14 +263,14 @@ class AssCatReader:
         # Waiting for data while paused will make deadlock, so prevent it.
         # This is essential for readexactly(n) for case when n > self._limit.
         if self._paused:
-            self._paused = False
-            self._transport.resume_reading()
+            self._resume_transport()
 
         self._waiter = self._loop.create_future()
         try:
             await self._waiter
         finally:
             self._waiter = None
+            self._read_at = self._loop.time()
 
     async def readline(self):
         """Read chunk of data from the stream until newline (b'\n') is found.
@@ -138,7 +296,7 @@ class AssCatReader:
             return e.partial
         except LimitOverrunError as e:
             if self._buffer.startswith(sep, e.consumed):
-                del self._buffer[:e.consumed + seplen]
+                self._buffer.discard(e.consumed + seplen)
             else:
                 self._buffer.clear()
             self._maybe_resume_transport()
@@ -203,8 +361,7 @@ class AssCatReader:
             # adds data which makes separator be found. That's why we check for
             # EOF *ater* inspecting the buffer.
             if self._eof:
-                chunk = bytes(self._buffer)
-                self._buffer.clear()
+                chunk = self._buffer.take()
                 raise IncompleteReadError(chunk, None)
 
             # _wait_for_data() will resume reading if stream was paused.
@@ -214,10 +371,110 @@ class AssCatReader:
             raise LimitOverrunError(
                 'Separator is found, but chunk is longer than limit', isep)
 
-        chunk = self._buffer[:isep + sep_len]
-        del self._buffer[:isep + sep_len]
+        chunk = self._buffer.take(isep + sep_len)
+        self._maybe_resume_transport()
+        return chunk
+
+    async def read_until_any(
+            self,
+            patterns: Union[Iterable[bytes], PatternMatcher],
+    ) -> Tuple[bytes, bytes]:
+        """Read data from the stream until one of ``patterns`` is found.
+
+        Returns a tuple of the consumed data, which ends with the match,
+        and the pattern that matched. When several patterns end at the
+        same offset, the longest one wins.
+
+        Patterns are compiled once into a PatternMatcher, pass one in to
+        skip even the cache lookup. The automaton state is kept while
+        waiting for more data, so every byte is scanned exactly once no
+        matter how many patterns there are.
+
+        Limit, EOF and over limit handling are the same as in
+        read_until().
+        """
+        if isinstance(patterns, PatternMatcher):
+            matcher = patterns
+        else:
+            matcher = PatternMatcher.compile(tuple(patterns))
+
+        if self._exception is not None:
+            raise self._exception
+
+        # Bytes before `offset` went through the automaton already,
+        # `state` holds where it stopped.
+        offset = 0
+        state = 0
+        while True:
+            buflen = len(self._buffer)
+            if buflen > offset:
+                end, idx, state = matcher.scan(self._buffer.peek(start=offset), state)
+                if idx is not None:
+                    end += offset
+                    break
+                offset = buflen
+                if offset - matcher.max_len + 1 > self._limit:
+                    raise LimitOverrunError(
+                        'No pattern is found, and chunk exceed the limit',
+                        offset)
+
+            if self._eof:
+                chunk = self._buffer.take()
+                raise IncompleteReadError(chunk, None)
+
+            await self._wait_for_data('read_until_any')
+
+        pattern = matcher.patterns[idx]
+        if end - len(pattern) > self._limit:
+            raise LimitOverrunError(
+                'Pattern is found, but chunk is longer than limit',
+                end - len(pattern))
+
+        chunk = self._buffer.take(end)
         self._maybe_resume_transport()
-        return bytes(chunk)
+        return chunk, pattern
+
+    async def read_until_regex(
+            self,
+            pattern: Union[bytes, re.Pattern],
+    ) -> Tuple[bytes, re.Match]:
+        """Read data from the stream until ``pattern`` matches.
+
+        Returns a tuple of the consumed data, up to the end of the match,
+        and the match object, whose offsets are relative to the data.
+
+        A regular expression can not resume mid-match, so the buffer is
+        searched again whenever data arrives. Prefer read_until_any() for
+        literal markers. Data past the limit raises LimitOverrunError.
+        """
+        regex = re.compile(pattern) if not isinstance(pattern, re.Pattern) else pattern
+
+        if self._exception is not None:
+            raise self._exception
+
+        searched = 0
+        while True:
+            buflen = len(self._buffer)
+            if buflen > searched:
+                data = self._buffer.peek()
+                match = regex.search(data)
+                if match is not None:
+                    break
+                searched = buflen
+                if searched > self._limit:
+                    raise LimitOverrunError(
+                        'Pattern does not match, and chunk exceed the limit',
+                        searched)
+
+            if self._eof:
+                chunk = self._buffer.take()
+                raise IncompleteReadError(chunk, None)
+
+            await self._wait_for_data('read_until_regex')
+
+        chunk = self._buffer.take(match.end())
+        self._maybe_resume_transport()
+        return chunk, match
 
     async def read(self, n=-1):
         """Read up to `n` bytes from the stream.
@@ -264,8 +521,7 @@ class AssCatReader:
             await self._wait_for_data('read')
 
         # This will work right even if buffer is less than n bytes
-        data = bytes(self._buffer[:n])
-        del self._buffer[:n]
+        data = self._buffer.take(n)
 
         self._maybe_resume_transport()
         return data
@@ -280,10 +536,32 @@ class AssCatReader:
         return val
 
 
+class WriterStats:
+    """Counters of one AssCatWriter"""
+    __slots__ = ('writes', 'sends', 'bytes_written')
+
+    def __init__(self):
+        self.writes: int = 0
+        self.sends: int = 0
+        self.bytes_written: int = 0
+
+    def __repr__(self):
+        return (f'<WriterStats writes={self.writes} sends={self.sends} '
+                f'bytes_written={self.bytes_written}>')
+
+
 class AssCatWriter:
-    """Transport wrapper"""
+    """
+    Transport wrapper
+
+    Writes issued within one loop iteration are coalesced and handed to
+    the transport as a single writelines() call. Backpressure is driven
+    by the transport's high/low water marks, flush() returns as soon as
+    the transport buffer dropped below the low water mark.
+    """
     __slots__ = ('_transport', '_protocol', '_reader', '_loop',
-                 '_complete_fut',)
+                 '_complete_fut', '_pending', '_pending_size', '_flush_handle',
+                 '_coalesce_limit', '_stats')
 
     def __init__(
             self,
@@ -291,6 +569,9 @@ class AssCatWriter:
             protocol,
             reader: StreamReader,
             loop: AbstractEventLoop,
+            high_water: int = None,
+            low_water: int = None,
+            coalesce_limit: int = COALESCE_LIMIT,
     ):
         self._loop: AbstractEventLoop = loop
         self._transport = transport
@@ -299,6 +580,13 @@ class AssCatWriter:
         self._reader: StreamReader = reader
         self._complete_fut = self._loop.create_future()
         self._complete_fut.set_result(None)
+        self._pending: list = []
+        self._pending_size: int = 0
+        self._flush_handle = None
+        self._coalesce_limit: int = coalesce_limit
+        self._stats: WriterStats = WriterStats()
+        if high_water is not None or low_water is not None:
+            self.set_write_buffer_limits(high_water, low_water)
 
     @property
     def transport(self):
@@ -312,19 +600,76 @@ class AssCatWriter:
     def reader(self):
         return self._reader
 
+    @property
+    def stats(self) -> WriterStats:
+        return self._stats
+
+    @property
+    def memory_usage(self) -> int:
+        """Approximate bytes held by the writer and its coalesced writes"""
+        return sys.getsizeof(self) + sys.getsizeof(self._pending) + self._pending_size
+
+    @property
+    def bytes_queued(self) -> int:
+        """Bytes not yet handed to the kernel, coalesced or in the transport"""
+        return self._pending_size + self._transport.get_write_buffer_size()
+
+    @property
+    def pauses(self) -> int:
+        """How often the peer was too slow and writing got paused"""
+        return getattr(self._protocol, 'write_pauses', 0)
+
+    def get_write_buffer_limits(self):
+        return self._transport.get_write_buffer_limits()
+
+    def set_write_buffer_limits(self, high: int = None, low: int = None):
+        self._transport.set_write_buffer_limits(high, low)
+
     def write(self, data):
-        self._transport.write(data)
+        if not data:
+            return
+        # Data is sent later, don't let callers mutate it meanwhile
+        if type(data) is not bytes:
+            data = bytes(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        self._stats.writes += 1
+        if self._pending_size >= self._coalesce_limit:
+            self._send_pending()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self._send_pending)
 
     def writelines(self, data):
-        self._transport.writelines(data)
+        for chunk in data:
+            self.write(chunk)
+
+    def _send_pending(self):
+        handle = self._flush_handle
+        if handle is not None:
+            handle.cancel()
+            self._flush_handle = None
+        pending = self._pending
+        if not pending:
+            return
+        stats = self._stats
+        stats.sends += 1
+        stats.bytes_written += self._pending_size
+        self._pending = []
+        self._pending_size = 0
+        if len(pending) == 1:
+            self._transport.write(pending[0])
+        else:
+            self._transport.writelines(pending)
 
     def write_eof(self):
-        return self._transport.write_eof_to_stdout()
+        self._send_pending()
+        return self._transport.write_eof()
 
     def can_write_eof(self):
         return self._transport.can_write_eof()
 
     def close(self):
+        self._send_pending()
         return self._transport.close()
 
     def is_closing(self):
@@ -343,11 +688,16 @@ class AssCatWriter:
             raise exc
 
     async def flush(self) -> None:
-        """Flush the stdout write buffer"""
-        if isinstance(self._reader, StreamReader):
+        """
+        Send coalesced writes and wait until the transport buffer is
+        below the low water mark.
+        """
+        if self._reader is not None:
             await self._check_for_exception()
+        self._send_pending()
         if self._transport.is_closing():
-            await sleep(.1)
+            # Let connection_lost() run, _drain_helper() raises then
+            await sleep(0)
         await self._protocol._drain_helper()  # noqa: pm
 
     async def start_tls(self, sslcontext, *,
@@ -365,6 +715,8 @@ class AssCatWriter:
         protocol._replace_writer(self)  # noqa: pm
 
     def __del__(self):
+        if self._loop.is_closed():
+            return
         if not self._transport.is_closing():
             self.close()
 
@@ -397,6 +749,9 @@ class Stream(ABC):
     async def readline(self) -> bytes:
         return await self._reader.readline()
 
+    async def read_until_any(self, patterns) -> Tuple[bytes, bytes]:
+        return await self._reader.read_until_any(patterns)
+
     async def write(self, data: bytes):
         self._writer.write(data)
         await self._writer.drain()
@@ -445,10 +800,22 @@ class SocketStream(Stream):
     def __init__(self, loop: AbstractEventLoop):
         super().__init__()
         self._loop = loop
+        self._out_history = None
+
+    @property
+    def history(self):
+        return self._out_history
 
     @classmethod
-    def create(cls, loop: AbstractEventLoop, reader: AssCatReader, writer: AssCatWriter):
+    def create(
+            cls,
+            loop: AbstractEventLoop,
+            reader: AssCatReader,
+            writer: AssCatWriter,
+            history=None,
+    ):
         self = cls(loop)
         self._reader = reader
         self._writer = writer
+        self._out_history = history
         return self
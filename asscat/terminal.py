@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import os
+import termios
+import tty
+from asyncio import AbstractEventLoop, Future, TimerHandle
+from typing import List, Optional
+
+from asscat.logger import set_log_stderr
+
+# Ctrl-], hands the terminal back like telnet does
+DETACH_KEY = b'\x1d'
+# Bytes read from the terminal per readiness event at most
+READ_SIZE = 4096
+# Output waiting for the terminal before the session's reading is
+# paused, and what it has to drain to before reading resumes
+HIGH_WATER = 64 * 1024
+LOW_WATER = 16 * 1024
+# Seconds between two looks at which session is the active one
+FOLLOW_INTERVAL = 0.1
+
+
+class RawTerminal:
+    """
+    Connects the controlling terminal to the active session in raw mode.
+
+    Every read from stdin goes straight to the session's
+    stdin_data_received(), no stream, reader task or command parsing
+    sits in between. The terminal is the session's stdout transport,
+    output is written to it as it arrives without blocking. What the
+    terminal doesn't take right away is buffered and written once it's
+    writable, past HIGH_WATER the session's reading is paused. Keystroke
+    to echo latency is tracked for every session typed into.
+
+    The detach key, or EOF on stdin, restores the terminal and resolves
+    the future attach() returned. Log messages only go to the log file
+    while attached.
+    """
+    __slots__ = ('_loop', '_manager', '_fd_in', '_fd_out', '_detach_key',
+                 '_saved', '_session', '_detached', '_buffer', '_blocking',
+                 '_paused', '_follow_handle')
+
+    def __init__(
+            self,
+            loop: AbstractEventLoop,
+            manager,
+            fd_in: int = 0,
+            fd_out: int = 1,
+            detach_key: bytes = DETACH_KEY,
+    ):
+        self._loop: AbstractEventLoop = loop
+        self._manager = manager
+        self._fd_in: int = fd_in
+        self._fd_out: int = fd_out
+        self._detach_key: bytes = detach_key
+        self._saved: Optional[List] = None
+        self._session = None
+        self._detached: Optional[Future] = None
+        self._buffer: bytearray = bytearray()
+        self._blocking: bool = True
+        # Whether the session's reading was paused for the terminal
+        self._paused: bool = False
+        self._follow_handle: Optional[TimerHandle] = None
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def attached(self) -> bool:
+        return self._detached is not None and not self._detached.done()
+
+    def attach(self) -> Future:
+        """Put the terminal in raw mode and start forwarding"""
+        if self.attached:
+            return self._detached
+        try:
+            self._saved = termios.tcgetattr(self._fd_in)
+            tty.setraw(self._fd_in, termios.TCSANOW)
+        except termios.error:
+            # Not a terminal, forward the pipe as it is
+            self._saved = None
+        self._blocking = os.get_blocking(self._fd_out)
+        os.set_blocking(self._fd_out, False)
+        set_log_stderr(False)
+        self._detached = self._loop.create_future()
+        self._loop.add_reader(self._fd_in, self._read)
+        self._follow()
+        return self._detached
+
+    async def run(self) -> None:
+        await self.attach()
+
+    def detach(self) -> None:
+        if not self.attached:
+            return
+        self._loop.remove_reader(self._fd_in)
+        if self._follow_handle is not None:
+            self._follow_handle.cancel()
+            self._follow_handle = None
+        self._set_session(None)
+        if self._buffer:
+            # Output the terminal never took is dropped
+            self._loop.remove_writer(self._fd_out)
+            self._buffer.clear()
+        os.set_blocking(self._fd_out, self._blocking)
+        if self._saved is not None:
+            termios.tcsetattr(self._fd_in, termios.TCSADRAIN, self._saved)
+            self._saved = None
+        set_log_stderr(True)
+        self._detached.set_result(None)
+
+    def follow(self) -> None:
+        """Switch over to the manager's active session if it changed"""
+        manager = self._manager
+        session = manager.get_session(manager.active_session_id)
+        if session is not self._session:
+            self._set_session(session)
+
+    def _follow(self) -> None:
+        self.follow()
+        self._follow_handle = self._loop.call_later(FOLLOW_INTERVAL, self._follow)
+
+    def _set_session(self, session) -> None:
+        current = self._session
+        if current is not None:
+            current.stdout_connection_made(None)
+            if self._paused:
+                self._resume_session()
+        self._session = session
+        if session is not None:
+            session.track_latency()
+            session.stdout_connection_made(self)
+
+    def _read(self) -> None:
+        try:
+            data = os.read(self._fd_in, READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.detach()
+            return
+        detach = data.find(self._detach_key)
+        if detach >= 0:
+            data = data[:detach]
+        session = self._session
+        if session is None or session.session_id != self._manager.active_session_id:
+            self.follow()
+            session = self._session
+        if data and session is not None:
+            session.stdin_data_received(data)
+        if detach >= 0:
+            self.detach()
+
+    def _pause_session(self) -> None:
+        transport = getattr(self._session, 'transport', None)
+        if transport is not None and not transport.is_closing() and transport.is_reading():
+            transport.pause_reading()
+            self._paused = True
+
+    def _resume_session(self) -> None:
+        self._paused = False
+        transport = getattr(self._session, 'transport', None)
+        if transport is not None and not transport.is_closing():
+            transport.resume_reading()
+
+    # The session's stdout transport
+
+    def write(self, data) -> None:
+        buffer = self._buffer
+        if not buffer:
+            try:
+                written = os.write(self._fd_out, data)
+            except (BlockingIOError, InterruptedError):
+                written = 0
+            except OSError:
+                # The terminal is gone
+                self.detach()
+                return
+            if written == len(data):
+                return
+            buffer += memoryview(data)[written:]
+            self._loop.add_writer(self._fd_out, self._write_ready)
+        else:
+            buffer += data
+        if len(buffer) > HIGH_WATER:
+            # Also when something else resumed reading meanwhile
+            self._pause_session()
+
+    def _write_ready(self) -> None:
+        buffer = self._buffer
+        try:
+            written = os.write(self._fd_out, buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.detach()
+            return
+        del buffer[:written]
+        if not buffer:
+            self._loop.remove_writer(self._fd_out)
+        if self._paused and len(buffer) <= LOW_WATER:
+            self._resume_session()
+
+    def get_write_buffer_size(self) -> int:
+        return len(self._buffer)
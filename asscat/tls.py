@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import os
+import ssl
+import subprocess
+import tempfile
+from ipaddress import ip_address
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+# Where certificate profiles are kept, one cert and key pair per name
+TLS_DIR = os.path.join(os.path.expanduser('~'), '.asscat', 'tls')
+DEFAULT_PROFILE = 'default'
+# Validity of generated certificates in days
+CERT_DAYS = 825
+# TLS 1.3 session tickets sent after each full handshake
+NUM_TICKETS = 2
+
+
+class CertProfile(NamedTuple):
+    """Certificate and key a listener serves, and CAs its clients must be signed by"""
+    certfile: str
+    keyfile: str
+    cafile: Optional[str] = None
+
+
+class TLSStats(NamedTuple):
+    handshakes: int
+    resumed: int
+    full: int
+    tickets_expired: int
+
+
+def profile_paths(name: str = DEFAULT_PROFILE, directory: str = TLS_DIR) -> CertProfile:
+    return CertProfile(os.path.join(directory, f'{name}.crt'),
+                       os.path.join(directory, f'{name}.key'))
+
+
+def _split_hosts(hosts: Iterable[str]) -> Tuple[list, list]:
+    names, addresses = [], []
+    for host in hosts:
+        try:
+            address = ip_address(host)
+        except ValueError:
+            names.append(host)
+        else:
+            # Wildcard binds are reached by other names, they don't go in the SAN
+            if not address.is_unspecified:
+                addresses.append(address)
+    return names, addresses
+
+
+def _generate_cryptography(certfile, keyfile, common_name, hosts, days) -> None:
+    # Imported on use, it's heavy and only needed to create certificates
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from datetime import datetime, timedelta, timezone
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, common_name)])
+    names, addresses = _split_hosts(hosts)
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + timedelta(days=days))
+        .add_extension(x509.SubjectAlternativeName(
+            [x509.DNSName(name) for name in names] +
+            [x509.IPAddress(address) for address in addresses]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    with open(keyfile, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(certfile, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+
+def _generate_openssl(certfile, keyfile, common_name, hosts, days) -> None:
+    names, addresses = _split_hosts(hosts)
+    san = ','.join([f'DNS:{name}' for name in names] + [f'IP:{address}' for address in addresses])
+    command = [
+        'openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+        '-nodes', '-keyout', keyfile, '-out', certfile, '-days', str(days),
+        '-subj', f'/CN={common_name}', '-addext', f'subjectAltName={san}',
+    ]
+    try:
+        subprocess.run(command, check=True, capture_output=True)
+    except FileNotFoundError:
+        raise ValueError('Generating certificates needs the cryptography package or openssl')
+    except subprocess.CalledProcessError as e:
+        raise ValueError(f'openssl failed: {e.stderr.decode(errors="replace").strip()}')
+
+
+def generate_certificate(
+        certfile: str,
+        keyfile: str,
+        common_name: str = 'asscat',
+        hosts: Iterable[str] = ('localhost', '127.0.0.1', '::1'),
+        days: int = CERT_DAYS,
+) -> CertProfile:
+    """
+    Create a self-signed EC certificate for local use, valid for
+    ``hosts``. The key is written readable by its owner only.
+    """
+    hosts = list(hosts) or [common_name]
+    for path in (certfile, keyfile):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+    umask = os.umask(0o077)
+    try:
+        try:
+            _generate_cryptography(certfile, keyfile, common_name, hosts, days)
+        except ImportError:
+            _generate_openssl(certfile, keyfile, common_name, hosts, days)
+    finally:
+        os.umask(umask)
+    return CertProfile(certfile, keyfile)
+
+
+def ensure_profile(
+        name: str = DEFAULT_PROFILE,
+        directory: str = TLS_DIR,
+        hosts: Iterable[str] = (),
+) -> CertProfile:
+    """Paths of a profile, generating a self-signed certificate if it has none yet"""
+    profile = profile_paths(name, directory)
+    if not (os.path.exists(profile.certfile) and os.path.exists(profile.keyfile)):
+        hosts = ['localhost', '127.0.0.1', '::1', *(host for host in hosts if host)]
+        # Generate next to the target and move in place, so a listener
+        # starting at the same time never loads half a pair
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=directory, prefix='.gen-')
+        try:
+            generated = generate_certificate(os.path.join(tmp, 'crt'), os.path.join(tmp, 'key'),
+                                             common_name=name, hosts=dict.fromkeys(hosts))
+            os.replace(generated.keyfile, profile.keyfile)
+            os.replace(generated.certfile, profile.certfile)
+        finally:
+            for leftover in os.listdir(tmp):
+                os.unlink(os.path.join(tmp, leftover))
+            os.rmdir(tmp)
+    return profile
+
+
+def server_context(profile: CertProfile) -> ssl.SSLContext:
+    """
+    Server context for ``profile`` that hands out session tickets, so
+    clients coming back resume instead of doing a full handshake.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(profile.certfile, profile.keyfile)
+    # Stateless tickets for TLS 1.2, the key lives as long as the context
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = NUM_TICKETS
+    if profile.cafile is not None:
+        context.load_verify_locations(profile.cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+def _mtimes(profile: CertProfile) -> Tuple[int, ...]:
+    return tuple(os.stat(path).st_mtime_ns for path in profile if path is not None)
+
+
+class ContextCache:
+    """
+    Server contexts by profile. Tickets are encrypted with a key of the
+    context they were issued by, so every listener of a profile shares
+    one context for clients to resume across listeners and restarts of
+    them. A profile whose files changed gets a new context.
+    """
+    __slots__ = ('_contexts',)
+
+    def __init__(self):
+        self._contexts: Dict[CertProfile, Tuple[Tuple[int, ...], ssl.SSLContext]] = {}
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def get(self, profile: CertProfile) -> ssl.SSLContext:
+        mtimes = _mtimes(profile)
+        cached = self._contexts.get(profile)
+        if cached is not None and cached[0] == mtimes:
+            return cached[1]
+        context = server_context(profile)
+        self._contexts[profile] = mtimes, context
+        return context
+
+    def stats(self) -> Dict[CertProfile, TLSStats]:
+        return {profile: context_stats(context) for profile, (_, context) in self._contexts.items()}
+
+    def clear(self) -> None:
+        self._contexts.clear()
+
+
+def context_stats(context: ssl.SSLContext) -> TLSStats:
+    """Handshakes a server context finished and how many of them resumed a session"""
+    stats = context.session_stats()
+    handshakes = stats['accept_good']
+    return TLSStats(handshakes, stats['hits'], handshakes - stats['hits'], stats['timeouts'])
@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import secrets
+import shlex
+from asyncio import (
+    FIRST_EXCEPTION,
+    IncompleteReadError,
+    LimitOverrunError,
+    Semaphore,
+    TimeoutError,
+    ensure_future,
+    wait,
+    wait_for,
+)
+from time import perf_counter
+from typing import Dict, NamedTuple, Optional
+
+from asscat.broadcast import read_past, run_on_session
+
+# Bytes of the file per chunk
+CHUNK_SIZE = 256 * 1024
+# Chunks sent before the first one has to be confirmed
+WINDOW = 8
+# Times a chunk is sent again after a checksum mismatch
+RETRIES = 3
+# Seconds to wait for the target to answer at all
+TIMEOUT = 30.
+
+# Target side tools by preference, fastest first
+ENCODERS = ('base64', 'xxd', 'python3')
+CHECKSUMS = ('md5sum', 'python3')
+
+_PY = 'python3 -c "import sys,base64,hashlib;%s"'
+DECODE = {
+    'base64': 'base64 -d',
+    'python3': _PY % 'sys.stdout.buffer.write(base64.b64decode(sys.stdin.buffer.read()))',
+    'xxd': 'xxd -r -p',
+}
+ENCODE = {
+    'base64': 'base64',
+    'python3': _PY % 'sys.stdout.write(base64.encodebytes(sys.stdin.buffer.read()).decode())',
+    'xxd': 'xxd -p',
+}
+CHECKSUM = {
+    'md5sum': 'md5sum',
+    'python3': _PY % 'print(hashlib.md5(sys.stdin.buffer.read()).hexdigest())',
+}
+
+_DATA_LINE = re.compile(rb'^[A-Za-z0-9+/=]+\r?$', re.M)
+_END_LINE = re.compile(rb'(\d+) ([0-9a-f]{32})')
+
+
+class TransferResult(NamedTuple):
+    session_id: int
+    source: str
+    destination: str
+    size: int
+    elapsed: float
+    retries: int = 0
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def rate(self) -> float:
+        """MB/s of file data moved"""
+        return self.size / self.elapsed / 1024 / 1024 if self.elapsed else 0.
+
+
+class TransferError(Exception):
+    pass
+
+
+class Tools(NamedTuple):
+    encoder: str
+    checksum: str
+    # head -c lets the decoder read chunks straight from the socket,
+    # the shell itself reads its input a byte at a time
+    head: bool = False
+
+
+async def probe_tools(session, timeout: float = TIMEOUT) -> Tools:
+    """Find the fastest encoder and a checksum tool on the target"""
+    names = sorted(set(ENCODERS + CHECKSUMS + ('head',)))
+    result = await run_on_session(session, 'command -v ' + ' '.join(names), timeout)
+    if result.error is not None:
+        raise TransferError(f'probing tools failed: {result.error}')
+    found = {os.path.basename(line.strip()) for line in result.output.decode(errors='replace').split()}
+    encoder = next((name for name in ENCODERS if name in found), None)
+    checksum = next((name for name in CHECKSUMS if name in found), None)
+    if encoder is None or checksum is None:
+        raise TransferError(f'target lacks tools, found: {" ".join(sorted(found)) or "none"}')
+    return Tools(encoder, checksum, 'head' in found)
+
+
+def _encode(data: bytes, encoder: str) -> bytes:
+    if encoder == 'xxd':
+        hexed = binascii.hexlify(data)
+        return b''.join(hexed[i:i + 60] + b'\n' for i in range(0, len(hexed), 60))
+    return base64.encodebytes(data)
+
+
+def _decode(lines, encoder: str) -> bytes:
+    data = b''.join(line.strip() for line in lines)
+    if encoder == 'xxd':
+        return binascii.unhexlify(data)
+    return base64.b64decode(data)
+
+
+def _dd(path: str, chunk_size: int, index: int, direction: str) -> str:
+    if direction == 'in':
+        return f'dd if={path} bs={chunk_size} skip={index} count=1 2>/dev/null'
+    return f'dd of={path} bs={chunk_size} seek={index} conv=notrunc 2>/dev/null'
+
+
+class _Window:
+    """
+    Pipelines chunk commands to the shell of a session. At most
+    ``window`` chunks are unconfirmed, writes go through the session's
+    AssCatWriter and wait for it to drain.
+    """
+    __slots__ = ('session', 'reader', 'writer', 'semaphore', 'retries', 'attempts')
+
+    def __init__(self, session, window: int):
+        self.session = session
+        self.reader = session.reader
+        self.writer = session.writer
+        if self.reader is None or self.writer is None:
+            raise TransferError('session has no local reader')
+        self.semaphore: Semaphore = Semaphore(window)
+        self.retries: int = 0
+        self.attempts: Dict[int, int] = {}
+
+    async def send(self, command: str | bytes) -> None:
+        if isinstance(command, str):
+            command = command.encode()
+        self.writer.write(command)
+        await self.writer.flush()
+
+    def retry(self, index: int) -> None:
+        attempts = self.attempts.get(index, 0) + 1
+        if attempts > RETRIES:
+            raise TransferError(f'chunk {index} failed its checksum {attempts} times')
+        self.attempts[index] = attempts
+        self.retries += 1
+
+    async def readline(self, timeout: float) -> bytes:
+        line = await wait_for(self.reader.readline(), timeout)
+        if not line:
+            raise TransferError('session closed')
+        return line
+
+
+def _release(session) -> None:
+    """Resume the session's reader, a failed transfer may leave it paused"""
+    reader = getattr(session, 'reader', None)
+    if reader is not None:
+        reader.release()
+
+
+async def _pipeline(sender, receiver) -> None:
+    """Run both halves of a transfer, the first failure ends both"""
+    tasks = ensure_future(sender()), ensure_future(receiver())
+    try:
+        await wait(tasks, return_when=FIRST_EXCEPTION)
+        for task in tasks:
+            if task.done() and task.exception() is not None:
+                raise task.exception()
+        await tasks[1]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def upload(
+        session,
+        source: str,
+        destination: str,
+        chunk_size: int = CHUNK_SIZE,
+        window: int = WINDOW,
+        timeout: float = TIMEOUT,
+        tools: Tools | None = None,
+) -> TransferResult:
+    """
+    Copy the local file ``source`` to ``destination`` on the target.
+
+    Every chunk is written to its offset with dd and read back through
+    the checksum tool, a chunk whose checksum does not match is sent
+    again. The file is read chunk by chunk as the window allows. The
+    encoded chunk follows its command and is read by ``head -c`` where
+    the target has it, a here-document otherwise.
+    """
+    sid = session.session_id
+    start = perf_counter()
+    try:
+        size = os.path.getsize(source)
+        if tools is None:
+            tools = await probe_tools(session, timeout)
+        flow = _Window(session, window)
+        token = secrets.token_hex(6)
+        ack = re.compile(rb'ASSCAT_ACK_%s_(\d+) ([0-9a-f]{32})' % token.encode())
+        remote = shlex.quote(destination)
+        decode, checksum = DECODE[tools.encoder], CHECKSUM[tools.checksum]
+        chunks = -(-size // chunk_size)
+        sent: Dict[int, tuple] = {}
+
+        def command(index: int, data: bytes) -> bytes:
+            encoded = _encode(data, tools.encoder)
+            write = _dd(remote, chunk_size, index, 'out')
+            confirm = (f"printf 'ASSCAT_%s_{token}_{index} %s\\n' ACK "
+                       f"\"$({_dd(remote, chunk_size, index, 'in')} | {checksum})\"\n")
+            if tools.head:
+                return f'head -c {len(encoded)} | {decode} | {write}; {confirm}'.encode() + encoded
+            eof = f'ASSCAT_EOF_{token}'
+            return f"{decode} <<'{eof}' | {write}\n".encode() + encoded + f'{eof}\n{confirm}'.encode()
+
+        async def sender():
+            await flow.send(f': > {remote}\n')
+            with open(source, 'rb') as f:
+                for index in range(chunks):
+                    await flow.semaphore.acquire()
+                    data = f.read(chunk_size)
+                    sent[index] = hashlib.md5(data).hexdigest(), data
+                    await flow.send(command(index, data))
+
+        async def receiver():
+            done = 0
+            while done < chunks:
+                match = ack.search(await flow.readline(timeout))
+                if match is None:
+                    continue
+                index, digest = int(match.group(1)), match.group(2).decode()
+                expected, data = sent[index]
+                if digest != expected:
+                    flow.retry(index)
+                    await flow.send(command(index, data))
+                    continue
+                del sent[index]
+                done += 1
+                flow.semaphore.release()
+
+        await _pipeline(sender, receiver)
+    except (OSError, ValueError, TransferError, TimeoutError, IncompleteReadError,
+            LimitOverrunError) as exc:
+        return TransferResult(sid, source, destination, 0, perf_counter() - start,
+                              error=str(exc) or repr(exc))
+    finally:
+        _release(session)
+    return TransferResult(sid, source, destination, size, perf_counter() - start, flow.retries)
+
+
+async def download(
+        session,
+        source: str,
+        destination: str,
+        chunk_size: int = CHUNK_SIZE,
+        window: int = WINDOW,
+        timeout: float = TIMEOUT,
+        tools: Tools | None = None,
+) -> TransferResult:
+    """
+    Copy ``source`` on the target to the local file ``destination``.
+    Chunks are encoded on the target, checked against the checksum it
+    sends along and written to their offset as they arrive.
+    """
+    sid = session.session_id
+    start = perf_counter()
+    try:
+        if tools is None:
+            tools = await probe_tools(session, timeout)
+        remote = shlex.quote(source)
+        result = await run_on_session(session, f'wc -c < {remote}', timeout)
+        if not result.ok:
+            raise TransferError(f'can not read {source}: '
+                                f'{result.error or result.output.decode(errors="replace").strip()}')
+        size = int(result.output.split()[-1])
+        flow = _Window(session, window)
+        token = secrets.token_hex(6).encode()
+        begin_marker = b'ASSCAT_BEGIN_%s_' % token
+        end_marker = b'ASSCAT_END_%s_' % token
+        encode, checksum = ENCODE[tools.encoder], CHECKSUM[tools.checksum]
+        chunks = -(-size // chunk_size)
+
+        def command(index: int) -> str:
+            read = _dd(remote, chunk_size, index, 'in')
+            marker = f"printf 'ASSCAT_%s_{token.decode()}_{index}"
+            return (f"{marker}\\n' BEGIN; {read} | {encode}; "
+                    f"{marker} %s\\n' END \"$({read} | {checksum})\"\n")
+
+        async def sender():
+            for index in range(chunks):
+                await flow.semaphore.acquire()
+                await flow.send(command(index))
+
+        with open(destination, 'wb') as f:
+            f.truncate(size)
+
+            async def receiver():
+                done = 0
+                while done < chunks:
+                    await wait_for(read_past(flow.reader, begin_marker), timeout)
+                    index = int(await flow.readline(timeout))
+                    block = await wait_for(read_past(flow.reader, end_marker), timeout)
+                    match = _END_LINE.match(await flow.readline(timeout))
+                    try:
+                        # Anything but encoder output is echo or prompt
+                        data = _decode(_DATA_LINE.findall(block), tools.encoder)
+                    except (binascii.Error, ValueError):
+                        data = None
+                    if (match is None or data is None or int(match.group(1)) != index or
+                            hashlib.md5(data).hexdigest() != match.group(2).decode()):
+                        flow.retry(index)
+                        await flow.send(command(index))
+                        continue
+                    f.seek(index * chunk_size)
+                    f.write(data)
+                    done += 1
+                    flow.semaphore.release()
+
+            await _pipeline(sender, receiver)
+    except (OSError, ValueError, TransferError, TimeoutError, IncompleteReadError,
+            LimitOverrunError) as exc:
+        return TransferResult(sid, source, destination, 0, perf_counter() - start,
+                              error=str(exc) or repr(exc))
+    finally:
+        _release(session)
+    return TransferResult(sid, source, destination, size, perf_counter() - start, flow.retries)
@@ -24,9 +24,13 @@ class AssCatApp(App):
     }
     ENABLE_COMMAND_PALETTE = False
 
-    _acm: AssCatManager = AssCatManager()
     _livelog: RichLog | Widget = None
 
+    def __init__(self, acm: AssCatManager | None = None, **kwargs):
+        super().__init__(**kwargs)
+        # Built here, on the loop the app runs on, not at import time
+        self._acm: AssCatManager = AssCatManager() if acm is None else acm
+
     @property
     def acm(self) -> AssCatManager:
         return self._acm
@@ -2,9 +2,15 @@ from textual.app import ComposeResult
 from textual.containers import Horizontal, Container
 from textual.widgets import ListView
 
+from asscat.tui.output import LatencyStatus, PartialLine, SessionOutput
+
 
 class Connections(Horizontal):
 
     def compose(self) -> ComposeResult:
         yield ListView(classes='panel', id='connections_lst')
-        yield Container(classes='panel', id='connections_cfg')
+        with Container(classes='panel', id='connections_cfg'):
+            partial = PartialLine(id='session_partial')
+            yield SessionOutput(partial=partial, id='session_output')
+            yield partial
+            yield LatencyStatus(id='session_latency')
@@ -10,6 +10,7 @@ from textual.widgets import (
 from asscat.tui.connections import Connections
 from asscat.tui.listeners import Listeners
 from asscat.tui.sidebar import SideBar
+from asscat.tui.stats import Stats
 
 
 class OutputContainer(ContentSwitcher): ...
@@ -23,3 +24,4 @@ class Dashboard(TabPane):
         with OutputContainer(initial='listeners', id='switcher'):
             yield Listeners(id='listeners')
             yield Connections(id='connections')
+            yield Stats(id='stats')
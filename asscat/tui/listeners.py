@@ -116,7 +116,8 @@ class ListenerCreator(Static):
             Number(minimum=1, maximum=65535),
         ])
         yield Static(id='ph1')
-        yield Select(Protocols(), prompt='Protocol', id='protocolinput', value='TCP')
+        yield Select(Protocols(), prompt='Protocol', id='protocolinput', value='TCP',
+                     allow_blank=False)
         yield Checkbox('SSL', id='sslinput')
         yield Static(id='ph2')
         yield Static(id='ph3')
@@ -127,8 +128,13 @@ class ListenerCreator(Static):
             host: str = self.query_one('#hostinput').value
             port: int = int(self.query_one('#portinput').value)
             ssl: bool = self.query_one('#sslinput').value
+            protocol: str = self.query_one('#protocolinput').value
             acm: AssCatManager = self.app.acm
-            sid, server = await acm.create_listener(host, port)
+            try:
+                sid, server = await acm.create_listener(host, port, ssl=ssl, protocol=protocol)
+            except (OSError, ValueError) as e:
+                self.notify(str(e), title='Listener not created', severity='error')
+                return
             self.log('Created:', sid, server, self._list, host, port)
             await self._list.append(ListenerItem(server_id=sid, server=server))
             self.screen.set_focus(self._list)
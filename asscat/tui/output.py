@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import codecs
+from collections import deque
+from typing import Deque, Optional
+
+from rich.text import Text
+from textual import events
+from textual.timer import Timer
+from textual.widgets import RichLog, Static
+
+# Frames rendered per second at most
+FPS = 30
+# Lines kept by the view, older ones are dropped when it falls behind
+MAX_LINES = 2000
+# Output buffered between two frames before the oldest is dropped
+MAX_PENDING = 1024 * 1024
+# Characters an unterminated line may grow to before it's shown as a
+# line of its own anyway
+MAX_PARTIAL = 4096
+# Seconds between two updates of the latency line
+LATENCY_INTERVAL = 1.
+
+# What keys without a character of their own send to the session
+KEYS = {
+    'enter': b'\r',
+    'backspace': b'\x7f',
+    'up': b'\x1b[A',
+    'down': b'\x1b[B',
+    'right': b'\x1b[C',
+    'left': b'\x1b[D',
+    'home': b'\x1b[H',
+    'end': b'\x1b[F',
+    'delete': b'\x1b[3~',
+}
+
+
+class FrameBuffer:
+    """
+    Stands in as stdout transport of the session shown in the TUI.
+
+    write() only queues the chunk, no widget is touched. The view takes
+    everything queued once per frame. When more than ``max_bytes`` pile
+    up, e.g. while the view is hidden, the oldest chunks are dropped.
+    Output is decoded incrementally and only complete lines are taken,
+    the unterminated rest stays in ``partial`` until its newline comes.
+    """
+    __slots__ = ('_chunks', '_size', '_max_bytes', '_dropped', '_decoder', '_partial')
+
+    def __init__(self, max_bytes: int = MAX_PENDING):
+        self._chunks: Deque[bytes] = deque()
+        self._size: int = 0
+        self._max_bytes: int = max_bytes
+        self._dropped: int = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._partial: str = ''
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dropped(self) -> int:
+        """Bytes thrown away because the view fell behind"""
+        return self._dropped
+
+    @property
+    def partial(self) -> str:
+        """Decoded output after the last newline taken so far"""
+        return self._partial
+
+    def write(self, data) -> None:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self._max_bytes and len(self._chunks) > 1:
+            dropped = len(self._chunks.popleft())
+            self._size -= dropped
+            self._dropped += dropped
+            self._decoder.reset()
+            self._partial = ''
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def take(self) -> Optional[str]:
+        """Complete lines queued since the last take, None if nothing was"""
+        if not self._chunks:
+            return None
+        text = self._partial + self._decoder.decode(b''.join(self._chunks))
+        self._chunks.clear()
+        self._size = 0
+        end = text.rfind('\n') + 1
+        if len(text) - end > MAX_PARTIAL:
+            end = len(text)
+        self._partial = text[end:]
+        return text[:end]
+
+    def clear(self) -> None:
+        self._chunks.clear()
+        self._size = 0
+        self._decoder.reset()
+        self._partial = ''
+
+
+class PartialLine(Static):
+    """The unterminated last line of the active session, e.g. its prompt"""
+
+
+class SessionOutput(RichLog):
+    """
+    Shows the output of the active session, rendered at most ``fps``
+    times per second. Only the active session feeds it, output of
+    background sessions never reaches the TUI. Keys pressed while it
+    has focus are sent to the session. A line is logged once it's
+    complete, until then ``partial`` shows it.
+    """
+    can_focus = True
+
+    def __init__(
+            self,
+            fps: int = FPS,
+            max_lines: int = MAX_LINES,
+            partial: Optional[PartialLine] = None,
+            **kwargs,
+    ):
+        super().__init__(max_lines=max_lines, wrap=True, **kwargs)
+        self._fps: int = fps
+        self._line_limit: int = max_lines
+        self._frame: FrameBuffer = FrameBuffer()
+        self._partial: Optional[PartialLine] = partial
+        self._session = None
+        self._timer: Optional[Timer] = None
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def dropped(self) -> int:
+        return self._frame.dropped
+
+    def on_mount(self) -> None:
+        self._timer = self.set_interval(1 / self._fps, self._render_frame)
+
+    def on_unmount(self) -> None:
+        self.detach()
+
+    def attach(self, session) -> None:
+        self.detach()
+        self.clear()
+        self._session = session
+        if session is None:
+            return
+        scrollback = session.scrollback
+        if scrollback is not None and len(scrollback):
+            start = max(0, scrollback.line_count - self._line_limit)
+            self._frame.write(b''.join(scrollback.lines(start, self._line_limit)))
+        session.track_latency()
+        session.stdout_connection_made(self._frame)
+
+    def detach(self) -> None:
+        session = self._session
+        if session is not None:
+            session.stdout_connection_made(None)
+        self._session = None
+        self._frame.clear()
+        self._show_partial()
+
+    def on_key(self, event: events.Key) -> None:
+        session = self._session
+        if session is None:
+            return
+        data = KEYS.get(event.key)
+        if data is None:
+            if not event.character:
+                return
+            data = event.character.encode()
+        event.stop()
+        event.prevent_default()
+        session.stdin_data_received(data)
+
+    def _follow_active_session(self) -> None:
+        acm = self.app.acm
+        active_id = acm.active_session_id
+        current_id = self._session.session_id if self._session is not None else None
+        if active_id != current_id:
+            self.attach(acm.get_session(active_id))
+
+    def _render_frame(self) -> None:
+        self._follow_active_session()
+        if not self.is_on_screen:
+            return
+        text = self._frame.take()
+        if text is None:
+            return
+        if text:
+            lines = text.splitlines()
+            if len(lines) > self._line_limit:
+                lines = lines[-self._line_limit:]
+            self.write(Text.from_ansi('\n'.join(lines)))
+        self._show_partial()
+
+    def _show_partial(self) -> None:
+        partial = self._partial
+        if partial is not None:
+            # What a carriage return went back over is overwritten
+            partial.update(Text.from_ansi(self._frame.partial.rsplit('\r', 1)[-1]))
+
+
+class LatencyStatus(Static):
+    """Keystroke to echo latency of the active session, next to the network RTT"""
+
+    def on_mount(self) -> None:
+        self.set_interval(LATENCY_INTERVAL, self._refresh_latency)
+
+    def _refresh_latency(self) -> None:
+        acm = self.app.acm
+        session = acm.get_session(acm.active_session_id)
+        latency = getattr(session, 'latency', None)
+        if latency is None:
+            self.update('')
+            return
+        self.update(f'session {session.session_id} latency: {latency.summary()}')
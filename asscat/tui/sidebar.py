@@ -23,6 +23,11 @@ class SideBar(ListView):
             classes='menuitem',
             id='mi_connections',
         )
+        yield SideBarItem(
+            Label('STATS'),
+            classes='menuitem',
+            id='mi_stats',
+        )
 
     async def on_list_view_selected(self, event: ListView.Selected):
         await self._switch_menu_widget(event.item)
@@ -39,3 +44,6 @@ class SideBar(ListView):
 
         elif item.id == 'mi_connections':
             switcher.current = 'connections'
+
+        elif item.id == 'mi_stats':
+            switcher.current = 'stats'
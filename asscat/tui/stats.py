@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+from textual.app import ComposeResult
+from textual.containers import Vertical
+from textual.widgets import DataTable
+
+# Seconds between two refreshes of the tables
+REFRESH_INTERVAL = 1.
+
+LISTENER_COLUMNS = ('#', 'kind', 'address', 'accepted', 'closed', 'open', 'waiting', 'rejected')
+SESSION_COLUMNS = ('#', 'listener', 'peer', 'state', 'in KiB', 'out KiB',
+                   'chunks', 'pauses', 'buffered', 'peak', 'idle')
+
+
+def _kib(size: int) -> str:
+    return f'{size / 1024:.1f}'
+
+
+class Stats(Vertical):
+    """Per listener and per session counters, refreshed once per second"""
+
+    def compose(self) -> ComposeResult:
+        yield DataTable(id='stats_listeners', classes='panel', cursor_type='row')
+        yield DataTable(id='stats_sessions', classes='panel', cursor_type='row')
+
+    def on_mount(self) -> None:
+        self.query_one('#stats_listeners', DataTable).add_columns(*LISTENER_COLUMNS)
+        self.query_one('#stats_sessions', DataTable).add_columns(*SESSION_COLUMNS)
+        self.set_interval(REFRESH_INTERVAL, self._refresh_stats)
+
+    def _refresh_stats(self) -> None:
+        if not self.display:
+            return
+        snapshot = self.app.acm.metrics()
+        listeners = self.query_one('#stats_listeners', DataTable)
+        listeners.clear()
+        listeners.add_rows(
+            (m.listener_id, m.kind, m.address, m.accepted, m.closed, m.active, m.waiting, m.rejected)
+            for m in snapshot.listeners
+        )
+        sessions = self.query_one('#stats_sessions', DataTable)
+        sessions.clear()
+        sessions.add_rows(
+            (m.session_id, m.listener_id, m.peer, m.state or '', _kib(m.bytes_in),
+             _kib(m.bytes_out), m.chunks_in, m.read_pauses + m.write_pauses,
+             m.buffered, m.buffer_high_water, f'{m.idle:.0f}s')
+            for m in snapshot.sessions
+        )
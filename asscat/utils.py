@@ -1,6 +1,34 @@
-import os
-from argparse import Action, Namespace, ArgumentParser
-from asyncio import sleep
+import re
+import secrets
+from argparse import Action, ArgumentParser, BooleanOptionalAction, Namespace
+from asyncio import (
+    IncompleteReadError,
+    LimitOverrunError,
+    Semaphore,
+    TimeoutError,
+    as_completed,
+    wait_for,
+)
+from functools import lru_cache
+from shutil import get_terminal_size
+from time import perf_counter
+from typing import AsyncIterator, Iterable, NamedTuple, Optional, Sequence, Tuple
+
+from asscat.admission import BACKLOG, PAUSE, REJECT, AdmissionPolicy
+from asscat.control import CONTROL_PATH
+from asscat.liveness import IDLE_TIMEOUT, SUSPECT_TIMEOUT, LivenessPolicy
+
+# Tried in this order to spawn a pty on the target
+PTY_BINARIES = ('python3', 'python', 'script')
+# Seconds a session may take to come back with a pty
+UPGRADE_TIMEOUT = 10.
+# Sessions upgraded at once by default
+UPGRADE_CONCURRENCY = 32
+# Seconds to wait for the prompt of the spawned shell before probing anyway
+SPAWN_WAIT = 2.
+# Output ending in what looks like a shell prompt, color or cursor
+# escapes may follow it
+PROMPT = re.compile(rb'[$#%>] ?(?:\x1b\[[0-9;?]*[A-Za-z])*$')
 
 
 class AddressAction(Action):
@@ -36,22 +64,131 @@ def build_arg_parser() -> Namespace:
         "--listen",
         "-l",
         dest='listen',
-        action="store_true",
+        action=BooleanOptionalAction,
         default=True,
-        required=False,
-        help="Enable the bind protocol"
+        help="Start a listener on the address in headless mode"
     )
 
     parser.add_argument(
         "--tui",
         '--app',
         dest='tui',
-        action="store_true",
+        action=BooleanOptionalAction,
         default=True,
-        required=False,
         help="Start interactive Terminal-UI"
     )
 
+    parser.add_argument(
+        "--headless",
+        "-H",
+        dest='tui',
+        action="store_false",
+        help="Run without the Terminal-UI, same as --no-tui"
+    )
+
+    parser.add_argument(
+        "--raw",
+        dest='raw',
+        action="store_true",
+        help="Run headless and connect this terminal to the active session in raw mode, Ctrl-] quits"
+    )
+
+    parser.add_argument(
+        "--ssl",
+        dest='ssl',
+        nargs='?',
+        const=True,
+        default=None,
+        metavar='PROFILE',
+        help="Serve TLS with a certificate profile, 'default' if none is given"
+    )
+
+    parser.add_argument(
+        "--udp",
+        dest='udp',
+        action="store_true",
+        help="Listen for UDP datagrams instead of TCP connections"
+    )
+
+    parser.add_argument(
+        "--control",
+        dest='control',
+        nargs='?',
+        const=CONTROL_PATH,
+        default=None,
+        metavar='PATH',
+        help=f"Serve the control API on a Unix socket, {CONTROL_PATH} if none is given"
+    )
+
+    parser.add_argument(
+        "--buffered",
+        dest='buffered',
+        action="store_true",
+        help="Use the BufferedProtocol session variant"
+    )
+
+    parser.add_argument(
+        "--max-sessions",
+        dest='max_sessions',
+        type=int,
+        default=None,
+        metavar='N',
+        help="Admit at most N sessions at once"
+    )
+
+    parser.add_argument(
+        "--accept-rate",
+        dest='accept_rate',
+        type=float,
+        default=None,
+        metavar='N',
+        help="Admit at most N sessions per second"
+    )
+
+    parser.add_argument(
+        "--accept-queue",
+        dest='accept_queue',
+        type=int,
+        default=0,
+        metavar='N',
+        help="Connections over a limit that wait for admission"
+    )
+
+    parser.add_argument(
+        "--overflow",
+        dest='overflow',
+        choices=(REJECT, PAUSE),
+        default=REJECT,
+        help="Close connections finding the queue full, or stop accepting"
+    )
+
+    parser.add_argument(
+        "--backlog",
+        dest='backlog',
+        type=int,
+        default=BACKLOG,
+        metavar='N',
+        help=f"Connections the kernel queues before they're accepted, {BACKLOG} by default"
+    )
+
+    parser.add_argument(
+        "--idle-timeout",
+        dest='idle_timeout',
+        type=float,
+        default=IDLE_TIMEOUT,
+        metavar='S',
+        help=f"Seconds without data before a session is checked for a dead peer, {IDLE_TIMEOUT:.0f} by default"
+    )
+
+    parser.add_argument(
+        "--suspect-timeout",
+        dest='suspect_timeout',
+        type=float,
+        default=SUSPECT_TIMEOUT,
+        metavar='S',
+        help=f"Seconds a suspect session gets before it's closed as dead, {SUSPECT_TIMEOUT:.0f} by default"
+    )
+
     parser.add_argument(
         'address',
         nargs='*',
@@ -63,23 +200,141 @@ def build_arg_parser() -> Namespace:
     return parser.parse_args()
 
 
-async def upgrade_pty(stream, binary: str = 'python', shell: str = '/bin/bash') -> None:
-    """Upgrades reverse shell to fully functional TTY when run"""
+def admission_policy(args: Namespace) -> AdmissionPolicy:
+    """Global admission limits from the command line"""
+    return AdmissionPolicy(
+        backlog=args.backlog,
+        max_sessions=args.max_sessions,
+        rate=args.accept_rate,
+        queue=args.accept_queue,
+        overflow=args.overflow,
+    )
+
 
-    # Get host terminal size
-    cols, lines = os.get_terminal_size(1)
+def liveness_policy(args: Namespace) -> LivenessPolicy:
+    """Dead peer detection timeouts from the command line"""
+    return LivenessPolicy(idle_timeout=args.idle_timeout, suspect_timeout=args.suspect_timeout)
 
-    if binary == 'script':
-        await stream.write(f'{binary} -qc {shell} /dev/null 2>&1\n'.encode())
-    elif binary.startswith('python'):
-        await stream.write(f'{binary} -c "import pty; pty.spawn(\'{shell}\')" 2>&1\n'.encode())
 
-    await stream.write(
-        #f'stty 5500:5:bf:8a3b:3:1c:7f:15:4:0:1:0:11:13:1a:0:12:f:17:16:0:0:0:0:0:0:0:0:0:0:0:0:0:0:0:0'
-        #f'stty raw -echo;'
-        f'reset && export SHELL={shell};'
-        f'export TERM=xterm-256color;'
-        f'stty rows {lines} columns {cols};'
-        f'\n'.encode()
-    )
-    await sleep(.01)
+@lru_cache(maxsize=None)
+def terminal_size() -> Tuple[int, int]:
+    """Columns and lines of the local terminal, looked up once"""
+    size = get_terminal_size((80, 24))
+    return size.columns, size.lines
+
+
+def _spawn_command(binaries: Sequence[str], shell: str) -> str:
+    """Shell line that starts the first available of ``binaries``"""
+    branches = []
+    for binary in binaries:
+        if binary == 'script':
+            spawn = f'script -qc {shell} /dev/null'
+        elif binary.startswith('python'):
+            spawn = f"{binary} -c 'import pty; pty.spawn(\"{shell}\")'"
+        else:
+            raise ValueError(f'Can not spawn a pty with {binary!r}')
+        keyword = 'elif' if branches else 'if'
+        branches.append(f'{keyword} command -v {binary} >/dev/null 2>&1; '
+                        f'then ASSCAT_VIA={binary} {spawn}')
+    return '; '.join(branches) + '; fi\n'
+
+
+class UpgradeResult(NamedTuple):
+    session_id: int
+    binary: Optional[str]
+    latency: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def _skip_until(reader, regex: re.Pattern) -> Tuple[bytes, re.Match]:
+    """read_until_regex() that skips output past the reader limit"""
+    while True:
+        try:
+            return await reader.read_until_regex(regex)
+        except LimitOverrunError as exc:
+            # Output unrelated to the upgrade, skip over it but keep
+            # what may be the start of a match
+            await reader.read(max(exc.consumed - 64, 1))
+
+
+async def upgrade_pty(
+        session,
+        binaries: Sequence[str] = PTY_BINARIES,
+        shell: str = '/bin/bash',
+        size: Optional[Tuple[int, int]] = None,
+        timeout: float = UPGRADE_TIMEOUT,
+) -> UpgradeResult:
+    """
+    Upgrade the reverse shell of ``session`` to a pty, spawned with the
+    first of ``binaries`` the target has.
+
+    Instead of sleeping, the probe line is sent once the spawned shell
+    printed its prompt, or after SPAWN_WAIT if none shows up. Sent along
+    with the spawn command, a shell reading its input in blocks would
+    run it before the pty exists. The probe answers with a marker naming
+    the binary if its stdin is a tty. The latency is the time until
+    that marker arrived.
+    """
+    sid = session.session_id
+    start = perf_counter()
+    reader = getattr(session, 'reader', None)
+    writer = getattr(session, 'writer', None)
+    if reader is None or writer is None:
+        return UpgradeResult(sid, None, 0., 'session has no local reader')
+
+    cols, lines = size or terminal_size()
+    token = secrets.token_hex(6)
+    # The quotes keep the echoed probe from matching the marker
+    probe = (f'export SHELL={shell} TERM=xterm-256color; stty rows {lines} columns {cols} 2>/dev/null; '
+             f'if tty -s; then echo ASSCAT_"PTY"_{token}_"$ASSCAT_VIA".; '
+             f'else echo ASSCAT_"PTY"_{token}_none.; fi\n')
+    marker = re.compile(rb'ASSCAT_PTY_%s_(\w*)\.' % token.encode())
+
+    try:
+        # Output from before may end in the prompt of the current shell
+        reader.release()
+        writer.write(_spawn_command(binaries, shell).encode())
+        await writer.flush()
+        try:
+            await wait_for(_skip_until(reader, PROMPT), min(SPAWN_WAIT, timeout))
+        except TimeoutError:
+            # Nothing spawned or no prompt, the probe tells which
+            pass
+        writer.write(probe.encode())
+        await writer.flush()
+        _, match = await wait_for(_skip_until(reader, marker), timeout)
+    except TimeoutError:
+        return UpgradeResult(sid, None, perf_counter() - start, 'timeout')
+    except (IncompleteReadError, ConnectionError, RuntimeError) as exc:
+        return UpgradeResult(sid, None, perf_counter() - start, repr(exc))
+    finally:
+        reader.release()
+
+    latency = perf_counter() - start
+    binary = match.group(1).decode()
+    if binary in ('', 'none'):
+        return UpgradeResult(sid, None, latency, 'no pty, none of ' + ', '.join(binaries) + ' worked')
+    return UpgradeResult(sid, binary, latency)
+
+
+async def upgrade_ptys(
+        sessions: Iterable,
+        concurrency: int = UPGRADE_CONCURRENCY,
+        **kwargs,
+) -> AsyncIterator[UpgradeResult]:
+    """
+    Upgrade ``sessions`` with at most ``concurrency`` at once and yield
+    the results in the order they finish.
+    """
+    semaphore = Semaphore(concurrency)
+
+    async def _bounded(session):
+        async with semaphore:
+            return await upgrade_pty(session, **kwargs)
+
+    for fut in as_completed([_bounded(session) for session in sessions]):
+        yield await fut
@@ -0,0 +1,107 @@
+"""
+Event loop lag and admission counters under a burst of callbacks.
+
+A client process opens ``--connections`` connections as fast as it can,
+each stays open for ``--hold`` seconds, connections not
+accepted by then give up. The manager serves them under several
+admission policies and closes sessions once their peer hung up, while a
+timer measures how late the loop gets to run it, which is what the
+Terminal-UI would feel.
+
+    python -m benchmarks.bench_admission [--connections N] [--hold S]
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from time import perf_counter
+
+import uvloop
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.admission import AdmissionPolicy  # noqa: E402
+from asscat.manager import AssCatManager  # noqa: E402
+
+POLICIES = (
+    ('no limits', AdmissionPolicy()),
+    ('500/s, queue 10000', AdmissionPolicy(rate=500, burst=50, queue=10000)),
+    ('max 1000, reject', AdmissionPolicy(max_sessions=1000)),
+    ('max 1000, pause', AdmissionPolicy(max_sessions=1000, queue=100, overflow='pause')),
+)
+# Seconds between two looks at the loop's lag
+TICK = 0.001
+
+
+async def burst(port: int, connections: int, hold: float) -> None:
+    semaphore = asyncio.Semaphore(512)
+
+    async def one():
+        async with semaphore:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection('127.0.0.1', port), hold)
+            except (asyncio.TimeoutError, OSError):
+                return
+        try:
+            await asyncio.wait_for(reader.read(), hold)
+        except (asyncio.TimeoutError, OSError):
+            pass
+        writer.close()
+
+    await asyncio.gather(*(one() for _ in range(connections)))
+
+
+def run_burst(port: int, connections: int, hold: float) -> None:
+    uvloop.run(burst(port, connections, hold))
+
+
+async def measure(policy: AdmissionPolicy, connections: int, hold: float) -> tuple:
+    loop = asyncio.get_running_loop()
+    acm = AssCatManager(loop, idle_reclaim=None, search_memory=None)
+    l_id, listener = await acm.create_listener('127.0.0.1', 0, admission=policy)
+    await acm.start_listener(l_id)
+    port = listener.sockets[0].getsockname()[1]
+    lags = []
+
+    def tick(expected):
+        now = loop.time()
+        lags.append(now - expected)
+        loop.call_at(now + TICK, tick, now + TICK)
+
+    loop.call_at(loop.time() + TICK, tick, loop.time() + TICK)
+    process = multiprocessing.Process(target=run_burst, args=(port, connections, hold))
+    start = perf_counter()
+    process.start()
+    while process.is_alive():
+        await asyncio.sleep(0.05)
+        for session in list(acm.sessions):
+            if session.reader is not None and session.reader.at_eof():
+                session.transport.close()
+    elapsed = perf_counter() - start
+    metrics = acm.metrics().listeners[0]
+    await acm.shutdown()
+    lags.sort()
+    return (elapsed, lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000, metrics)
+
+
+def main(args):
+    os.chdir(args.log_dir)
+    print(f'{args.connections} connections, held {args.hold}s\n')
+    print(f'{"policy":<22}{"burst s":>9}{"p99 lag ms":>12}{"max lag ms":>12}'
+          f'{"admitted":>10}{"queued":>8}{"rejected":>10}{"pauses":>8}')
+    for name, policy in POLICIES:
+        elapsed, p99, worst, m = uvloop.run(measure(policy, args.connections, args.hold))
+        print(f'{name:<22}{elapsed:>9.2f}{p99:>12.1f}{worst:>12.1f}'
+              f'{m.accepted:>10}{m.queued:>8}{m.rejected:>10}{m.pauses:>8}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', type=int, default=5000)
+    parser.add_argument('--hold', type=float, default=2.)
+    parser.add_argument('--log-dir', default=tempfile.gettempdir(), help='Where asscat.log is written')
+    main(parser.parse_args())
@@ -0,0 +1,88 @@
+"""
+Microbenchmark of Cmds input classification against the former
+decode-and-split dispatcher, for keystrokes, shell lines and commands.
+
+    python -m benchmarks.bench_dispatch [--lines N] [--rounds N]
+"""
+import asyncio
+import os
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.commands import Cmds  # noqa: E402
+
+INPUTS = {
+    'keystroke': [b'l', b's', b' ', b'-', b'l', b'a', b'\r', b'\x1b[A', b'\x7f'],
+    'shell line': [b'ls -la /tmp\n', b'id\n', b'cat /etc/passwd | grep root\n', b'uname -a\n'],
+    'lookalike': [b'sudo -l\n', b'echo $PATH\n', b'export TERM=xterm\n', b'bash\n'],
+    'builtin': [b'sessions\n', b'sessions 3\n', b'back\n'],
+}
+
+
+class LegacyCmds:
+    """The dispatcher Cmds.parse replaced, empty input guarded"""
+
+    def __init__(self, cmds: Cmds):
+        self._commands = {name: getattr(cmds, name) for name in cmds.commands}
+
+    def match(self, raw_cmd: bytes):
+        cmd = raw_cmd.decode().split()
+        if cmd and cmd[0] in self._commands.keys():
+            return self._commands[cmd[0]], cmd[1:]
+        return None
+
+    async def parse(self, raw_cmd: bytes):
+        cmd = raw_cmd.decode().split()
+        if cmd and cmd[0] in self._commands.keys():
+            return await self._commands[cmd[0]](cmd[1:])
+        return raw_cmd
+
+
+def run_match(match, lines, rounds) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = perf_counter()
+        for line in lines:
+            match(line)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+async def run_parse(parse, lines, rounds) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        start = perf_counter()
+        for line in lines:
+            await parse(line)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+async def main(count: int, rounds: int):
+    cmds = Cmds(asyncio.get_running_loop(), output=lambda _: None)
+    legacy = LegacyCmds(cmds)
+    print('classification only, per input')
+    print(f'{"input":<12}{"Cmds":>14}{"legacy":>14}{"speedup":>10}')
+    for name, inputs in INPUTS.items():
+        lines = (inputs * (count // len(inputs) + 1))[:count]
+        new = run_match(cmds.match, lines, rounds)
+        old = run_match(legacy.match, lines, rounds)
+        print(f'{name:<12}{new / count * 1e9:>11.0f}ns{old / count * 1e9:>11.0f}ns{old / new:>9.2f}x')
+    print('\nawait parse(), per input')
+    for name, inputs in INPUTS.items():
+        lines = (inputs * (count // len(inputs) + 1))[:count]
+        new = await run_parse(cmds.parse, lines, rounds)
+        old = await run_parse(legacy.parse, lines, rounds)
+        print(f'{name:<12}{new / count * 1e9:>11.0f}ns{old / count * 1e9:>11.0f}ns{old / new:>9.2f}x')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=200000, help='Inputs per case')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.lines, args.rounds))
@@ -0,0 +1,118 @@
+"""
+Bookkeeping cost of tracking session liveness at up to 50k sessions.
+
+Compares the timer wheel of the liveness checks against one loop timer
+per session: arming a deadline for every session, moving all of them
+as if every session had sent data, the time spent in the timers over
+a full idle timeout and the memory held. The loop's clock is simulated,
+a run takes seconds, not minutes.
+
+    python -m benchmarks.bench_liveness [--sessions N,N,...] [--idle S]
+"""
+import asyncio
+import gc
+import heapq
+import os
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.liveness import TimerWheel  # noqa: E402
+
+
+class SimulatedLoop(asyncio.BaseEventLoop):
+    """Event loop whose clock only moves when advance() says so"""
+
+    def __init__(self):
+        super().__init__()
+        self._now = 1000.
+
+    def time(self):
+        return self._now
+
+    def advance(self, seconds: float) -> None:
+        """Run everything due within the next ``seconds``"""
+        end = self._now + seconds
+        scheduled = self._scheduled
+        while scheduled and scheduled[0].when() <= end:
+            handle = heapq.heappop(scheduled)
+            handle._scheduled = False
+            self._now = max(self._now, handle.when())
+            if not handle.cancelled():
+                handle._run()
+        self._now = end
+
+
+def per_session_timers(loop, sessions: int, idle: float) -> tuple:
+    fired = []
+    handles = {}
+    start = perf_counter()
+    for sid in range(sessions):
+        handles[sid] = loop.call_at(loop.time() + idle + sid % 60, fired.append, sid)
+    armed = perf_counter() - start
+    start = perf_counter()
+    for sid in range(sessions):
+        handles[sid].cancel()
+        handles[sid] = loop.call_at(loop.time() + idle + sid % 60 + 1, fired.append, sid)
+    moved = perf_counter() - start
+    start = perf_counter()
+    loop.advance(idle + 61)
+    ticking = perf_counter() - start
+    return armed, moved, ticking, len(fired), handles
+
+
+def wheel(loop, sessions: int, idle: float) -> tuple:
+    fired = []
+    timers = TimerWheel(loop, fired.extend)
+    start = perf_counter()
+    for sid in range(sessions):
+        timers.add(sid, loop.time() + idle + sid % 60)
+    armed = perf_counter() - start
+    start = perf_counter()
+    for sid in range(sessions):
+        timers.add(sid, loop.time() + idle + sid % 60 + 1)
+    moved = perf_counter() - start
+    start = perf_counter()
+    loop.advance(idle + 61)
+    ticking = perf_counter() - start
+    return armed, moved, ticking, len(fired), timers
+
+
+def measure(run, sessions: int, idle: float) -> tuple:
+    loop = SimulatedLoop()
+    gc.collect()
+    armed, moved, ticking, fired, _ = run(loop, sessions, idle)
+    assert fired == sessions, (fired, sessions)
+    loop.close()
+    # Memory is traced in a run of its own, tracing slows everything down
+    loop = SimulatedLoop()
+    gc.collect()
+    tracemalloc.start()
+    *_, keep = run(loop, sessions, idle)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del keep
+    loop.close()
+    return armed, moved, ticking, memory
+
+
+def main(args):
+    print(f'{"":<18}{"sessions":>9}{"arm us":>9}{"move us":>9}{"timers ms":>11}{"MiB":>8}')
+    for sessions in args.sessions:
+        for name, run in (('call_at each', per_session_timers), ('timer wheel', wheel)):
+            armed, moved, ticking, memory = measure(run, sessions, args.idle)
+            print(f'{name:<18}{sessions:>9}{armed / sessions * 1e6:>9.2f}'
+                  f'{moved / sessions * 1e6:>9.2f}{ticking * 1000:>11.1f}'
+                  f'{memory / 1024 / 1024:>8.1f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessions', type=lambda v: [int(n) for n in v.split(',')],
+                        default=[1000, 10000, 50000])
+    parser.add_argument('--idle', type=float, default=300., help='Idle timeout in seconds')
+    main(parser.parse_args())
@@ -0,0 +1,120 @@
+"""
+Memory held per idle session, before and after its buffers are released.
+
+Opens ``--sessions`` connections whose peers send a burst of shell output
+and then go quiet, in ``--cycles`` rounds. Every round reports the
+footprint the manager estimates and what tracemalloc and the process RSS
+measure per session, right after the burst and after reclaim_idle().
+
+    python -m benchmarks.bench_memory [--sessions N] [--burst KB] [--cycles N] [--buffered]
+"""
+import asyncio
+import gc
+import logging
+import os
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.manager import AssCatManager  # noqa: E402
+
+LINE = b'-rw-r--r-- 1 root root 1024 Jan  1 00:00 /var/log/some/file.log\n'
+
+
+class Shell(asyncio.Protocol):
+    """Peer that prints a burst of output whenever asked to"""
+
+    def __init__(self):
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def burst(self, size: int):
+        lines = LINE * (size // len(LINE) + 1)
+        for i in range(0, size, 4096):
+            self.transport.write(lines[i:min(i + 4096, size)])
+
+
+def rss() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+async def settle(acm: AssCatManager) -> None:
+    """Wait until no session received anything for a while"""
+    last = -1
+    while True:
+        await asyncio.sleep(0.2)
+        total = sum(session.stats.bytes_in for session in acm.sessions)
+        if total == last:
+            return
+        last = total
+
+
+def report(label: str, acm: AssCatManager, count: int, traced: int, base_rss: int) -> None:
+    footprints = acm.top_memory(count)
+    total = sum(f.total for f in footprints)
+    parts = {}
+    for f in footprints:
+        for name in ('objects', 'reader', 'writer', 'recv_blocks', 'scrollback'):
+            parts[name] = parts.get(name, 0) + getattr(f, name)
+    detail = ', '.join(f'{name} {size / count / 1024:.1f}' for name, size in parts.items())
+    print(f'{label:<16}{total / count / 1024:>10.1f}{traced / count / 1024:>12.1f}'
+          f'{(rss() - base_rss) / count / 1024:>10.1f}   {detail}')
+
+
+async def main(sessions: int, burst: int, cycles: int, buffered: bool):
+    loop = asyncio.get_running_loop()
+    acm = AssCatManager(loop, buffered=buffered, idle_reclaim=None)
+    l_id, server = await acm.create_listener('127.0.0.1', 0)
+    await acm.start_listener(l_id)
+    port = server.sockets[0].getsockname()[1]
+
+    gc.collect()
+    tracemalloc.start()
+    base_traced, base_rss = tracemalloc.get_traced_memory()[0], rss()
+    shells = []
+    for _ in range(sessions):
+        _, shell = await loop.create_connection(Shell, '127.0.0.1', port)
+        shells.append(shell)
+    while len(acm.sessions) < sessions:
+        await asyncio.sleep(0.05)
+
+    print(f'{sessions} sessions, {burst} KB bursts, '
+          f'{"buffered" if buffered else "plain"} protocol, KiB per session')
+    print(f'{"":<16}{"estimate":>10}{"tracemalloc":>12}{"rss":>10}   estimate by part')
+    await settle(acm)
+    gc.collect()
+    report('connected', acm, sessions, tracemalloc.get_traced_memory()[0] - base_traced, base_rss)
+    for cycle in range(1, cycles + 1):
+        for shell in shells:
+            shell.burst(burst * 1024)
+        await settle(acm)
+        gc.collect()
+        report(f'burst {cycle}', acm, sessions, tracemalloc.get_traced_memory()[0] - base_traced, base_rss)
+        acm.set_active_session(None)
+        acm.reclaim_idle(0)
+        # Spilled tails are freed once the scrollback writer thread wrote them
+        await asyncio.sleep(0.2)
+        gc.collect()
+        report(f'released {cycle}', acm, sessions, tracemalloc.get_traced_memory()[0] - base_traced, base_rss)
+
+    tracemalloc.stop()
+    for shell in shells:
+        shell.transport.close()
+    await acm.shutdown()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--burst', type=int, default=64, help='KB of output per session and cycle')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--buffered', action='store_true', help='Use AssCatBufferedProtocol')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    asyncio.run(main(args.sessions, args.burst, args.cycles, args.buffered))
@@ -0,0 +1,109 @@
+"""
+Throughput of AssCatProtocol against AssCatBufferedProtocol under load.
+
+Every client connection pushes ``--size`` MB into a listener whose sessions
+drain their reader in 64K blocks. The unread rows leave the readers
+alone, as the Terminal-UI and headless mode do, every byte still has to
+reach the sessions.
+
+    python -m benchmarks.bench_protocols [--clients N] [--size MB] [--loop uvloop]
+"""
+import asyncio
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.manager import AssCatManager  # noqa: E402
+
+# Seconds the clients of a run get before it counts as stalled
+TIMEOUT = 60.
+
+
+class DrainingManager(AssCatManager):
+    """Manager that reads every session until EOF"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drained = []
+
+    def client_connected_cb(self, session, peername) -> None:
+        super().client_connected_cb(session, peername)
+        self.drained.append(self._loop.create_task(self._drain(session)))
+
+    @staticmethod
+    async def _drain(session) -> int:
+        total = 0
+        reader, writer = session.reader, session.writer
+        while block := await reader.read(65536):
+            total += len(block)
+        writer.close()
+        return total
+
+
+async def client(host, port, payload: bytes, size: int):
+    _, writer = await asyncio.open_connection(host, port)
+    for _ in range(size // len(payload)):
+        writer.write(payload)
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def run(buffered: bool, clients: int, size: int, port: int, drain: bool = True) -> float:
+    loop = asyncio.get_running_loop()
+    acm = (DrainingManager if drain else AssCatManager)(loop, buffered=buffered)
+    l_id, server = await acm.create_listener('127.0.0.1', port)
+    await acm.start_listener(l_id)
+    payload = os.urandom(64 * 1024)
+
+    start = perf_counter()
+    sending = asyncio.gather(*(client('127.0.0.1', port, payload, size) for _ in range(clients)))
+    try:
+        await asyncio.wait_for(sending, TIMEOUT)
+    except asyncio.TimeoutError:
+        raise AssertionError(f'clients stalled after '
+                             f'{sum(s.stats.bytes_in for s in acm.sessions)} bytes') from None
+    if drain:
+        received = sum(await asyncio.gather(*acm.drained))
+    else:
+        # The sessions outlive their half-closed peers
+        received = sum(session.stats.bytes_in for session in acm.sessions)
+    elapsed = perf_counter() - start
+
+    await acm.shutdown()
+    await server.wait_closed()
+    assert received == clients * (size // len(payload)) * len(payload)
+    return received / elapsed / 1024 / 1024
+
+
+async def main(args):
+    for drain in (True, False):
+        for buffered in (False, True):
+            name = 'AssCatBufferedProtocol' if buffered else 'AssCatProtocol'
+            if not drain:
+                name += ', unread'
+            mbs = max([await run(buffered, args.clients, args.size << 20, args.port, drain)
+                       for _ in range(args.rounds)])
+            print(f'{name:<32}{mbs:>10.1f} MB/s')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--size', type=int, default=32, help='MB sent per client')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--port', type=int, default=18888)
+    parser.add_argument('--loop', choices=('asyncio', 'uvloop'), default='uvloop')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    print(f'loop: {args.loop}')
+    if args.loop == 'uvloop':
+        import uvloop
+        uvloop.run(main(args))
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,101 @@
+"""
+Microbenchmark of AssCatReader against asyncio.StreamReader, which keeps
+the old single-bytearray buffer layout.
+
+    python -m benchmarks.bench_reader [--size MB] [--rounds N]
+"""
+import asyncio
+import os
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.streams import AssCatReader  # noqa: E402
+
+LINE = b'drwxr-xr-x 2 root root 4096 Jan  1 00:00 /usr/share/some/long/path\n'
+
+
+def make_payload(size: int) -> bytes:
+    return LINE * (size // len(LINE))
+
+
+def feed(reader, payload: bytes, chunk_size: int):
+    for i in range(0, len(payload), chunk_size):
+        reader.feed_data(payload[i:i + chunk_size])
+    reader.feed_eof()
+
+
+async def drain_readline(reader):
+    while await reader.readline():
+        pass
+
+
+async def drain_read(reader, n=512):
+    while await reader.read(n):
+        pass
+
+
+async def drain_read_bulk(reader):
+    await drain_read(reader, 65536)
+
+
+async def drain_read_until(reader, sep=b'root '):
+    try:
+        while True:
+            await reader.read_until(sep)
+    except asyncio.IncompleteReadError:
+        pass
+
+
+async def drain_stdlib_read_until(reader, sep=b'root '):
+    try:
+        while True:
+            await reader.readuntil(sep)
+    except asyncio.IncompleteReadError:
+        pass
+
+
+CASES = {
+    'readline': (drain_readline, drain_readline),
+    'read(512)': (drain_read, drain_read),
+    'read(64K)': (drain_read_bulk, drain_read_bulk),
+    'read_until': (drain_read_until, drain_stdlib_read_until),
+}
+
+
+async def run_case(factory, drain, payload, chunk_size, rounds) -> float:
+    best = float('inf')
+    loop = asyncio.get_running_loop()
+    for _ in range(rounds):
+        reader = factory(loop)
+        start = perf_counter()
+        feed(reader, payload, chunk_size)
+        await drain(reader)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+async def main(size_mb: int, rounds: int):
+    payload = make_payload(size_mb * 1024 * 1024)
+    limit = 2 ** 16
+    factories = {
+        'AssCatReader': lambda loop: AssCatReader(loop, limit=limit),
+        'StreamReader': lambda loop: asyncio.StreamReader(limit=limit, loop=loop),
+    }
+    print(f'{"case":<12}{"chunk":>8}{"AssCatReader":>16}{"StreamReader":>16}{"speedup":>10}')
+    for name, (acr_drain, std_drain) in CASES.items():
+        for chunk_size in (512, 16384, 262144):
+            acr = await run_case(factories['AssCatReader'], acr_drain, payload, chunk_size, rounds)
+            std = await run_case(factories['StreamReader'], std_drain, payload, chunk_size, rounds)
+            print(f'{name:<12}{chunk_size:>8}{acr * 1e3:>13.1f}ms{std * 1e3:>13.1f}ms{std / acr:>9.2f}x')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=8, help='Stream size in MB')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.size, args.rounds))
@@ -0,0 +1,97 @@
+"""
+Indexing throughput, memory and search latency of the cross-session index.
+
+Fills the scrollback of ``--sessions`` sessions with ``--size`` KB of
+generated shell output each, indexes it and times searches through the
+index against scanning every scrollback.
+
+    python -m benchmarks.bench_search [--sessions N] [--size KB] [--memory MB] [--limit N]
+"""
+import asyncio
+import os
+import random
+import re
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.scrollback import ScrollbackBudget  # noqa: E402
+from asscat.search import SearchIndex  # noqa: E402
+
+WORDS = (b'drwxr-xr-x', b'-rw-r--r--', b'root', b'www-data', b'4096', b'Jan', b'12:00',
+         b'/etc', b'/var/log', b'nginx', b'error', b'warning', b'connected', b'uid=0(root)',
+         b'Permission denied', b'No such file or directory', b'$', b'#')
+
+SEARCHES = (
+    ('rare literal', b'db-prod-07.internal', {}),
+    ('common literal', b'Permission denied', {}),
+    ('ignore case', b'PASSWORD for', {'ignore_case': True}),
+    ('regex', rb'host-\d+\.corp', {'regex': True}),
+    ('regex, no literal', rb'\d{3}-\d{4}', {'regex': True}),
+)
+
+
+def shell_output(size: int, needles) -> bytes:
+    lines = []
+    total = 0
+    while total < size:
+        if random.random() < 0.001:
+            line = random.choice(needles)
+        else:
+            line = b' '.join(random.choices(WORDS, k=8)) + b' ' + os.urandom(4).hex().encode()
+        lines.append(line)
+        total += len(line) + 1
+    return b'\n'.join(lines)[:size]
+
+
+def naive(budget, pattern: bytes, flags: int, regex: bool) -> int:
+    compiled = re.compile(pattern if regex else re.escape(pattern), flags)
+    return sum(len(compiled.findall(store.read(0))) for store in budget)
+
+
+def main(args):
+    random.seed(7)
+    loop = asyncio.new_event_loop()
+    budget = ScrollbackBudget(256 * 1024 * 1024)
+    needles = (b'ssh root@db-prod-07.internal', b'[sudo] password for admin:',
+               b'ping host-42.corp', b'call 555-0199')
+    for sid in range(args.sessions):
+        budget.create(sid).append(shell_output(args.size * 1024, needles))
+    total = args.sessions * args.size * 1024
+    index = SearchIndex(loop, budget, max_memory=args.memory << 20)
+
+    start = perf_counter()
+    index.update()
+    elapsed = perf_counter() - start
+    stats = index.stats()
+    print(f'{args.sessions} sessions, {total / 1e6:.0f} MB of output')
+    done = stats.indexed + stats.evicted
+    print(f'indexed {done / 1e6:.0f} MB in {elapsed:.2f}s '
+          f'({done / elapsed / 1e6:.1f} MB/s), index {stats.memory / 1024 / 1024:.1f} MiB '
+          f'in {stats.segments} segments, {stats.evicted / 1e6:.0f} MB of it evicted\n')
+
+    print(f'{"search":<20}{"index ms":>10}{"scan ms":>10}{"hits":>8}')
+    for name, pattern, kwargs in SEARCHES:
+        start = perf_counter()
+        hits = index.search(pattern, limit=args.limit, **kwargs)
+        indexed = perf_counter() - start
+        start = perf_counter()
+        found = naive(budget, pattern, re.IGNORECASE if kwargs.get('ignore_case') else 0,
+                      kwargs.get('regex', False))
+        scanned = perf_counter() - start
+        note = '' if found == len(hits) else f' (of {found})'
+        print(f'{name:<20}{indexed * 1000:>10.1f}{scanned * 1000:>10.1f}{len(hits):>8}{note}')
+    budget.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=300)
+    parser.add_argument('--size', type=int, default=256, help='KB of output per session')
+    parser.add_argument('--memory', type=int, default=64, help='MB the index may use')
+    parser.add_argument('--limit', type=int, default=1000, help='Hits a search returns at most')
+    main(parser.parse_args())
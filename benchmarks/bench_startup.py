@@ -0,0 +1,84 @@
+"""
+Startup time and memory of headless mode against the Terminal-UI.
+
+Starts ``python -m asscat --headless`` ``--runs`` times and measures the
+time until its listener accepts a connection and the RSS it has then. The
+Terminal-UI is measured up to its imports, which is what headless skips.
+
+    python -m benchmarks.bench_startup [--runs N]
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+from argparse import ArgumentParser
+from statistics import median
+from time import perf_counter, sleep
+
+this = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(this)
+
+# Prints the RSS in KiB once everything the Terminal-UI needs is imported
+TUI_IMPORTS = (
+    'import asscat.__main__, asscat.tui.ac_app;'
+    'print(open("/proc/self/status").read().split("VmRSS:")[1].split()[0])'
+)
+
+
+def rss_kib(pid: int) -> int:
+    with open(f'/proc/{pid}/status') as f:
+        return int(f.read().split('VmRSS:')[1].split()[0])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def headless(log_dir: str) -> tuple:
+    port = free_port()
+    start = perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'asscat', '--headless', '127.0.0.1', str(port)],
+        cwd=log_dir, env={**os.environ, 'PYTHONPATH': root},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except ConnectionRefusedError:
+                if process.poll() is not None:
+                    raise RuntimeError(f'headless asscat exited with {process.returncode}')
+                sleep(0.001)
+        elapsed = perf_counter() - start
+        return elapsed, rss_kib(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(10)
+
+
+def tui_imports() -> tuple:
+    start = perf_counter()
+    out = subprocess.run([sys.executable, '-c', TUI_IMPORTS], cwd=root,
+                         capture_output=True, check=True, text=True).stdout
+    return perf_counter() - start, int(out)
+
+
+def main(runs: int, log_dir: str) -> None:
+    print(f'{"":<24}{"startup ms":>12}{"RSS MiB":>10}')
+    for name, measure in (('headless listening', lambda: headless(log_dir)),
+                          ('tui imported', tui_imports)):
+        results = [measure() for _ in range(runs)]
+        print(f'{name:<24}{median(r[0] for r in results) * 1000:>12.0f}'
+              f'{median(r[1] for r in results) / 1024:>10.1f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--log-dir', default='/tmp', help='Where headless runs write asscat.log')
+    args = parser.parse_args()
+    main(args.runs, args.log_dir)
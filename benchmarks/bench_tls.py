@@ -0,0 +1,175 @@
+"""
+Handshakes per second and bulk throughput of TLS listeners against plaintext.
+
+Handshakes are made by ``--clients`` threads that connect, wait for the
+server's first byte and disconnect, full or resuming the session of their
+previous connection. Throughput is measured like bench_protocols, every
+client pushing ``--size`` MB into sessions that drain their reader.
+
+    python -m benchmarks.bench_tls [--clients N] [--seconds S] [--size MB] [--loop uvloop]
+"""
+import asyncio
+import logging
+import os
+import socket
+import ssl
+import sys
+import tempfile
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.manager import AssCatManager  # noqa: E402
+from asscat.tls import DEFAULT_PROFILE, profile_paths  # noqa: E402
+
+VERSIONS = {'1.2': ssl.TLSVersion.TLSv1_2, '1.3': ssl.TLSVersion.TLSv1_3}
+
+
+class BenchManager(AssCatManager):
+    """Manager that greets every session and reads it until EOF"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drained = []
+
+    def client_connected_cb(self, session, peername) -> None:
+        super().client_connected_cb(session, peername)
+        session.transport.write(b'$ ')
+        self.drained.append(self._loop.create_task(self._drain(session)))
+
+    @staticmethod
+    async def _drain(session) -> int:
+        total = 0
+        reader, writer = session.reader, session.writer
+        while block := await reader.read(65536):
+            total += len(block)
+        writer.close()
+        return total
+
+
+def client_context(cafile: str, version: str) -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = context.maximum_version = VERSIONS[version]
+    return context
+
+
+def connect_loop(port: int, context, resume: bool, deadline: float) -> tuple:
+    """Connect until ``deadline``, returns connections and how many resumed"""
+    connections = resumed = 0
+    session = None
+    while perf_counter() < deadline:
+        sock = socket.create_connection(('127.0.0.1', port))
+        if context is not None:
+            sock = context.wrap_socket(sock, server_hostname='localhost', session=session)
+        # The greeting also carries the TLS 1.3 tickets in front of it
+        sock.recv(2)
+        if context is not None:
+            resumed += sock.session_reused
+            if resume:
+                session = sock.session
+        sock.close()
+        connections += 1
+    return connections, resumed
+
+
+async def handshakes(acm: BenchManager, ssl_arg, context, resume: bool, args) -> tuple:
+    loop = asyncio.get_running_loop()
+    l_id, server = await acm.create_listener('127.0.0.1', 0, ssl=ssl_arg)
+    await acm.start_listener(l_id)
+    port = server.sockets[0].getsockname()[1]
+    start = perf_counter()
+    deadline = start + args.seconds
+    with ThreadPoolExecutor(args.clients) as pool:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, connect_loop, port, context, resume, deadline)
+            for _ in range(args.clients)))
+    elapsed = perf_counter() - start
+    await acm.stop_listener(l_id)
+    await asyncio.gather(*acm.drained)
+    acm.drained.clear()
+    connections = sum(r[0] for r in results)
+    return connections / elapsed, sum(r[1] for r in results) / max(connections, 1)
+
+
+async def bulk_client(port: int, context, payload: bytes, size: int):
+    _, writer = await asyncio.open_connection(
+        '127.0.0.1', port, ssl=context, server_hostname='localhost' if context else None)
+    for _ in range(size // len(payload)):
+        writer.write(payload)
+        await writer.drain()
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, ssl.SSLError):
+        pass
+
+
+async def throughput(acm: BenchManager, ssl_arg, context, args) -> float:
+    l_id, server = await acm.create_listener('127.0.0.1', 0, ssl=ssl_arg)
+    await acm.start_listener(l_id)
+    port = server.sockets[0].getsockname()[1]
+    payload = os.urandom(64 * 1024)
+    size = args.size << 20
+    start = perf_counter()
+    await asyncio.gather(*(bulk_client(port, context, payload, size) for _ in range(args.clients)))
+    received = sum(await asyncio.gather(*acm.drained))
+    elapsed = perf_counter() - start
+    acm.drained.clear()
+    await acm.stop_listener(l_id)
+    assert received == args.clients * (size // len(payload)) * len(payload)
+    return received / elapsed / 1024 / 1024
+
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+    acm = BenchManager(loop, buffered=args.buffered, idle_reclaim=None, tls_dir=args.tls_dir)
+    # Generates the default profile on first use
+    await acm.ssl_context(True)
+    cafile = profile_paths(DEFAULT_PROFILE, args.tls_dir).certfile
+
+    print(f'{"handshakes":<28}{"per second":>12}{"resumed":>10}')
+    rate, _ = await handshakes(acm, None, None, False, args)
+    print(f'{"plaintext":<28}{rate:>12.0f}{"":>10}')
+    for version in VERSIONS:
+        context = client_context(cafile, version)
+        for resume in (False, True):
+            rate, reused = await handshakes(acm, True, context, resume, args)
+            label = f'TLS {version} {"resumed" if resume else "full"}'
+            print(f'{label:<28}{rate:>12.0f}{reused:>10.0%}')
+
+    print(f'\n{"throughput":<28}{"MB/s":>12}')
+    for version in (None, *VERSIONS):
+        context = None if version is None else client_context(cafile, version)
+        mbs = max([await throughput(acm, version is not None, context, args)
+                   for _ in range(args.rounds)])
+        print(f'{"plaintext" if version is None else f"TLS {version}":<28}{mbs:>12.1f}')
+
+    stats = acm.tls_stats()
+    for profile, s in stats.items():
+        print(f'\n{os.path.basename(profile.certfile)}: {s.handshakes} handshakes, '
+              f'{s.resumed} resumed, {s.full} full')
+    await acm.shutdown()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=3., help='Seconds of handshakes per case')
+    parser.add_argument('--size', type=int, default=32, help='MB sent per client')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--buffered', action='store_true', help='Use AssCatBufferedProtocol')
+    parser.add_argument('--tls-dir', default=None, help='Certificate profiles, a temporary one by default')
+    parser.add_argument('--loop', choices=('asyncio', 'uvloop'), default='uvloop')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        args.tls_dir = args.tls_dir or tmp
+        print(f'loop: {args.loop}')
+        if args.loop == 'uvloop':
+            import uvloop
+            uvloop.run(main(args))
+        else:
+            asyncio.run(main(args))
@@ -0,0 +1,350 @@
+"""
+Microbenchmark suite for the stream, protocol, manager and command hot paths.
+
+Runs every case on stock asyncio and uvloop, prints a table, optionally
+writes the results as JSON and compares them against a saved baseline.
+
+    python -m benchmarks.suite --json results.json
+    python -m benchmarks.suite --compare results.json --threshold 10
+    python -m benchmarks.suite --filter reader --loop uvloop
+"""
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+this = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(this))
+
+from asscat.commands import Cmds  # noqa: E402
+from asscat.manager import AssCatManager  # noqa: E402
+from asscat.protocols import AssCatProtocol  # noqa: E402
+from asscat.streams import AssCatReader, AssCatWriter  # noqa: E402
+
+CHUNK_SIZES = (64, 1024, 16384, 65536)
+STREAM_SIZE = 4 * 1024 * 1024
+LINE = b'-rw-r--r-- 1 root root 1024 Jan  1 00:00 /var/log/some/file.log\n'
+
+
+class Sample(NamedTuple):
+    ops: int
+    nbytes: int
+    seconds: float
+
+
+class Case(NamedTuple):
+    name: str
+    func: Callable
+    params: Tuple
+
+
+CASES: List[Case] = []
+
+
+def bench(name: str, params: Tuple = (None,)):
+    """Register a coroutine function returning a Sample as benchmark case"""
+    def decorator(func):
+        CASES.append(Case(name, func, params))
+        return func
+    return decorator
+
+
+class FakeTransport(asyncio.Transport):
+    """Transport that swallows writes, stands in for sockets and pipes"""
+
+    def __init__(self, peername=('127.0.0.1', 4444)):
+        super().__init__()
+        self._peername = peername
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self._peername
+        return default
+
+    def write(self, data):
+        pass
+
+    def writelines(self, list_of_data):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        self._closing = True
+
+
+def make_payload(size: int = STREAM_SIZE) -> bytes:
+    return LINE * (size // len(LINE))
+
+
+def chunked(payload: bytes, chunk_size: int) -> List[bytes]:
+    return [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)]
+
+
+def fed_reader(chunks: List[bytes]) -> AssCatReader:
+    reader = AssCatReader(asyncio.get_running_loop(), limit=2 ** 16)
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    reader.feed_eof()
+    return reader
+
+
+@bench('reader.read', CHUNK_SIZES)
+async def reader_read(chunk_size: int) -> Sample:
+    payload = make_payload()
+    reader = fed_reader(chunked(payload, chunk_size))
+    ops = 0
+    start = perf_counter()
+    while await reader.read(chunk_size):
+        ops += 1
+    return Sample(ops, len(payload), perf_counter() - start)
+
+
+@bench('reader.readline', CHUNK_SIZES)
+async def reader_readline(chunk_size: int) -> Sample:
+    payload = make_payload()
+    reader = fed_reader(chunked(payload, chunk_size))
+    ops = 0
+    start = perf_counter()
+    while await reader.readline():
+        ops += 1
+    return Sample(ops, len(payload), perf_counter() - start)
+
+
+@bench('reader.read_until', CHUNK_SIZES)
+async def reader_read_until(chunk_size: int) -> Sample:
+    payload = make_payload()
+    reader = fed_reader(chunked(payload, chunk_size))
+    ops = 0
+    start = perf_counter()
+    try:
+        while True:
+            await reader.read_until(b'root ')
+            ops += 1
+    except asyncio.IncompleteReadError:
+        pass
+    return Sample(ops, len(payload), perf_counter() - start)
+
+
+@bench('reader.aiter', CHUNK_SIZES)
+async def reader_aiter(chunk_size: int) -> Sample:
+    payload = make_payload()
+    reader = fed_reader(chunked(payload, chunk_size))
+    ops = 0
+    start = perf_counter()
+    async for _ in reader:
+        ops += 1
+    return Sample(ops, len(payload), perf_counter() - start)
+
+
+@bench('protocol.data_received', CHUNK_SIZES)
+async def protocol_data_received(chunk_size: int) -> Sample:
+    loop = asyncio.get_running_loop()
+    acm = AssCatManager(loop)
+    session = AssCatProtocol(loop, acm, 0)
+    session.connection_made(FakeTransport())
+    session.stdout_connection_made(FakeTransport())
+    payload = make_payload()
+    chunks = chunked(payload, chunk_size)
+    data_received = session.data_received
+    start = perf_counter()
+    for chunk in chunks:
+        data_received(chunk)
+    elapsed = perf_counter() - start
+    await acm.shutdown()
+    return Sample(len(chunks), len(payload), elapsed)
+
+
+@bench('protocol.keystroke', ('untracked', 'tracked'))
+async def protocol_keystroke(kind: str) -> Sample:
+    loop = asyncio.get_running_loop()
+    acm = AssCatManager(loop)
+    session = AssCatProtocol(loop, acm, 0)
+    session.connection_made(FakeTransport())
+    session.stdout_connection_made(FakeTransport())
+    if kind == 'tracked':
+        session.track_latency()
+    keys = [b'l', b's', b'\r'] * 10000
+    stdin_data_received, data_received = session.stdin_data_received, session.data_received
+    start = perf_counter()
+    for key in keys:
+        stdin_data_received(key)
+        data_received(key)
+    elapsed = perf_counter() - start
+    await acm.shutdown()
+    return Sample(len(keys), len(keys), elapsed)
+
+
+@bench('writer.write', (16, 256, 4096))
+async def writer_write(size: int) -> Sample:
+    loop = asyncio.get_running_loop()
+    session = AssCatProtocol(loop, AssCatManager(loop), 0)
+    writer = AssCatWriter(FakeTransport(), session, None, loop)
+    data = b'x' * size
+    ops = 20000
+    start = perf_counter()
+    for i in range(ops):
+        writer.write(data)
+        if not i % 100:
+            # Let the coalesced writes go out like a loop iteration would
+            await writer.flush()
+    await writer.flush()
+    return Sample(ops, ops * size, perf_counter() - start)
+
+
+@bench('manager.churn', (1000,))
+async def manager_churn(sessions: int) -> Sample:
+    loop = asyncio.get_running_loop()
+    acm = AssCatManager(loop)
+    transports = [FakeTransport(('10.0.0.1', 1024 + i)) for i in range(sessions)]
+    start = perf_counter()
+    for transport in transports:
+        session = AssCatProtocol(loop, acm, 0)
+        session.connection_made(transport)
+        session.connection_lost(None)
+    elapsed = perf_counter() - start
+    await acm.shutdown()
+    return Sample(sessions, 0, elapsed)
+
+
+@bench('cmds.parse', ('keystroke', 'passthrough', 'builtin'))
+async def cmds_parse(kind: str) -> Sample:
+    cmds = Cmds(asyncio.get_running_loop())
+    if kind == 'builtin':
+        lines = [b'sessions\n', b'sessions 3\n', b'back\n'] * 10000
+    elif kind == 'keystroke':
+        lines = [b'l', b's', b'\r', b'\x1b[A', b''] * 6000
+    else:
+        lines = [b'ls -la /tmp\n', b'id\n', b'cat /etc/passwd | grep root\n'] * 10000
+    parse = cmds.parse
+    start = perf_counter()
+    for line in lines:
+        await parse(line)
+    return Sample(len(lines), 0, perf_counter() - start)
+
+
+async def run_cases(cases: List[Case], repeat: int) -> Dict[str, Dict]:
+    results = {}
+    for case in cases:
+        for param in case.params:
+            key = case.name if param is None else f'{case.name}[{param}]'
+            best: Optional[Sample] = None
+            for _ in range(repeat):
+                sample = await case.func(param)
+                if best is None or sample.seconds < best.seconds:
+                    best = sample
+            results[key] = {
+                'ops': best.ops,
+                'bytes': best.nbytes,
+                'seconds': best.seconds,
+                'ops_per_sec': best.ops / best.seconds,
+                'mb_per_sec': best.nbytes / best.seconds / 1024 / 1024,
+            }
+    return results
+
+
+def run_on_loop(loop_name: str, cases: List[Case], repeat: int) -> Dict[str, Dict]:
+    if loop_name == 'uvloop':
+        import uvloop
+        return uvloop.run(run_cases(cases, repeat))
+    return asyncio.run(run_cases(cases, repeat))
+
+
+def available_loops() -> List[str]:
+    loops = ['asyncio']
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        loops.append('uvloop')
+    return loops
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    """Print ops/sec against the baseline, return keys slower than threshold %"""
+    regressions = []
+    print(f'\n{"benchmark":<48}{"baseline":>14}{"current":>14}{"change":>10}')
+    for key, current in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        change = (current['ops_per_sec'] / base['ops_per_sec'] - 1) * 100
+        flag = ''
+        if change < -threshold:
+            regressions.append(key)
+            flag = '  <-- regression'
+        print(f'{key:<48}{base["ops_per_sec"]:>14.0f}{current["ops_per_sec"]:>14.0f}'
+              f'{change:>+9.1f}%{flag}')
+    return regressions
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--loop', choices=('asyncio', 'uvloop', 'all'), default='all')
+    parser.add_argument('--filter', default='', help='Only run cases containing this string')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of N runs per case')
+    parser.add_argument('--json', dest='json_path', help='Write results to this file')
+    parser.add_argument('--compare', dest='baseline', help='Baseline JSON to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Allowed slowdown in percent before failing --compare')
+    parser.add_argument('--with-logging', action='store_true',
+                        help='Keep manager logging enabled while measuring')
+    args = parser.parse_args()
+
+    if not args.with_logging:
+        logging.disable(logging.INFO)
+
+    loops = available_loops() if args.loop == 'all' else [args.loop]
+    cases = [case for case in CASES if args.filter in case.name]
+
+    results = {}
+    for loop_name in loops:
+        for key, value in run_on_loop(loop_name, cases, args.repeat).items():
+            results[f'{loop_name}:{key}'] = value
+
+    print(f'{"benchmark":<48}{"ops/s":>14}{"MB/s":>10}')
+    for key, value in results.items():
+        mbs = f'{value["mb_per_sec"]:.1f}' if value['bytes'] else '-'
+        print(f'{key:<48}{value["ops_per_sec"]:>14.0f}{mbs:>10}')
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({
+                'meta': {
+                    'created': datetime.now(timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'implementation': platform.python_implementation(),
+                    'machine': platform.machine(),
+                    'loops': loops,
+                },
+                'results': results,
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())